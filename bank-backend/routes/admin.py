@@ -1,11 +1,18 @@
-import redis
 import json
+import csv
+import io
 from fastapi import APIRouter, WebSocket, WebSocketDisconnect, Depends, HTTPException, Query
 from sqlalchemy.orm import Session
-from sqlalchemy import text
-from src.database import get_db
+from sqlalchemy import select
+from src.database import get_db, SessionLocal, engine, async_engine
+from src.redis_client import pool as redis_pool, async_pool as async_redis_pool, blocking_pool as blocking_redis_pool
+from src.pool_metrics import sqlalchemy_pool_stats, redis_pool_stats, async_redis_pool_stats
 from src.models import Transaction, AtmDevice
-from src.auth import admin_required
+from src.auth import admin_required, list_sessions
+from src.transaction_stats import get_stats
+from src.atm_pool import publish_free_atm
+from src.account_lock import lock_stats
+from src.transaction_feed import subscribe_feed
 import asyncio
 from fastapi.responses import StreamingResponse, JSONResponse
 from pydantic import BaseModel, constr
@@ -13,40 +20,89 @@ from typing import Optional
 from datetime import date
 
 router = APIRouter()
-r = redis.Redis(host='localhost', port=6379, db=0)
-
-active_connections = []
 
 @router.websocket("/ws/admin")
 async def websocket_endpoint(websocket: WebSocket, current_user=Depends(admin_required)):
     # Sprawdzenie, czy użytkownik jest administratorem (np. user_id == 1)
-    if current_user.get("role") != "admin":
+    if current_user.role != "admin":
         raise HTTPException(status_code=403, detail="Access forbidden")
 
     await websocket.accept()
-    active_connections.append(websocket)
 
-    try:
-        while True:
-            data = await websocket.receive_text()
-            await websocket.send_text(f"Received: {data}")  # Echo testowe
-    except WebSocketDisconnect:
-        active_connections.remove(websocket)
-
-def broadcast_transaction(transaction: dict):
-    """Wysyła transakcję do wszystkich połączonych klientów WebSocket"""
-    for connection in active_connections:
+    # Zdarzenia transakcji (redis pub/sub) -- własny, ograniczony bufor klienta
+    async with subscribe_feed() as client:
+        sender = asyncio.create_task(send_feed(websocket, client))
         try:
-            connection.send_text(json.dumps(transaction))
-        except:
-            active_connections.remove(connection)
+            while True:
+                await websocket.receive_text()      # wiadomości klienta są pomijane -- odbiór wykrywa rozłączenie
+        except WebSocketDisconnect:
+            pass
+        finally:
+            sender.cancel()
+
+async def send_feed(websocket: WebSocket, client):
+    """Wysyła klientowi WebSocket kolejne zdarzenia z jego bufora"""
+    while True:
+        event = await client.get()
+        await websocket.send_text(json.dumps(event))
+
+EXPORT_COLUMNS = [Transaction.id, Transaction.from_account_id, Transaction.to_account_id, Transaction.amount,
+                  Transaction.type, Transaction.date, Transaction.status, Transaction.device_id]
+
+EXPORT_BATCH_SIZE = 1000
 
 @router.get("/admin/transactions")
-def get_transactions(db: Session = Depends(get_db), current_user=Depends(admin_required)):
-    """Zwraca listę transakcji dla administratora"""
+def get_transactions(cursor: Optional[int] = Query(None), limit: int = Query(100, ge=1, le=1000),
+                     db: Session = Depends(get_db), current_user=Depends(admin_required)):
+    """Zwraca stronę listy transakcji dla administratora (od najnowszych, paginacja po id)"""
+
+    query = db.query(*EXPORT_COLUMNS)
+    if cursor is not None:
+        query = query.filter(Transaction.id < cursor)
+
+    # Jeden wiersz więcej -- informacja, czy istnieje następna strona
+    rows = query.order_by(Transaction.id.desc()).limit(limit + 1).all()
+    next_cursor = rows[limit - 1].id if len(rows) > limit else None
 
-    transactions = db.query(Transaction).all()
-    return transactions
+    return {"items": [row._asdict() for row in rows[:limit]], "next_cursor": next_cursor}
+
+@router.get("/admin/transactions/export")
+def export_transactions(format: str = Query("ndjson", enum=["ndjson", "csv"]), current_user=Depends(admin_required)):
+    """Eksport wszystkich transakcji (NDJSON/CSV) strumieniowo -- pamięć nie zależy od rozmiaru tabeli"""
+
+    if format == "csv":
+        return StreamingResponse(export_rows(csv_chunks), media_type="text/csv",
+                                 headers={"Content-Disposition": "attachment; filename=transactions.csv"})
+
+    return StreamingResponse(export_rows(ndjson_chunks), media_type="application/x-ndjson",
+                             headers={"Content-Disposition": "attachment; filename=transactions.ndjson"})
+
+def export_rows(serialize):
+    """
+    Odczyt tabeli kursorem po stronie serwera (yield_per) i serializacja paczkami.
+    Sesja jest tworzona tutaj -- musi żyć tak długo, jak strumień odpowiedzi.
+    """
+    db = SessionLocal()
+    try:
+        result = db.execute(select(*EXPORT_COLUMNS).order_by(Transaction.id).execution_options(yield_per=EXPORT_BATCH_SIZE))
+        yield from serialize(result.partitions())
+    finally:
+        db.close()
+
+def ndjson_chunks(partitions):
+    for rows in partitions:
+        yield "".join(json.dumps(row._asdict(), default=str) + "\n" for row in rows)
+
+def csv_chunks(partitions):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow([column.key for column in EXPORT_COLUMNS])
+    for rows in partitions:
+        writer.writerows(rows)
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+    yield buffer.getvalue()
 
 @router.get("/admin/atms")
 def get_atms(db: Session = Depends(get_db), current_user=Depends(admin_required)):
@@ -55,13 +111,41 @@ def get_atms(db: Session = Depends(get_db), current_user=Depends(admin_required)
     atms = db.query(AtmDevice).all()
     return atms
 
+@router.get("/admin/pool-stats")
+def get_pool_stats(current_user=Depends(admin_required)):
+    """Stan pul połączeń (Postgres sync/async, Redis sync/async/blokujące) w tym procesie: zajęte i wolne połączenia, oczekiwania, czasy pobrania"""
+
+    return {
+        "postgres": sqlalchemy_pool_stats(engine.pool),
+        "postgres_async": sqlalchemy_pool_stats(async_engine.sync_engine.pool),
+        "redis": redis_pool_stats(redis_pool),
+        "redis_async": async_redis_pool_stats(async_redis_pool),
+        "redis_blocking": async_redis_pool_stats(blocking_redis_pool),
+    }
+
+@router.get("/admin/sessions")
+def get_sessions(cursor: int = Query(0, ge=0), count: int = Query(100, ge=1, le=1000),
+                 current_user=Depends(admin_required)):
+    """Zwraca stronę aktywnych sesji (rejestr sesji w redis, bez KEYS) i kursor następnej strony (0 -- ostatnia)"""
+
+    next_cursor, sessions = list_sessions(cursor, count)
+    return {"sessions": sessions, "next_cursor": next_cursor}
+
+@router.get("/admin/lock-stats")
+def get_lock_stats(current_user=Depends(admin_required)):
+    """Blokady kont (sesje bankomatowe) w tym procesie: liczba uzyskań, oczekiwań, przekroczeń czasu i czasy oczekiwania"""
+
+    return lock_stats()
+
 async def event_stream():
-    while True:
-        yield f"data: Nowa transakcja o wartości 100 PLN\n\n"
-        await asyncio.sleep(2)  # Co 2 sekundy wysyła nową wiadomość
+    # Subskrypcja trwa do rozłączenia klienta (anulowanie generatora)
+    async with subscribe_feed() as client:
+        while True:
+            event = await client.get()
+            yield f"data: {json.dumps(event)}\n\n"
 
 @router.get("/sse/logs")
-async def sse_logs():
+async def sse_logs(current_user=Depends(admin_required)):
     return StreamingResponse(event_stream(), media_type="text/event-stream")
 
 
@@ -80,6 +164,8 @@ def create_atm(atm: AtmDeviceCreate, db: Session = Depends(get_db), current_user
         db.add(new_atm)
         db.commit()
         db.refresh(new_atm)
+        if new_atm.status == 'active':
+            publish_free_atm(new_atm.id, new_atm.localization)
         return {"message": "ATM device created", "atm_id": new_atm.id}
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"An error occurred: {e}")
@@ -104,52 +190,12 @@ def get_transaction_stats(
     end_date: Optional[date] = Query(None),
     db: Session = Depends(get_db), current_user=Depends(admin_required)
 ):
-    if granularity == 'days':
-        group_by = "DATE_TRUNC('day', date)"
-    elif granularity == 'hours':
-        group_by = "DATE_TRUNC('hour', date)"
-    elif granularity == 'minutes':
-        group_by = "DATE_TRUNC('minute', date)"
-    else:
+    if granularity not in ['days', 'hours', 'minutes']:
         return JSONResponse(content={"detail": "Nieprawidłowa granulacja"}, status_code=400)
 
-    query = f"""
-        SELECT {group_by} as period, COUNT(*) as count
-        FROM transactions
-    """
-
-    filters = []
-    params = {}
-
-    if status:
-        filters.append("status = :status")
-        params["status"] = status
-
-    if start_date:
-        filters.append("date >= :start_date")
-        params["start_date"] = start_date.strftime('%Y-%m-%d')
-
-    if end_date:
-        filters.append("date <= :end_date")
-        params["end_date"] = end_date.strftime('%Y-%m-%d')
-
-    if filters:
-        query += " WHERE " + " AND ".join(filters)
-
-    query += """
-        GROUP BY period
-        ORDER BY period ASC
-    """
+    # Zliczenia z tabeli minutowych agregatów (transaction_stats_minute), godziny i dni są z nich sumowane
     try:
-        print(f"Executing query: {query}, with parameters: {params}")
-        result = db.execute(text(query), params).fetchall()
-        response = [
-            {"time": row[0], "count": row[1]}
-            for row in result
-        ]
-        if not result:
-            return []
-        return response
+        return get_stats(db, granularity, status, start_date, end_date)
     except Exception as e:
         print(f"Error executing query: {e}")
-        return JSONResponse(content={"detail": "Błąd zapytania do bazy danych"}, status_code=500)
\ No newline at end of file
+        return JSONResponse(content={"detail": "Błąd zapytania do bazy danych"}, status_code=500)
@@ -1,7 +1,11 @@
-from fastapi import APIRouter, Depends, HTTPException, Form, Query
+from fastapi import APIRouter, Depends, HTTPException, Form, Query, Header
+from fastapi.concurrency import run_in_threadpool
+from sqlalchemy import select, update
 from sqlalchemy.orm import Session
+from sqlalchemy.ext.asyncio import AsyncSession
+from typing import Optional
 
-from src.database import get_db
+from src.database import get_db, get_async_db, AsyncSessionLocal
 from src.models import Transaction, Account, Card, AtmDevice, User
 from pydantic import BaseModel
 from datetime import datetime, timezone
@@ -9,14 +13,25 @@ import requests
 from routes.verify import router as verify_router
 import pytz
 import time
-from redlock import Redlock
-
+import asyncio
+
+from src.aml_windows import record_transaction
+from src.balances import to_minor, total_balance
+from src.atm_pool import acquire_atm, release_atm
+from src.account_lock import account_lock, advance_fence
+from src.config import ATM_CONFIRMATION_TIMEOUT
+from src.notifications import RedisListener
+from src.idempotency import run_idempotent
+from src.transaction_feed import publish_transaction_event_async
+from src.partitions import by_ids
+from src.redis_client import async_r
+from services.atm import RESULT_CHANNEL_PATTERN, result_channel
 from src.celery_app import process_atm_operation_task
 from src.celery_app import celery_app
 router = APIRouter()
 router.include_router(verify_router)
 
-redlock = Redlock([{"host": "redis", "port": 6379}])
+atm_results = RedisListener(RESULT_CHANNEL_PATTERN)     # wyniki operacji publikowane przez workera
 
 
 class AtmFreeRequest(BaseModel):
@@ -52,29 +67,23 @@ class ConfirmationRequest(BaseModel):
 
 
 @router.get("/atm-assignment")
-def assign_atm(db: Session = Depends(get_db)):
+async def assign_atm(localization: Optional[str] = Query(None), db: AsyncSession = Depends(get_async_db)):
 
-    # Oczekiwanie na odpowiedź workera
-    response = assign_atm_intervals()
-    if response['status'] != 'success':
+    # Oczekiwanie w kolejce (FIFO) na wolny bankomat -- bez odpytywania bazy
+    atm_id = await acquire_atm(db, localization)
+    if atm_id is None:
         raise HTTPException(status_code=404, detail="Brak dostępnych bankomatów.")
 
-    return {"atm_id": response['atm_id']}
+    return {"atm_id": atm_id}
 
 
 @router.post("/atm-free")
-def free_atm(atm_request: AtmFreeRequest, db: Session = Depends(get_db)):
+async def free_atm(atm_request: AtmFreeRequest, db: AsyncSession = Depends(get_async_db)):
 
-    # Zwolnienie bankomatu przy anulowaniu operacji
-    atm_id = atm_request.atm_id
-    atm_data = db.query(AtmDevice).filter(AtmDevice.id == atm_id).first()
-    if not atm_data:
+    # Zwolnienie bankomatu przy anulowaniu operacji -- budzi pierwszego oczekującego klienta
+    if not await release_atm(db, atm_request.atm_id):
         raise HTTPException(status_code=404, detail="Bankomat nie istnieje.")
 
-    atm_data.status = 'active'
-    db.commit()
-    db.refresh(atm_data)
-
     return {"message": "ok"}
 
 
@@ -95,7 +104,7 @@ def free_account(account_request: AccountFreeRequest, db: Session = Depends(get_
 
 
 @router.post("/atm-operation/verification")
-def verify_atm_operation(operation_data: ATMVerificationModel, db: Session = Depends(get_db)):
+async def verify_atm_operation(operation_data: ATMVerificationModel, db: AsyncSession = Depends(get_async_db)):
 
     """
     Weryfikacja warunków do przeprowadzenia operacji w bankomacie, tj. czy karta i bankomat "działają".
@@ -110,7 +119,7 @@ def verify_atm_operation(operation_data: ATMVerificationModel, db: Session = Dep
     atm_id = operation_data.atm_id
 
     # Sprawdzenie, czy bankomat istnieje
-    atm_data = db.query(AtmDevice).filter(AtmDevice.id == atm_id).first()
+    atm_data = await db.get(AtmDevice, atm_id)
     if not atm_data:
         raise HTTPException(status_code=404, detail="Bankomat nie istnieje.")
 
@@ -118,19 +127,17 @@ def verify_atm_operation(operation_data: ATMVerificationModel, db: Session = Dep
     # BANKOMANT JEST JUŻ ZAREZERWOWANY DLA KLIENTA NA POCZĄTKU ENDPOINTA
 
     # Sprawdzenie, czy karta może być obsłużona przez bankomat
-    card_data = db.query(Card).filter(Card.id == card_id).first()
+    card_data = await db.get(Card, card_id)
     if not card_data:
 
-        atm_data.status = 'active'
-        db.commit()
-        db.refresh(atm_data)
+        await release_atm(db, atm_id)
         raise HTTPException(status_code=404, detail="Nie rozpoznano karty.")
 
     return {"status": "ok"}
 
 
 @router.post("/atm-operation/pin-verification")
-def verify_pin(verification_data: PINVerificationModel, db: Session = Depends(get_db)):
+async def verify_pin(verification_data: PINVerificationModel, db: AsyncSession = Depends(get_async_db)):
 
     # Weryfikacja pinu i klienta
 
@@ -140,41 +147,53 @@ def verify_pin(verification_data: PINVerificationModel, db: Session = Depends(ge
     #card_data = db.query(Card).filter(Card.id == card_id).first()
 
     # Sprawdzenie PIN-u podanego przez klienta (czy PIN pasuje do karty)
-    pin_data = db.query(Card).filter(Card.id == card_id, Card.pin == pin).first()
+    pin_data = (await db.execute(select(Card.id).where(Card.id == card_id, Card.pin == pin))).first()
     if not pin_data:
         raise HTTPException(status_code=401, detail="Wprowadzony PIN jest niepoprawny.")
 
     # Sprawdzenie, czy konto może być obsłużone (czy istnieje oraz, czy nie jest zablokowane)
     # Sprawdzenie, czy użytkownik nie jest tymczasowo zablokowany
     # Oczekiwanie na uzyskanie dostępu do konta
-    response = check_account_lock(card_id)
+    response = await check_account_lock(card_id)
 
-    if response['label'] == 'timeout':
+    if response['label'] == 'timeout' or response['label'] == 'not_found':
         raise HTTPException(status_code=404, detail="Nie znaleziono konta.")
     elif response['label'] == 'account_busy' or response['label'] == 'user_disabled':
         raise HTTPException(status_code=403, detail="Usługa tymczasowo niedostępna.")
+    elif response['label'] == 'error':
+        raise HTTPException(status_code=500, detail=response['message'])
     else:
         return {"message": "ok"}
 
 
 @router.post("/atm-operation/withdrawal")
-def withdraw_funds(withdrawal_data: ATMOperationModelPIN, db: Session = Depends(get_db)):
+async def withdraw_funds(withdrawal_data: ATMOperationModelPIN, db: AsyncSession = Depends(get_async_db),
+                         idempotency_key: Optional[str] = Header(None, alias="Idempotency-Key")):
 
     """
     Dalsza weryfikacja -- po wprowadzeniu PIN oraz wykonanie wypłaty.
+    Ponowienie z tym samym Idempotency-Key zwraca odpowiedź pierwszego żądania (src.idempotency).
     :param withdrawal_data:
     :param db:
+    :param idempotency_key:
     :return:
     """
+
+    return await run_idempotent(f"atm-withdrawal:{withdrawal_data.atm_id}", idempotency_key, withdrawal_data,
+                                lambda: _withdraw_funds(withdrawal_data, db))
+
+
+async def _withdraw_funds(withdrawal_data: ATMOperationModelPIN, db: AsyncSession):
     card_id = withdrawal_data.card_id
     atm_id = withdrawal_data.atm_id
     amount = withdrawal_data.amount
 
-    card_data = db.query(Card).filter(Card.id == card_id).first()
-    account_data = db.query(Account).filter(Account.id == card_data.account_id).first()
+    account_data = (await db.execute(select(Account.id, total_balance(Account.id).label("balance"))
+                                     .join(Card, Card.account_id == Account.id)
+                                     .where(Card.id == card_id))).first()
 
-    # Sprawdzenie, czy na koncie są wystarczające środki
-    if account_data.balance < amount:
+    # Sprawdzenie, czy na koncie są wystarczające środki (wstępne -- o wypłacie decyduje warunkowe UPDATE workera)
+    if account_data.balance < to_minor(amount):
         raise HTTPException(status_code=409, detail="Niewystarczające środki.")
 
     # Sprawdzenie, czy podaną kwotę można wypłacić
@@ -185,34 +204,50 @@ def withdraw_funds(withdrawal_data: ATMOperationModelPIN, db: Session = Depends(
     new_transaction = Transaction(from_account_id=account_data.id, to_account_id=0, amount=amount,
                                   type='withdrawal', status='pending', device_id=atm_id)
     db.add(new_transaction)
-    db.commit()
-    db.refresh(new_transaction)
+    await db.commit()
+
+    # Okna czasowe AML (redis) -- liczniki, sumy i lokalizacje bankomatów
+    localization = (await db.execute(select(AtmDevice.localization).where(AtmDevice.id == atm_id))).scalar()
+    await run_in_threadpool(record_transaction, new_transaction, localization)     # synchroniczny klient redis
+    await publish_transaction_event_async(new_transaction.id, new_transaction.status, type=new_transaction.type,
+                                          amount=amount, from_account_id=account_data.id, device_id=atm_id)
 
-    celery_app.send_task("process_atm_operation_task", args=[new_transaction.id])
+    await run_in_threadpool(celery_app.send_task, "process_atm_operation_task",
+                            args=[new_transaction.id, new_transaction.date.isoformat()])
 
     return {
         "message": "Transakcja w toku...",
         "transaction_id": new_transaction.id,
+        "date": new_transaction.date.isoformat(),
         "status": "processing"
     }
 
 
 @router.post("/atm-operation/deposit")
-def deposit_funds(deposit_data: ATMOperationModelPIN, db: Session = Depends(get_db)):
+async def deposit_funds(deposit_data: ATMOperationModelPIN, db: AsyncSession = Depends(get_async_db),
+                        idempotency_key: Optional[str] = Header(None, alias="Idempotency-Key")):
 
     """
     Dalsza weryfikacja -- po wprowadzeniu PIN oraz wykonanie wypłaty.
+    Ponowienie z tym samym Idempotency-Key zwraca odpowiedź pierwszego żądania (src.idempotency).
     :param deposit_data:
     :param db:
+    :param idempotency_key:
     :return:
     """
 
+    return await run_idempotent(f"atm-deposit:{deposit_data.atm_id}", idempotency_key, deposit_data,
+                                lambda: _deposit_funds(deposit_data, db))
+
+
+async def _deposit_funds(deposit_data: ATMOperationModelPIN, db: AsyncSession):
+
     card_id = deposit_data.card_id
     atm_id = deposit_data.atm_id
     amount = deposit_data.amount
 
-    card_data = db.query(Card).filter(Card.id == card_id).first()
-    account_data = db.query(Account).filter(Account.id == card_data.account_id).first()
+    account_data = (await db.execute(select(Account).join(Card, Card.account_id == Account.id)
+                                     .where(Card.id == card_id))).scalars().first()
 
     # Sprawdzenie, czy podaną kwotę można wpłacić
     if amount % 10 != 0:
@@ -222,23 +257,31 @@ def deposit_funds(deposit_data: ATMOperationModelPIN, db: Session = Depends(get_
     new_transaction = Transaction(from_account_id=0, to_account_id=account_data.id, amount=amount,
                                   type='deposit', status='pending', device_id=atm_id)
     db.add(new_transaction)
-    db.commit()
-    db.refresh(new_transaction)
+    await db.commit()
 
-    celery_app.send_task("process_atm_operation_task", args=[new_transaction.id])
+    # Okna czasowe AML (redis) -- liczniki, sumy i lokalizacje bankomatów
+    localization = (await db.execute(select(AtmDevice.localization).where(AtmDevice.id == atm_id))).scalar()
+    await run_in_threadpool(record_transaction, new_transaction, localization)     # synchroniczny klient redis
+    await publish_transaction_event_async(new_transaction.id, new_transaction.status, type=new_transaction.type,
+                                          amount=amount, to_account_id=account_data.id, device_id=atm_id)
+
+    await run_in_threadpool(celery_app.send_task, "process_atm_operation_task",
+                            args=[new_transaction.id, new_transaction.date.isoformat()])
 
     return {
             "message": "Transakcja w toku...",
             "transaction_id": new_transaction.id,
+            "date": new_transaction.date.isoformat(),
             "status": "processing"
         }
 
 @router.get("/atm-operation/confirmation")
-def get_confirmation(transaction_id: int, db: Session = Depends(get_db)):
+async def get_confirmation(transaction_id: int, date: Optional[datetime] = Query(None),
+                           db: AsyncSession = Depends(get_async_db)):
 
-    # Przygotowanie potwierdzenia
-    time.sleep(1)
-    transaction = db.query(Transaction).filter(Transaction.id == transaction_id).first()
+    # Przygotowanie potwierdzenia -- odpowiedź zaraz po zakończeniu przetwarzania przez workera (long-poll)
+    # date -- data utworzenia transakcji (z odpowiedzi wypłaty/wpłaty), odczyt tylko partycji od jej miesiąca
+    transaction = await wait_for_atm_result(db, transaction_id, date)
 
     if transaction:
 
@@ -265,42 +308,36 @@ def get_confirmation(transaction_id: int, db: Session = Depends(get_db)):
         return {"confirmation": "Błąd pobierania danych."}
 
 
-def assign_atm_intervals(timeout=10, interval=2):
+async def wait_for_atm_result(db: AsyncSession, transaction_id: int, tx_date: datetime = None,
+                              timeout: float = ATM_CONFIRMATION_TIMEOUT):
 
     """
-    Próba przypisania bankomatu przez [timeout] sekund.
-    :param timeout: jak długo próbować
-    :param interval: co ile wysyłać ponowną próbę
-    :return:
+    Oczekiwanie (najwyżej [timeout] sekund) na wynik przetwarzania operacji przez workera.
+    :param transaction_id: id transakcji
+    :param tx_date: data utworzenia transakcji -- worker przesuwa datę naprzód, więc jest dolną granicą (None -- wszystkie partycje)
+    :return: transakcja (w stanie po przetworzeniu lub aktualnym po upływie czasu), None -- brak transakcji
     """
 
-    db = next(get_db())
-    waited = 0
-
-    # Zapytanie
-    try:
-        while waited < timeout:
+    channel = result_channel(transaction_id)
+    lookup = select(Transaction).where(*by_ids([transaction_id], since=tx_date))
 
-            # Przypisanie bankomatu do użytkownika — oznaczenie go jako zajęty
-            atm_chosen = db.query(AtmDevice).filter(AtmDevice.status == 'active').with_for_update().first()
-            if atm_chosen:
-                atm_chosen.status = 'busy'
-                db.commit()
-                return {"status": "success", "atm_id": atm_chosen.id}
+    # Subskrypcja przed odczytem stanu -- wynik opublikowany w międzyczasie nie zostanie pominięty
+    async with atm_results.watch(channel) as result:
+        transaction = (await db.execute(lookup)).scalars().first()
+        if not transaction or transaction.status != 'pending' or await async_r.exists(channel):
+            return transaction
 
-            time.sleep(interval)    # Odczekaj odpowiednią ilość sekund
-            waited += interval
-            db.rollback()           # odświeżenie
-        return {"status": "failure", "error_message": "Brak dostępnych bankomatów. Spróbuj ponownie później."}
+        await db.rollback()     # zwolnienie połączenia na czas oczekiwania
+        try:
+            await asyncio.wait_for(result, timeout)
+        except asyncio.TimeoutError:
+            pass
 
-    except Exception as e:
-        db.rollback()
-        return {"status": "error", "message": f"Nieoczekiwany błąd: {e}"}
-    finally:
-        db.close()
+    # ponowny odczyt (data zmienia się przy przetworzeniu -- po id i dolnej granicy daty)
+    return (await db.execute(lookup.execution_options(populate_existing=True))).scalars().first()
 
 
-def check_account_lock(card_id: int):
+async def check_account_lock(card_id: int):
 
     """
     Próba uzyskania dostępu do konta.
@@ -308,44 +345,47 @@ def check_account_lock(card_id: int):
     :return:
     """
 
-    db = next(get_db())
-    lock = None
+    db = AsyncSessionLocal()
 
     try:
-        card = db.query(Card).filter(Card.id == card_id).first()
-        if not card:
-            return {"status": "error", "message": "Nie znaleziono karty"}
-
-        account = db.query(Account).filter(Account.id == card.account_id).first()
-        user = db.query(User).filter(User.id == account.user_id).first()
-
-        lock_key = f"lock-account-{account.id}"
-        for _ in range(10):  # Próba uzyskania dostępu do konta (lock_key) przez 10 sekund
-            lock = redlock.lock(lock_key, 10000)  # zablokowanie dostępu innym procesom na 10 sekund
-            if lock:
-                break
-            time.sleep(1)
-
-        if not lock:        # nie udało się uzyskać dostępu
-            return {"status": "error", "label": "timeout"}
-
-        if account.status == 'busy':       # udało się uzyskać dostęp, ale konto jest wciąż zajęte
-            return {"status": "error", "label": "account_busy"}
-
-        if user.status == 'disabled':       # klient jest zablokowany
+        # Karta, konto i klient -- jedno zapytanie
+        owner = (await db.execute(select(Account.id, User.status).join(Card, Card.account_id == Account.id)
+                                  .join(User, User.id == Account.user_id).where(Card.id == card_id))).first()
+        await db.rollback()         # zwolnienie połączenia na czas oczekiwania na blokadę
+        if not owner:
+            return {"status": "error", "label": "not_found"}
+
+        account_id, user_status = owner
+        if user_status == 'disabled':       # klient jest zablokowany
             return {"status": "error", "label": "user_disabled"}
 
-        account.status = 'busy'
-        db.commit()
-        db.refresh(account)
-
-        return {"status": "success", "account_id": account.id, 'label': 'success'}
+        # Oczekiwanie na zwolnienie blokady konta (wybudzenie przy zwolnieniu, bez ponawiania co sekundę)
+        async with account_lock(account_id) as token:
+            if token is None:        # nie udało się uzyskać dostępu
+                return {"status": "error", "label": "timeout"}
+
+            # udało się uzyskać dostęp -- konto zajmowane tylko, jeśli nie jest wciąż zajęte
+            # Token ochronny zapisywany w wierszu konta -- zapis z tokenem nie nowszym od zapisanego (blokada
+            # wygasła i przejął ją kolejny klient) jest odrzucany przez samą bazę
+            taken = (await db.execute(update(Account)
+                                      .where(Account.id == account_id, Account.status == 'active',
+                                             Account.lock_token < token)
+                                      .values(status='busy', lock_token=token).returning(Account.id))).first()
+            if not taken:
+                stored_token = (await db.execute(select(Account.lock_token).where(Account.id == account_id))).scalar()
+                await db.rollback()
+                if stored_token is not None and stored_token >= token:
+                    await advance_fence(account_id, stored_token)
+                    return {"status": "error", "label": "timeout"}
+                return {"status": "error", "label": "account_busy"}
+
+            await db.commit()
+
+        return {"status": "success", "account_id": account_id, 'label': 'success'}
 
     except Exception as e:
-        db.rollback()
-        return {"status": "error", "message": f"Nieoczekiwany błąd: {e}"}
+        await db.rollback()
+        return {"status": "error", "label": "error", "message": f"Nieoczekiwany błąd: {e}"}
 
     finally:
-        if lock:
-            redlock.unlock(lock)
-        db.close()
\ No newline at end of file
+        await db.close()
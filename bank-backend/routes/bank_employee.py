@@ -1,15 +1,17 @@
-import redis
-from fastapi import APIRouter, WebSocket, WebSocketDisconnect, Depends, HTTPException
+from fastapi import APIRouter, WebSocket, WebSocketDisconnect, Depends, HTTPException, Request
+from fastapi.responses import StreamingResponse
 from sqlalchemy.orm import Session
-from src.auth import bank_employee_required, hash_password
+from src.auth import bank_employee_required, invalidate_principal
+from src.password_pool import password_pool, PasswordPoolSaturated
 from src.database import get_db
 from src.models import User, Account, AtmDevice, Card
-import random
+from services.provisioning import stream_provisioning, provision_users, provision_accounts, provision_cards
+from src.account_numbers import allocate_account_numbers
+from src.balances import to_minor, to_major, total_balance
 from pydantic import BaseModel, constr
 from typing import Optional, List
 
 router = APIRouter()
-r = redis.Redis(host='localhost', port=6379, db=0)
 
 
 class UserCreate(BaseModel):
@@ -30,13 +32,19 @@ def create_user_admin(user: UserCreate, db: Session = Depends(get_db), current_u
     if existing_user:
         raise HTTPException(status_code=400, detail="User already exists")
 
+    # Hashowanie w puli procesów -- odrzucenie od razu, gdy pula jest przeciążona
+    try:
+        hashed_password = password_pool.hash(user.password)
+    except PasswordPoolSaturated:
+        raise HTTPException(status_code=503, detail="Service busy, try again later", headers={"Retry-After": "1"})
+
     # Utwórz użytkownika
     db_user = User(
         first_name=user.first_name,
         last_name=user.last_name,
         email=user.email,
         username=user.username,
-        password=hash_password(user.password),
+        password=hashed_password,
         role="user"
     )
 
@@ -55,18 +63,16 @@ def delete_user(username: int, db: Session = Depends(get_db), current_user=Depen
         raise HTTPException(status_code=404, detail="User not found")
 
     # Usuń użytkownika z bazy
+    user_id = user.id
     db.delete(user)
     db.commit()
+    invalidate_principal(user_id)
     return {"message": f"User {username} deleted"}
 
 class AccountCreate(BaseModel):
     user_id: int
     initial_balance: float = 0.0
 
-def generate_account_number():
-    # Generowanie 26-cyfrowego numeru konta
-    return ''.join([str(random.randint(0, 9)) for _ in range(26)])
-
 @router.post("/bank_employee/add-account", response_model=dict)
 def create_account(account: AccountCreate, db: Session = Depends(get_db), current_user=Depends(bank_employee_required)):
     # Sprawdzenie czy użytkownik istnieje
@@ -74,18 +80,14 @@ def create_account(account: AccountCreate, db: Session = Depends(get_db), curren
     if not user:
         raise HTTPException(status_code=404, detail="User not found")
 
-    # Generowanie unikalnego numeru konta
-    while True:
-        account_number = generate_account_number()
-        existing_account = db.query(Account).filter(Account.account_number == account_number).first()
-        if not existing_account:
-            break  # numer jest unikalny
+    # Numer konta z sekwencji (NRB z cyframi kontrolnymi) -- unikalny bez sprawdzania w bazie
+    account_number, = allocate_account_numbers(db, 1)
 
     # Tworzenie konta
     new_account = Account(
         user_id=account.user_id,
         account_number=account_number,
-        balance=account.initial_balance,
+        balance=to_minor(account.initial_balance),
         status="active"
     )
 
@@ -123,6 +125,43 @@ def add_card(
 
     return {"message": "Card created successfully", "card_id": new_card.id}
 
+# Modele wierszy NDJSON dla masowego zakładania
+class UserBulkCreate(BaseModel):
+    first_name: str
+    last_name: str
+    email: str
+    username: int
+    password: Optional[str] = None          # hasło jawne -- hashowane w puli procesów
+    password_hash: Optional[str] = None     # albo gotowy hash bcrypt (migracja z innego systemu)
+
+class AccountBulkCreate(BaseModel):
+    user_id: Optional[int] = None
+    username: Optional[int] = None          # zamiast user_id -- właściciel założony w tej samej migracji
+    initial_balance: float = 0.0
+
+class CardBulkCreate(BaseModel):
+    account_id: Optional[int] = None
+    account_number: Optional[str] = None    # zamiast account_id
+    pin_code: constr(min_length=4, max_length=4)
+
+
+async def bulk_response(request: Request, model, provision):
+    # Treść NDJSON -- jeden wiersz na encję; wynik NDJSON -- jeden wiersz na wiersz wejścia
+    body = await request.body()
+    return StreamingResponse(stream_provisioning(body, model, provision), media_type="application/x-ndjson")
+
+@router.post("/bank_employee/bulk/users")
+async def bulk_create_users(request: Request, current_user=Depends(bank_employee_required)):
+    return await bulk_response(request, UserBulkCreate, provision_users)
+
+@router.post("/bank_employee/bulk/accounts")
+async def bulk_create_accounts(request: Request, current_user=Depends(bank_employee_required)):
+    return await bulk_response(request, AccountBulkCreate, provision_accounts)
+
+@router.post("/bank_employee/bulk/cards")
+async def bulk_create_cards(request: Request, current_user=Depends(bank_employee_required)):
+    return await bulk_response(request, CardBulkCreate, provision_cards)
+
 @router.delete("/bank_employee/delete-account", response_model=dict)
 def delete_account(account_number: str, db: Session = Depends(get_db), current_user=Depends(bank_employee_required)):
     account = db.query(Account).filter(Account.account_number == account_number).first()
@@ -146,7 +185,8 @@ def get_user_data(
     if not user:
         raise HTTPException(status_code=404, detail="User not found")
 
-    accounts = db.query(Account).filter(Account.user_id == user.id).all()
+    accounts = db.query(Account.id, Account.account_number, Account.status,
+                        total_balance(Account.id).label("balance")).filter(Account.user_id == user.id).all()
 
     return {
         "user": {
@@ -160,7 +200,7 @@ def get_user_data(
             {
                 "id": acc.id,
                 "account_number": acc.account_number,
-                "balance": acc.balance,
+                "balance": to_major(acc.balance),
                 "status" : acc.status
             }
             for acc in accounts
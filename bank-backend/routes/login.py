@@ -1,14 +1,15 @@
-import redis
 from typing import Annotated
 from fastapi import APIRouter, Depends, HTTPException
+from fastapi.concurrency import run_in_threadpool
 from fastapi.security import OAuth2PasswordBearer, OAuth2PasswordRequestForm
-from sqlalchemy.orm import Session
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
 from src.models import User
-from src.database import get_db
-from src.auth import verify_password, create_access_token, store_token_in_redis
+from src.database import get_async_db
+from src.password_pool import password_pool, PasswordPoolSaturated
+from src.auth import create_access_token, store_token_in_redis, remove_token_from_redis
 from datetime import timedelta
 
-r = redis.Redis(host='redis', port=6379, db=0)
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="login")
 router = APIRouter()
 
@@ -16,7 +17,7 @@ ACCESS_TOKEN_EXPIRE_MINUTES = timedelta(minutes=30)
 
 
 @router.post("/login")
-def login(form_data: Annotated[OAuth2PasswordRequestForm, Depends()], db: Session = Depends(get_db)) -> dict:
+async def login(form_data: Annotated[OAuth2PasswordRequestForm, Depends()], db: AsyncSession = Depends(get_async_db)) -> dict:
     """
     Login route.
     :param form_data: data from the form
@@ -27,19 +28,38 @@ def login(form_data: Annotated[OAuth2PasswordRequestForm, Depends()], db: Sessio
     username = form_data.username
     password = form_data.password
 
+    # Usernames are numeric -- anything else cannot match
+    if not username.isdigit():
+        raise HTTPException(status_code=400, detail="Invalid credentials")
+
     # Find the user in the database
-    user = db.query(User).filter(User.username == username).first()
+    user = (await db.execute(select(User).where(User.username == int(username)))).scalars().first()
 
-    # Raise the exception if user is not found or the password is invalid
-    if not user or not verify_password(password, user.password):
+    if not user:
         raise HTTPException(status_code=400, detail="Invalid credentials")
 
+    # bcrypt is CPU-bound -- it runs in the password process pool, rejected at once when the pool is saturated
+    try:
+        valid, new_hash = await password_pool.verify_async(password, user.password)
+    except PasswordPoolSaturated:
+        raise HTTPException(status_code=503, detail="Too many login attempts, try again later",
+                            headers={"Retry-After": "1"})
+
+    # Raise the exception if the password is invalid
+    if not valid:
+        raise HTTPException(status_code=400, detail="Invalid credentials")
+
+    # The hash was made with another bcrypt cost -- store the rehashed password
+    if new_hash:
+        user.password = new_hash
+        await db.commit()
+
     # Create a new token for the user
     access_token = create_access_token(data={"sub": str(user.username), "user_id": str(user.id), "role": user.role},
                                        expires_delta=ACCESS_TOKEN_EXPIRE_MINUTES)
 
-    # Store the token in redis temporarily
-    store_token_in_redis(user.id, access_token, ACCESS_TOKEN_EXPIRE_MINUTES)
+    # Store the token in redis temporarily (sync client -- in the threadpool, off the event loop)
+    await run_in_threadpool(store_token_in_redis, user.id, access_token, ACCESS_TOKEN_EXPIRE_MINUTES)
 
     return {"access_token": access_token, "token_type": "bearer", "role": user.role}
 
@@ -52,12 +72,8 @@ def logout(user_id: int) -> dict:
     :return: information about successful logout
     """
 
-    # Get the user's token key
-    token_key = f"user:{user_id}:token"
-
-    # If the key exists in redis, delete it
-    if r.exists(token_key):
-        r.delete(token_key)
+    # If the token exists in redis, delete it (with its session registry entry)
+    if remove_token_from_redis(user_id):
         return {"message": "User logged out successfully"}
 
     # Raise the exception when token is not found
@@ -1,11 +1,22 @@
-from fastapi import APIRouter, Depends, HTTPException
+from typing import Optional
+from fastapi import APIRouter, Depends, HTTPException, Header
+from fastapi.concurrency import run_in_threadpool
+from sqlalchemy import select, update
 from sqlalchemy.orm import Session
-from src.database import get_db
+from sqlalchemy.ext.asyncio import AsyncSession
+from src.database import get_db, get_async_db
 from src.models import Transaction, Account
 from src.auth import get_current_user
+from src.aml_windows import record_transaction
+from src.balances import to_minor, total_balance
+from src.transaction_feed import publish_transaction_event, publish_transaction_event_async
+from src.idempotency import run_idempotent
+from src.partitions import queue_entry
 from pydantic import BaseModel
 
-from routes.aml import send_transaction_to_aml
+from services.transfers import accept_transfer, enqueue_settlement
+from services.aml_batch import enqueue_aml_check
+from src.config import AML_BATCH_ENABLED, SETTLEMENT_ENABLED
 from src.celery_app import celery_app, process_aml_check
 
 router = APIRouter()
@@ -18,35 +29,45 @@ class TransferRequest(BaseModel):
     amount: float
 
 @router.post("/transfer")
-def create_transfer(transfer_data: TransferRequest, db: Session = Depends(get_db),
-                    user_id: int = Depends(get_current_user)):
+async def create_transfer(transfer_data: TransferRequest, db: AsyncSession = Depends(get_async_db),
+                          user_id: int = Depends(get_current_user),
+                          idempotency_key: Optional[str] = Header(None, alias="Idempotency-Key")):
     """
     Transfer funds from one account to another
     :param transfer_data: sender id, receiver id, amount
     :param db: database session
     :param user_id: logged-in user id
+    :param idempotency_key: retries with the same key get the response of the first request (src.idempotency)
     :return: information about successful transfer
     """
 
+    return await run_idempotent(f"transfer:{user_id}", idempotency_key, transfer_data,
+                                lambda: _create_transfer(transfer_data, db, user_id))
+
+
+async def _create_transfer(transfer_data: TransferRequest, db: AsyncSession, user_id: int):
+
     sender_account = transfer_data.sender_account
     receiver_account = transfer_data.receiver_account
     amount = transfer_data.amount
 
     # Raise the exception when sender account is not the user's account
-    sender_account = db.query(Account).filter(Account.account_number == sender_account, Account.user_id == user_id).first()
-    sender_id = sender_account.id
+    sender_account = (await db.execute(select(Account.id, total_balance(Account.id).label("balance"))
+                                       .where(Account.account_number == sender_account,
+                                              Account.user_id == int(user_id)))).first()
 
     if not sender_account:
         raise HTTPException(status_code=403, detail="You can only send money from your own account.")
 
+    sender_id = sender_account.id
+
     # Check if receiver is in our database (if not, it is an external transfer)
-    receiver_account = db.query(Account).filter(Account.account_number == receiver_account).first()
-    if receiver_account:
-        receiver_id = receiver_account.id
-    else:
+    receiver_id = (await db.execute(select(Account.id).where(Account.account_number == receiver_account))).scalar()
+    if receiver_id is None:
         receiver_id = 0 # default account for external transfers
 
-    if sender_account.balance < amount:
+    # Early rejection only -- the debit itself is a conditional UPDATE at acceptance (src.balances)
+    if sender_account.balance < to_minor(amount):
         return {"status": "failure", "message": "insufficient balance"}
 
     # Create a new transaction record
@@ -55,30 +76,43 @@ def create_transfer(transfer_data: TransferRequest, db: Session = Depends(get_db
 
     # Add the record to the database
     db.add(transaction)
-    db.commit()
-    db.refresh(transaction)
-
-    celery_app.send_task("process_aml_check", args=[transaction.id, amount])    # Przeniesienie taska do workera
+    await db.commit()
+    # Sync redis and celery clients -- in the threadpool, off the event loop
+    await run_in_threadpool(record_transaction, transaction)     # Windowed AML aggregates
+    await publish_transaction_event_async(transaction.id, transaction.status, type=transaction.type, amount=amount,
+                                          from_account_id=sender_id, to_account_id=receiver_id)
+
+    if AML_BATCH_ENABLED:
+        # Micro-batched AML worker (services.aml_batch)
+        await run_in_threadpool(enqueue_aml_check, transaction.id, transaction.date)
+    else:
+        # Przeniesienie taska do workera -- z datą transakcji (odczyt tylko z jej partycji)
+        await run_in_threadpool(celery_app.send_task, "process_aml_check",
+                                args=[transaction.id, amount, transaction.date.isoformat()])
 
     return {"message": "Transaction created. AML Checking process in progress", "transaction_id": transaction.id}
 
 @router.post("/transfer/accept")
 def transfer_accept(data: dict, db: Session = Depends(get_db)):
     transaction_id = data["transaction_id"]
-    transaction = db.query(Transaction).filter(Transaction.id == transaction_id).first()
-    db.commit()
 
+    if SETTLEMENT_ENABLED:
+        # Approved only -- the settlement worker moves the money with its next batch (services.settlement)
+        tx_date = db.execute(update(Transaction).where(Transaction.id == transaction_id, Transaction.type == "transfer",
+                                                       Transaction.status.in_(["pending", "aml_approved"]))
+                             .values(status="aml_approved").returning(Transaction.date)
+                             .execution_options(synchronize_session=False)).scalar()
+        if tx_date is None:
+            raise HTTPException(status_code=404, detail="Transaction not found.")
+        db.commit()
+        enqueue_settlement(queue_entry(transaction_id, tx_date))
+        publish_transaction_event(transaction_id, "aml_approved")
+        return {"transaction_id": transaction_id, "status": "aml_approved"}
+
+    transaction = accept_transfer(db, transaction_id)
     if not transaction:
         raise HTTPException(status_code=404, detail="Transaction not found.")
 
-    sender_account = db.query(Account).filter(Account.id == transaction.from_account_id).first()
-    sender_account.balance -= transaction.amount
-    if transaction.to_account_id:
-        receiver_account=db.query(Account).filter(Account.id == transaction.to_account_id).first()
-        receiver_account.balance += transaction.amount
-
-    transaction.status = "completed"
-
     db.commit()
     db.refresh(transaction)
-    db.refresh(sender_account)
+    publish_transaction_event(transaction.id, transaction.status)
@@ -1,8 +1,15 @@
-from fastapi import APIRouter, Depends, HTTPException
-from sqlalchemy.orm import Session
-from src.database import get_db
+import base64
+import pytz
+from datetime import datetime
+from typing import Optional
+from fastapi import APIRouter, Depends, HTTPException, Query
+from sqlalchemy import select, union_all, and_, tuple_
+from sqlalchemy.orm import Session, aliased
+from sqlalchemy.ext.asyncio import AsyncSession
+from src.database import get_db, get_async_db
 from src.models import User, Account, Transaction, Card
 from src.auth import get_current_user
+from src.balances import to_major, total_balance
 from pydantic import BaseModel
 
 router = APIRouter()
@@ -15,29 +22,132 @@ def get_user_accounts(current_user: int = Depends(get_current_user), db: Session
 
 
 @router.get("/user/account/{account_id}/balance")
-def get_account_balance(account_id: int, current_user: int = Depends(get_current_user), db: Session = Depends(get_db)):
-    print(account_id)
-    account = db.query(Account).filter_by(id=account_id, user_id=current_user).first()
-    print(account)
-    if not account:
+async def get_account_balance(account_id: int, current_user: int = Depends(get_current_user),
+                              db: AsyncSession = Depends(get_async_db)):
+    balance = (await db.execute(select(total_balance(Account.id)).where(Account.id == account_id,
+                                                                        Account.user_id == int(current_user)))).first()
+    if not balance:
         raise HTTPException(status_code=404, detail="Nie znaleziono konta")
-    return {"balance": account.balance}
+    return {"balance": to_major(balance[0])}
 
 
 @router.get("/user/account/{account_id}/transactions")
-def get_account_transactions(account_id: int, current_user: User = Depends(get_current_user),
-                             db: Session = Depends(get_db)):
-    account = db.query(Account).filter_by(id=account_id, user_id=current_user).first()
-    if not account:
+async def get_account_transactions(account_id: int, current_user: User = Depends(get_current_user),
+                                   db: AsyncSession = Depends(get_async_db)):
+    if not await _is_own_account(db, account_id, current_user):
         raise HTTPException(status_code=404, detail="Account not found")
-    transactions = db.query(Transaction).filter(
-        (Transaction.from_account_id == account.id) | (Transaction.to_account_id == account.id)
-    ).all()
-
-    return [{"id": txn.id, "date": txn.date, "amount": txn.amount,
-             "receiver": db.query(Account).filter_by(id=txn.to_account_id).first().account_number,
-             "transaction_type": txn.type, "status": txn.status} for txn in
-            transactions]
+
+    # Full history (kept for the dashboard) -- counterparties resolved by the join
+    rows = (await db.execute(_history_query(account_id, [], None, None))).all()
+
+    return [_history_item(row) for row in rows]
+
+
+@router.get("/user/account/{account_id}/history")
+async def get_account_history(account_id: int,
+                        cursor: Optional[str] = Query(None),
+                        limit: int = Query(50, ge=1, le=500),
+                        date_from: Optional[datetime] = Query(None),
+                        date_to: Optional[datetime] = Query(None),
+                        amount_min: Optional[float] = Query(None),
+                        amount_max: Optional[float] = Query(None),
+                        transaction_type: Optional[str] = Query(None, enum=["deposit", "withdrawal", "transfer"]),
+                        status: Optional[str] = Query(None, enum=["pending", "completed", "failed", "cancelled",
+                                                                  "aml_processed", "aml_blocked", "aml_approved"]),
+                        current_user: int = Depends(get_current_user),
+                        db: AsyncSession = Depends(get_async_db)):
+    """
+    Account history, newest first, with keyset (cursor) pagination.
+    :param cursor: next_cursor returned with the previous page
+    :param limit: page size
+    :return: page of transactions and the cursor of the next page (None on the last page)
+    """
+
+    if not await _is_own_account(db, account_id, current_user):
+        raise HTTPException(status_code=404, detail="Account not found")
+
+    filters = []
+    if date_from:
+        filters.append(Transaction.date >= _aware(date_from))
+    if date_to:
+        filters.append(Transaction.date <= _aware(date_to))
+    if amount_min is not None:
+        filters.append(Transaction.amount >= amount_min)
+    if amount_max is not None:
+        filters.append(Transaction.amount <= amount_max)
+    if transaction_type:
+        filters.append(Transaction.type == transaction_type)
+    if status:
+        filters.append(Transaction.status == status)
+
+    # One row more than the page -- tells whether there is a next page
+    rows = (await db.execute(_history_query(account_id, filters, _decode_cursor(cursor) if cursor else None,
+                                            limit + 1))).all()
+
+    next_cursor = _encode_cursor(rows[limit - 1]) if len(rows) > limit else None
+
+    return {"items": [_history_item(row) for row in rows[:limit]], "next_cursor": next_cursor}
+
+
+async def _is_own_account(db: AsyncSession, account_id: int, user_id) -> bool:
+    account = (await db.execute(select(Account.id).where(Account.id == account_id,
+                                                         Account.user_id == int(user_id)))).first()
+    return account is not None
+
+
+def _aware(moment: datetime) -> datetime:
+    # Dates without a time zone are local (Europe/Warsaw), like the transaction dates
+    return moment if moment.tzinfo else pytz.timezone("Europe/Warsaw").localize(moment)
+
+
+def _history_query(account_id: int, filters: list, cursor, limit):
+    """
+    Query of the account history, newest first.
+    Outgoing and incoming transactions are read by two separate index range scans, (from_account_id, date, id)
+    and (to_account_id, date, id), each stopping after [limit] rows, and merged.
+    :param account_id: account id
+    :param filters: additional conditions on Transaction
+    :param cursor: (date, id) of the last row of the previous page
+    :param limit: number of rows (None -- whole history)
+    """
+
+    branches = []
+    for condition in [Transaction.from_account_id == account_id,
+                      and_(Transaction.to_account_id == account_id,
+                           Transaction.from_account_id.is_distinct_from(account_id))]:
+        branch = select(Transaction.id, Transaction.date, Transaction.amount, Transaction.type,
+                        Transaction.status, Transaction.from_account_id, Transaction.to_account_id
+                        ).where(condition, *filters)
+        if cursor:
+            branch = branch.where(tuple_(Transaction.date, Transaction.id) < tuple_(*cursor))
+        branch = branch.order_by(Transaction.date.desc(), Transaction.id.desc()).limit(limit)
+        branches.append(select(branch.subquery()))
+
+    history = union_all(*branches).subquery()
+    sender = aliased(Account)
+    receiver = aliased(Account)
+
+    return select(history, sender.account_number.label("sender"), receiver.account_number.label("receiver")
+                  ).outerjoin(sender, sender.id == history.c.from_account_id
+                  ).outerjoin(receiver, receiver.id == history.c.to_account_id
+                  ).order_by(history.c.date.desc(), history.c.id.desc()).limit(limit)
+
+
+def _history_item(row) -> dict:
+    return {"id": row.id, "date": row.date, "amount": row.amount, "sender": row.sender, "receiver": row.receiver,
+            "transaction_type": row.type, "status": row.status}
+
+
+def _encode_cursor(row) -> str:
+    return base64.urlsafe_b64encode(f"{row.date.isoformat()}|{row.id}".encode()).decode()
+
+
+def _decode_cursor(cursor: str) -> tuple:
+    try:
+        date_part, id_part = base64.urlsafe_b64decode(cursor.encode()).decode().split("|")
+        return datetime.fromisoformat(date_part), int(id_part)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
 
 
 @router.get("/user/account/{account_id}/card_id")
@@ -4,8 +4,10 @@ from src.database import get_db
 from src.models import Transaction, Account, Card, AtmDevice, User
 from pydantic import BaseModel
 from datetime import datetime
+from typing import Optional
 
-from routes.aml import is_multiple_transactions_different_locations, is_smurfing_activity
+from services.atm import verify_atm_transaction
+from src.partitions import by_ids
 
 
 # Weryfikacja transakcji ATM
@@ -13,13 +15,14 @@ router = APIRouter()
 
 class AutoVerificationModel(BaseModel):
     transaction_id: int
+    date: Optional[datetime] = None     # data transakcji -- odczyt tylko jej partycji
 
 @router.post("/verify-transaction-auto")
 def auto_verify(transaction_pending: AutoVerificationModel, db: Session = Depends(get_db)):
 
     # Sprawdzenie, czy transakcja jest w bazie
     transaction_id = transaction_pending.transaction_id
-    transaction_data = db.query(Transaction).filter(Transaction.id == transaction_id).first()
+    transaction_data = db.query(Transaction).filter(*by_ids([transaction_id], [transaction_pending.date])).first()
     if not transaction_data:
         raise HTTPException(status_code=404, detail="Nie znaleziono transakcji.")
 
@@ -27,10 +30,7 @@ def auto_verify(transaction_pending: AutoVerificationModel, db: Session = Depend
     if transaction_data.status != 'pending':
         raise HTTPException(status_code=403, detail="Transakcja nie jest oczekująca.")
 
-    # Dla kwot niższych od wybranego progu — automatyczna akceptacja
-    if (transaction_data.amount <= 20000
-            and not is_multiple_transactions_different_locations(db, transaction_data.from_account_id, transaction_data.type))\
-            and not is_smurfing_activity(db,transaction_data.from_account_id,transaction_data.type):
+    if verify_atm_transaction(db, transaction_data) == "completed":
         return {"message": "Weryfikacja zakończona pomyślnie.", "status": "completed"}
 
     # Dla kwot wyższych — przekierowanie do pracownika (weryfikacja ręczna)
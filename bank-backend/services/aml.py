@@ -0,0 +1,129 @@
+from datetime import datetime
+import redis
+import numpy as np
+from sqlalchemy.orm import Session
+from src.models import AmlToControl
+from src.partitions import update_statuses
+from src.aml_features import extract_transfer_features
+from src.config import AML_FREQUENCY_RECENT_SECONDS, AML_FREQUENCY_PAST_SECONDS, SETTLEMENT_ENABLED
+from src import aml_windows
+from services.transfers import accept_transfer
+
+## AML rules and the transfer check, called in-process by the API routes and the celery workers
+
+
+def check_transfer(db: Session, transaction_id: int, tx_date: datetime = None):
+    """
+    Run the AML check of a transfer; an approved transfer is accepted in the same database transaction.
+    The caller is responsible for committing the session.
+    :param db: database session
+    :param transaction_id: transaction id
+    :param tx_date: transaction date, when known -- only its partition is read
+    :return: new status of the transaction (aml_blocked, completed/failed for an approved transfer --
+             aml_approved with SETTLEMENT_ENABLED, the caller queues it after the commit),
+             None when the transaction does not exist
+    """
+
+    ## the transaction and its amount profile (one round trip), the windowed counts from redis
+    features = extract_transfer_features(db, transaction_id, tx_date)
+
+    if not features:
+        return None
+
+    new_status = "aml_processed"
+
+    ## checking what kind of transaction is being tested:
+    if features["type"] in ["deposit","withdrawal"]:
+        ## aml check for deposit and withdrawal is done by services.atm.verify_atm_transaction
+        pass
+
+    elif features["type"] == "transfer":
+        problems_found = evaluate_transfer_features(features)
+
+        ## behaviour due to the problems found - none --> accept, any --> aml_block
+        if problems_found:
+            new_status = "aml_blocked"
+            aml_transaction = AmlToControl(transaction_id=transaction_id, reasoning=",".join(problems_found))
+            db.add(aml_transaction)
+        else:
+            new_status = "aml_approved"
+
+    update_statuses(db, {transaction_id: new_status}, {transaction_id: features["date"]})
+
+    if new_status == "aml_approved" and not SETTLEMENT_ENABLED:
+        new_status = accept_transfer(db, transaction_id, features["date"]).status     # completed, or failed without funds
+
+    return new_status
+
+
+def is_large_transaction(amount: float, threshold: float = 10000) -> bool:
+    return amount > threshold
+
+
+
+def is_rapid_count(count: int, threshold: int = 5) -> bool:
+    return count > threshold
+
+def is_unusual_for_profile(amount: float, count: int, mean: float, m2: float, threshold: float = 3.0) -> bool:
+    ## works on single values and on numpy arrays (batch evaluation in services.aml_batch)
+    std_dev = np.sqrt(m2 / np.maximum(count, 1))
+
+    #not enough data below 5 transactions
+    #current comparison --> is the amount bigger than std_dev * threshold
+    return (count >= 5) & (amount > mean + threshold * std_dev)
+
+
+def is_unusual_for_counts(recent_count: int, past_count: int, factor_threshold: float = 2.0) -> bool:
+    past_avg = past_count / (AML_FREQUENCY_PAST_SECONDS / 86400)
+    recent_avg = recent_count / (AML_FREQUENCY_RECENT_SECONDS / 86400)
+
+    return (past_avg > 0) & (recent_avg > factor_threshold * past_avg)
+
+def evaluate_transfer_features(features: dict) -> list:
+    """
+    Run the transfer rules against the feature row from extract_transfer_features.
+    :param features: feature row
+    :return: names of the rules that flagged the transfer
+    """
+    problems_found = []
+
+    ## suspicious ammount of transferred money:
+    if is_large_transaction(features["amount"]):
+        problems_found.append("is_large_transaction")
+
+    ## too many transactions in a short term (ex. 1 min, 5 transfers)
+    if is_rapid_count(features["rapid_count"]):
+        problems_found.append("is_rapid_transactions")
+
+    # TODO: strange time of transfer <-- to be
+
+    ## analysis of user's profile --> "does the user act as usually?"
+    if is_unusual_for_profile(features["amount"], features["profile_count"], features["profile_mean"], features["profile_m2"]):
+        problems_found.append("is_unusual_amount")
+
+    if is_unusual_for_counts(features["recent_count"], features["past_count"]):
+        problems_found.append("is_unusual_frequency")
+
+    return problems_found
+
+def is_multiple_transactions_different_locations(db: Session, account_id: int, type_of_transaction: str, max_locations: int = 3) -> bool:
+    """
+    Sprawdza, czy w ostatnich X minutach (AML_LOCATIONS_WINDOW_SECONDS) wystąpiły wpłaty z różnych lokalizacji ATM.
+    """
+    try:
+        unique_location_count = aml_windows.distinct_locations(account_id, type_of_transaction)
+    except redis.RedisError:
+        unique_location_count = aml_windows.sql_distinct_locations(db, account_id, type_of_transaction)
+
+    return unique_location_count >= max_locations
+
+def is_smurfing_activity(db: Session, account_id: int, type_of_transaction: str, threshold: float = 10000.0) -> bool:
+    """
+    Wykrywa smurfing: wiele małych transakcji (do AML_SMURFING_MAX_SINGLE_AMOUNT), które łącznie przekraczają określony próg w krótkim czasie.
+    """
+    try:
+        total_amount = aml_windows.small_amount_sum(account_id, type_of_transaction)
+    except redis.RedisError:
+        total_amount = aml_windows.sql_small_amount_sum(db, account_id, type_of_transaction)
+
+    return total_amount >= threshold
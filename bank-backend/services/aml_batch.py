@@ -0,0 +1,292 @@
+import time
+from datetime import datetime, timedelta
+import numpy as np
+import pytz
+from sqlalchemy import func, insert, update
+from sqlalchemy.orm import Session
+from src.config import (AML_BATCH_SIZE, AML_BATCH_MAX_WAIT_MS, AML_BATCH_MAX_ATTEMPTS, AML_RAPID_WINDOW_SECONDS,
+                        AML_FREQUENCY_RECENT_SECONDS, AML_FREQUENCY_PAST_SECONDS, SETTLEMENT_ENABLED)
+from src.database import get_db
+from src.redis_client import r
+from src.models import Transaction, AmlToControl, AccountAmountProfile
+from src.partitions import queue_entry, parse_queue_entry, by_ids, update_statuses
+from services.aml import is_large_transaction, is_rapid_count, is_unusual_for_profile, is_unusual_for_counts
+from services.transfers import accept_transfer, enqueue_settlement
+from src.transaction_feed import publish_transaction_events
+
+## micro-batched AML check of transfers (enabled with AML_BATCH_ENABLED=true)
+## the API pushes transfers (id and date, src.partitions.queue_entry) to a redis list, the worker drains up to
+## AML_BATCH_SIZE of them
+## (waiting at most AML_BATCH_MAX_WAIT_MS for the batch to fill), loads the history of all involved
+## accounts in one query and evaluates the rules with numpy across the whole batch
+##
+## run from the bank-backend folder: python -m services.aml_batch
+
+
+QUEUE_KEY = "aml:pending-transfers"
+ATTEMPTS_KEY = "aml:pending-transfers:attempts"     # failed checks per queue entry
+DEAD_LETTER_KEY = "aml:pending-transfers:dead"      # entries that failed AML_BATCH_MAX_ATTEMPTS times
+
+# Rule names in the order of the columns of the flag matrix
+RULES = ["is_large_transaction", "is_rapid_transactions", "is_unusual_amount", "is_unusual_frequency"]
+
+
+def enqueue_aml_check(transaction_id: int, tx_date: datetime = None):
+    """
+    Queue the transfer for the batched AML check.
+    :param transaction_id: transaction id
+    :param tx_date: transaction date
+    """
+
+    r.rpush(QUEUE_KEY, queue_entry(transaction_id, tx_date))
+
+
+def drain_batch(size: int = AML_BATCH_SIZE, max_wait_ms: int = AML_BATCH_MAX_WAIT_MS, key: str = QUEUE_KEY) -> list:
+    """
+    Take up to [size] entries from the queue [key].
+    Blocks (up to a second) for the first entry, then waits at most [max_wait_ms] for the batch to fill.
+    :return: list of queue entries (src.partitions.queue_entry; empty when the queue stayed empty)
+    """
+
+    first = r.blpop(key, timeout=1)
+    if not first:
+        return []
+
+    entries = [first[1].decode()]
+    deadline = time.monotonic() + max_wait_ms / 1000
+
+    while len(entries) < size:
+        # LRANGE + LTRIM in MULTI -- atomic pop of many entries at once
+        pipe = r.pipeline()
+        pipe.lrange(key, 0, size - len(entries) - 1)
+        pipe.ltrim(key, size - len(entries), -1)
+        values, _ = pipe.execute()
+        entries.extend(value.decode() for value in values)
+
+        if not values:
+            if time.monotonic() >= deadline:
+                break
+            time.sleep(0.005)
+
+    return entries
+
+
+def _window_counts(codes: np.ndarray, hist_codes: np.ndarray, hist_offsets: np.ndarray, scale: int, starts: list) -> list:
+    """
+    For every transfer of the batch count the history entries of its account not older than each start.
+    The history is encoded as one sorted key per entry (account code * scale + time offset), so every
+    count is a pair of binary searches done for the whole batch at once.
+    :return: list of arrays, one per start
+    """
+
+    keys = np.sort(hist_codes * scale + hist_offsets)
+    ends = np.searchsorted(keys, (codes + 1) * scale, side="left")
+
+    return [ends - np.searchsorted(keys, codes * scale + start, side="left") for start in starts]
+
+
+def evaluate_batch(db: Session, entries: list) -> dict:
+    """
+    AML check of a batch of transfers -- the batched counterpart of services.aml.check_transfer.
+    The caller is responsible for committing the session.
+    :param db: database session
+    :param entries: queue entries of the transfers (src.partitions.queue_entry) or transfer ids
+    :return: dictionary transaction id -> new status (aml_blocked, completed/failed for approved transfers --
+             aml_approved with SETTLEMENT_ENABLED, the caller queues them after the commit)
+    """
+
+    now = datetime.now(pytz.timezone('Europe/Warsaw'))
+    recent_start = now - timedelta(seconds=AML_FREQUENCY_RECENT_SECONDS)
+    past_start = recent_start - timedelta(seconds=AML_FREQUENCY_PAST_SECONDS)
+
+    # Claim the pending transfers of the batch (others were already checked) -- by id and date
+    transaction_ids, dates = zip(*(parse_queue_entry(entry) for entry in entries))
+    claimed = db.execute(
+        update(Transaction)
+        .where(*by_ids(transaction_ids, dates), Transaction.status == "pending", Transaction.type == "transfer")
+        .values(status="aml_processed")
+        .returning(Transaction.id, Transaction.from_account_id, Transaction.amount, Transaction.date)
+        .execution_options(synchronize_session=False)
+    ).all()
+
+    if not claimed:
+        return {}
+    claimed_dates = {row[0]: row[3] for row in claimed}
+
+    ids = np.array([row[0] for row in claimed])
+    amounts = np.array([row[2] for row in claimed], dtype=float)
+    accounts, codes = np.unique(np.array([row[1] for row in claimed]), return_inverse=True)
+
+    # History of all the involved accounts -- one query
+    history = db.query(Transaction.from_account_id, func.extract("epoch", Transaction.date)).filter(
+        Transaction.from_account_id.in_(accounts.tolist()),
+        Transaction.date >= past_start
+    ).all()
+
+    base_ms = int(past_start.timestamp() * 1000)
+    scale = int(now.timestamp() * 1000) - base_ms + 1
+    hist_codes = np.searchsorted(accounts, np.array([row[0] for row in history], dtype=accounts.dtype))
+    hist_offsets = np.clip(np.array([float(row[1]) * 1000 for row in history], dtype=float).astype(np.int64) - base_ms,
+                           0, scale - 1)
+
+    rapid_start = int((now - timedelta(seconds=AML_RAPID_WINDOW_SECONDS)).timestamp() * 1000) - base_ms
+    recent_offset = int(recent_start.timestamp() * 1000) - base_ms
+    total_counts, recent_counts, rapid_counts = _window_counts(codes, hist_codes, hist_offsets, scale,
+                                                               [0, recent_offset, rapid_start])
+
+    # Amount profiles of the involved accounts -- one query
+    profile_count = np.zeros(len(accounts))
+    profile_mean = np.zeros(len(accounts))
+    profile_m2 = np.zeros(len(accounts))
+    for account_id, tx_count, mean_amount, m2_amount in db.query(
+            AccountAmountProfile.account_id, AccountAmountProfile.tx_count,
+            AccountAmountProfile.mean_amount, AccountAmountProfile.m2_amount
+    ).filter(AccountAmountProfile.account_id.in_(accounts.tolist())):
+        position = np.searchsorted(accounts, account_id)
+        profile_count[position], profile_mean[position], profile_m2[position] = tx_count, mean_amount, m2_amount
+
+    # The same rules as check_transfer, evaluated for the whole batch
+    flags = np.column_stack([
+        is_large_transaction(amounts),
+        is_rapid_count(rapid_counts),
+        is_unusual_for_profile(amounts, profile_count[codes], profile_mean[codes], profile_m2[codes]),
+        is_unusual_for_counts(recent_counts, total_counts - recent_counts),
+    ])
+    blocked = flags.any(axis=1)
+
+    decisions = {int(tx_id): ("aml_blocked" if is_blocked else "aml_approved") for tx_id, is_blocked in zip(ids, blocked)}
+
+    # Bulk write back: statuses and AML reasons
+    update_statuses(db, decisions, claimed_dates)
+
+    reasons = [
+        {"transaction_id": int(tx_id), "reasoning": ",".join(rule for rule, flag in zip(RULES, row) if flag)}
+        for tx_id, row, is_blocked in zip(ids, flags, blocked) if is_blocked
+    ]
+    if reasons:
+        db.execute(insert(AmlToControl), reasons)
+
+    for tx_id, status in decisions.items():
+        if status == "aml_approved" and not SETTLEMENT_ENABLED:
+            decisions[tx_id] = accept_transfer(db, tx_id, claimed_dates[tx_id]).status       # completed, or failed without funds
+
+    return decisions
+
+
+def requeue_pending(db: Session) -> int:
+    """
+    Queue the transfers still waiting for the AML check (e.g. after a worker restart).
+    :return: number of queued transfers
+    """
+
+    entries = [queue_entry(tx_id, tx_date) for tx_id, tx_date in
+               db.query(Transaction.id, Transaction.date).filter(Transaction.status == "pending",
+                                                                 Transaction.type == "transfer")]
+    if entries:
+        r.rpush(QUEUE_KEY, *entries)
+    return len(entries)
+
+
+def requeue_failed(entries: list, error: Exception):
+    """
+    Put the entries of a failed (rolled back) check back in the queue; an entry that failed
+    AML_BATCH_MAX_ATTEMPTS times goes to the dead-letter list instead (inspect it, then push it back by hand).
+    """
+
+    pipe = r.pipeline()
+    for entry in entries:
+        pipe.hincrby(ATTEMPTS_KEY, entry, 1)
+    attempts = pipe.execute()
+
+    retry = [entry for entry, count in zip(entries, attempts) if count < AML_BATCH_MAX_ATTEMPTS]
+    dead = [entry for entry, count in zip(entries, attempts) if count >= AML_BATCH_MAX_ATTEMPTS]
+    pipe = r.pipeline()
+    if retry:
+        pipe.rpush(QUEUE_KEY, *retry)
+    if dead:
+        pipe.rpush(DEAD_LETTER_KEY, *dead)
+        pipe.hdel(ATTEMPTS_KEY, *dead)
+    pipe.execute()
+
+    print(f"AML check failed, {len(retry)} transfers requeued, {len(dead)} dead-lettered: {error}")
+
+
+def check_batch(entries: list) -> dict:
+    """
+    Check and commit a batch; when it fails, the claim is rolled back and the entries are requeued.
+    A failed batch of many entries is retried one entry at a time, so a single bad entry cannot hold back the rest.
+    :return: dictionary transaction id -> new status of the committed checks
+    """
+
+    db = next(get_db())
+    try:
+        decisions = evaluate_batch(db, entries)
+        db.commit()
+        return decisions
+    except Exception as e:
+        db.rollback()
+        if len(entries) == 1:
+            try:
+                requeue_failed(entries, e)
+            except Exception as requeue_error:
+                # Still pending in the database -- requeue_pending puts it back when the worker restarts
+                print(f"Requeueing transfer {entries[0]} failed: {requeue_error}")
+            time.sleep(1)
+            return {}
+        print(f"AML batch failed, checking its transfers one by one: {e}")
+    finally:
+        db.close()
+
+    decisions = {}
+    for entry in entries:
+        decisions.update(check_batch([entry]))
+    return decisions
+
+
+def hand_over(entries: list, decisions: dict, attempts: int = 3):
+    """
+    After the commit: queue the approved transfers for the settlement and publish the decisions.
+    Never requeues into the AML queue -- the transfers are no longer pending; approved transfers that could
+    not be queued are picked up by requeue_approved when the settlement worker starts.
+    """
+
+    dates = dict(parse_queue_entry(entry) for entry in entries)
+    approved = [queue_entry(tx_id, dates.get(tx_id)) for tx_id, status in decisions.items() if status == "aml_approved"]
+
+    for attempt in range(attempts if approved else 0):
+        try:
+            enqueue_settlement(*approved)
+            break
+        except Exception as e:
+            print(f"Queueing {len(approved)} approved transfers for the settlement failed (attempt {attempt + 1}): {e}")
+            time.sleep(0.1 * 2 ** attempt)
+
+    try:
+        publish_transaction_events(decisions)
+        checked = [entry for entry in entries if parse_queue_entry(entry)[0] in decisions]
+        if checked:
+            r.hdel(ATTEMPTS_KEY, *checked)
+    except Exception as e:
+        print(f"Publishing {len(decisions)} AML decisions failed: {e}")
+
+
+def run_worker():
+    db = next(get_db())
+    try:
+        print(f"Requeued {requeue_pending(db)} pending transfers.")
+    finally:
+        db.close()
+
+    while True:
+        entries = drain_batch()
+        if not entries:
+            continue
+
+        decisions = check_batch(entries)
+        hand_over(entries, decisions)
+        print(f"AML batch: {len(entries)} queued, {len(decisions)} checked, "
+              f"{sum(status == 'aml_blocked' for status in decisions.values())} blocked")
+
+
+if __name__ == "__main__":
+    run_worker()
@@ -0,0 +1,101 @@
+from datetime import datetime
+import pytz
+from sqlalchemy import update
+from sqlalchemy.orm import Session
+from sqlalchemy.orm.attributes import set_committed_value
+from src.models import Transaction
+from src.balances import debit, credit, to_minor
+from src.aml_profile import update_amount_profile
+from src.redis_client import r
+from src.partitions import by_ids
+from services.aml import is_multiple_transactions_different_locations, is_smurfing_activity
+
+## weryfikacja i księgowanie operacji bankomatowych -- wywoływane bezpośrednio przez API i workera celery
+## po przetworzeniu worker publikuje status na kanale atm:done:{id} (redis) -- budzi oczekujące potwierdzenie
+## status zapisywany jest też (na krótko) pod kluczem o tej samej nazwie -- dla klienta, który zapyta po publikacji
+
+RESULT_CHANNEL_PATTERN = "atm:done:*"
+RESULT_TTL_SECONDS = 300
+
+
+def result_channel(transaction_id: int) -> str:
+    return f"atm:done:{transaction_id}"
+
+
+def publish_result(transaction_id: int, status: str):
+    """
+    Powiadomienie o zakończeniu przetwarzania operacji (po zatwierdzeniu zmian).
+    :param transaction_id: id transakcji
+    :param status: status po przetworzeniu
+    """
+
+    pipe = r.pipeline()
+    pipe.set(result_channel(transaction_id), status, ex=RESULT_TTL_SECONDS)
+    pipe.publish(result_channel(transaction_id), status)
+    pipe.execute()
+
+
+def verify_atm_transaction(db: Session, transaction: Transaction) -> str:
+    """
+    Automatyczna weryfikacja AML operacji bankomatowej.
+    :param db: sesja bazy danych
+    :param transaction: oczekująca transakcja
+    :return: "completed" -- akceptacja, "pending" -- wymagana weryfikacja ręczna
+    """
+
+    # Dla kwot niższych od wybranego progu — automatyczna akceptacja
+    if (transaction.amount <= 20000
+            and not is_multiple_transactions_different_locations(db, transaction.from_account_id, transaction.type))\
+            and not is_smurfing_activity(db, transaction.from_account_id, transaction.type):
+        return "completed"
+
+    # Dla kwot wyższych — przekierowanie do pracownika (weryfikacja ręczna)
+    return "pending"
+
+
+def _finish(db: Session, transaction: Transaction, status: str) -> str:
+    """
+    Zapis statusu i daty przetworzenia -- po id i dotychczasowej dacie (odczyt tylko jej partycji).
+    :return: nowy status
+    """
+
+    now = datetime.now(pytz.timezone('Europe/Warsaw'))
+    db.execute(update(Transaction).where(*by_ids([transaction.id], [transaction.date]))
+               .values(status=status, date=now).execution_options(synchronize_session=False))
+    set_committed_value(transaction, "status", status)
+    set_committed_value(transaction, "date", now)
+    return status
+
+
+def process_atm_operation(db: Session, transaction_id: int, tx_date: datetime = None):
+    """
+    Weryfikacja i zaksięgowanie wpłaty/wypłaty.
+    Zatwierdzenie zmian (commit) należy do wywołującego.
+    :param db: sesja bazy danych
+    :param transaction_id: id transakcji
+    :param tx_date: data utworzenia transakcji -- odczyt tylko partycji od jej miesiąca (None -- wszystkich)
+    :return: nowy status transakcji, None -- brak transakcji
+    """
+
+    transaction = db.query(Transaction).filter(*by_ids([transaction_id], since=tx_date)).first()
+    if not transaction:
+        return None
+
+    # Transakcja, która nie jest oczekująca, nie może zostać zweryfikowana
+    if transaction.status != 'pending':
+        return _finish(db, transaction, "failed")
+
+    # Weryfikacja AML
+    if verify_atm_transaction(db, transaction) != "completed":
+        return "pending"    # albo aml_blocked -- czeka na pracownika
+
+    # rozgraniczenie na dwie rodzaje transakcji - wplaty/wyplaty --> roznica w tym czy to from_account, czy to_account
+    # oraz czy balance na "+" czy "-" -- jedno warunkowe UPDATE (wypłata tylko przy wystarczającym saldzie)
+    if transaction.type == "withdrawal":
+        if debit(db, transaction.from_account_id, to_minor(transaction.amount)) is None:
+            return _finish(db, transaction, "failed")       # saldo zmieniło się od sprawdzenia w API
+    elif transaction.type == "deposit":
+        credit(db, transaction.to_account_id, to_minor(transaction.amount))
+
+    update_amount_profile(db, transaction.from_account_id, transaction.amount)
+    return _finish(db, transaction, "completed")
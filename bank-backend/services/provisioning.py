@@ -0,0 +1,208 @@
+import json
+from pydantic import ValidationError
+from sqlalchemy import select, or_
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.orm import Session
+from src.database import SessionLocal
+from src.models import User, Account, Card
+from src.password_pool import password_pool, pwd_context
+from src.account_numbers import allocate_account_numbers
+from src.balances import to_minor
+
+## bulk provisioning of users, accounts and cards (branch migrations)
+## the input is NDJSON -- one entity per line; lines are processed in chunks of BULK_CHUNK_SIZE:
+## uniqueness and references are checked with one query per chunk, the chunk is written with one
+## multi-row INSERT and committed (users: ON CONFLICT DO NOTHING -- a concurrent duplicate only fails its own row,
+## accounts: numbers reserved from the sequence, see src.account_numbers)
+## the result is NDJSON as well -- one result per input line: {"line", "status": "created"|"error", "id"|"detail"}
+
+BULK_CHUNK_SIZE = 1000
+
+
+def _created(line: int, **fields) -> dict:
+    return {"line": line, "status": "created", **fields}
+
+
+def _error(line: int, detail: str) -> dict:
+    return {"line": line, "status": "error", "detail": detail}
+
+
+def provision_users(db: Session, rows: list) -> list:
+    """
+    Create the users of a chunk.
+    :param rows: list of (line number, UserBulkCreate)
+    :return: results of the rows
+    """
+
+    results = []
+    accepted = []
+    usernames, emails = set(), set()
+
+    for line, row in rows:
+        if (row.password is None) == (row.password_hash is None):
+            results.append(_error(line, "Exactly one of password, password_hash is required"))
+        elif row.password_hash is not None and pwd_context.identify(row.password_hash) != "bcrypt":
+            results.append(_error(line, "password_hash is not a bcrypt hash"))
+        elif row.username in usernames or row.email in emails:
+            results.append(_error(line, "Duplicate username or email in the batch"))
+        else:
+            usernames.add(row.username)
+            emails.add(row.email)
+            accepted.append((line, row))
+
+    # Plain passwords are hashed in the password process pool, all the workers at once -- before the first query,
+    # so that the connection does not sit idle in an open transaction while hashing (rows of existing users
+    # are hashed too, duplicates are rare in a migration)
+    plain = [(line, row.password) for line, row in accepted if row.password is not None]
+    hashes = dict(zip((line for line, _ in plain), password_pool.hash_many([password for _, password in plain])))
+
+    # Users already in the database -- one query for the whole chunk
+    existing = db.execute(select(User.username, User.email)
+                          .where(or_(User.username.in_(usernames), User.email.in_(emails)))).all()
+    taken_usernames = {username for username, _ in existing}
+    taken_emails = {email for _, email in existing}
+
+    new_rows = []
+    for line, row in accepted:
+        if row.username in taken_usernames or row.email in taken_emails:
+            results.append(_error(line, "User already exists"))
+        else:
+            new_rows.append((line, row))
+
+    values = [{"first_name": row.first_name, "last_name": row.last_name, "email": row.email,
+               "username": row.username, "password": row.password_hash or hashes[line], "role": "user"}
+              for line, row in new_rows]
+
+    inserted = {}
+    if values:
+        inserted = {username: user_id for user_id, username in db.execute(
+            insert(User).on_conflict_do_nothing().returning(User.id, User.username), values)}
+
+    for line, row in new_rows:
+        if row.username in inserted:
+            results.append(_created(line, id=inserted[row.username], username=row.username))
+        else:
+            results.append(_error(line, "User already exists"))     # inserted concurrently
+
+    return results
+
+
+def provision_accounts(db: Session, rows: list) -> list:
+    """
+    Create the accounts of a chunk; the owner is given by user_id or username.
+    :param rows: list of (line number, AccountBulkCreate)
+    :return: results of the rows
+    """
+
+    results = []
+
+    # Owners -- one query per kind of reference
+    user_ids = {row.user_id for _, row in rows if row.user_id is not None}
+    usernames = {row.username for _, row in rows if row.user_id is None and row.username is not None}
+    known_ids = set(db.scalars(select(User.id).where(User.id.in_(user_ids)))) if user_ids else set()
+    ids_by_username = dict(db.execute(select(User.username, User.id).where(User.username.in_(usernames)))
+                           .all()) if usernames else {}
+
+    pending = []
+    for line, row in rows:
+        user_id = row.user_id if row.user_id is not None else ids_by_username.get(row.username)
+        if row.user_id is None and row.username is None:
+            results.append(_error(line, "user_id or username is required"))
+        elif user_id is None or (row.user_id is not None and user_id not in known_ids):
+            results.append(_error(line, "User not found"))
+        else:
+            pending.append((line, {"user_id": user_id, "balance": to_minor(row.initial_balance),
+                                    "status": "active"}))
+
+    # Account numbers reserved from the sequence for the whole chunk -- unique without probing
+    for (_, values), account_number in zip(pending, allocate_account_numbers(db, len(pending))):
+        values["account_number"] = account_number
+
+    if pending:
+        account_ids = db.scalars(insert(Account).returning(Account.id, sort_by_parameter_order=True),
+                                 [values for _, values in pending]).all()
+        results.extend(_created(line, id=account_id, account_number=values["account_number"])
+                       for (line, values), account_id in zip(pending, account_ids))
+
+    return results
+
+
+def provision_cards(db: Session, rows: list) -> list:
+    """
+    Create the cards of a chunk; the account is given by account_id or account_number.
+    :param rows: list of (line number, CardBulkCreate)
+    :return: results of the rows
+    """
+
+    results = []
+
+    account_ids = {row.account_id for _, row in rows if row.account_id is not None}
+    numbers = {row.account_number for _, row in rows if row.account_id is None and row.account_number is not None}
+    known_ids = set(db.scalars(select(Account.id).where(Account.id.in_(account_ids)))) if account_ids else set()
+    ids_by_number = dict(db.execute(select(Account.account_number, Account.id)
+                                    .where(Account.account_number.in_(numbers))).all()) if numbers else {}
+
+    pending = []
+    for line, row in rows:
+        account_id = row.account_id if row.account_id is not None else ids_by_number.get(row.account_number)
+        if not row.pin_code.isdigit():
+            results.append(_error(line, "PIN must consist of 4 digits"))
+        elif row.account_id is None and row.account_number is None:
+            results.append(_error(line, "account_id or account_number is required"))
+        elif account_id is None or (row.account_id is not None and account_id not in known_ids):
+            results.append(_error(line, "Account not found"))
+        else:
+            pending.append((line, {"account_id": account_id, "pin": row.pin_code}))
+
+    if pending:
+        card_ids = db.scalars(insert(Card).returning(Card.id, sort_by_parameter_order=True),
+                              [values for _, values in pending]).all()
+        results.extend(_created(line, id=card_id) for (line, _), card_id in zip(pending, card_ids))
+
+    return results
+
+
+def _parse(body: bytes, model):
+    for line, text in enumerate(body.decode().splitlines(), start=1):
+        if not text.strip():
+            continue
+        try:
+            yield line, model.model_validate(json.loads(text)), None
+        except (ValueError, ValidationError) as e:
+            yield line, None, str(e)
+
+
+def _provision_chunk(db: Session, provision, chunk: list) -> str:
+    try:
+        results = provision(db, chunk)
+        db.commit()
+    except Exception as e:
+        db.rollback()
+        results = [_error(line, f"Chunk failed: {e}") for line, _ in chunk]
+
+    return "".join(json.dumps(result) + "\n" for result in sorted(results, key=lambda result: result["line"]))
+
+
+def stream_provisioning(body: bytes, model, provision):
+    """
+    Validate the NDJSON lines with [model] and provision them in chunks, yielding the NDJSON results.
+    The session is created here -- it has to live as long as the response stream.
+    """
+
+    db = SessionLocal()
+    try:
+        chunk = []
+        for line, row, error in _parse(body, model):
+            if error:
+                yield json.dumps(_error(line, error)) + "\n"
+                continue
+
+            chunk.append((line, row))
+            if len(chunk) >= BULK_CHUNK_SIZE:
+                yield _provision_chunk(db, provision, chunk)
+                chunk = []
+
+        if chunk:
+            yield _provision_chunk(db, provision, chunk)
+    finally:
+        db.close()
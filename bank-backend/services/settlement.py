@@ -0,0 +1,161 @@
+import time
+from collections import defaultdict
+from sqlalchemy import select, text
+from sqlalchemy.orm import Session
+from src.config import SETTLEMENT_BATCH_SIZE, SETTLEMENT_MAX_WAIT_MS
+from src.database import get_db
+from src.redis_client import r
+from src.models import Transaction, Account
+from src.aml_profile import update_amount_profile
+from src.balances import to_minor, debit, credit
+from src.balance_shards import shard_count
+from src.transaction_feed import publish_transaction_events
+from src.partitions import queue_entry, parse_queue_entry, by_ids, update_statuses
+from services.transfers import SETTLEMENT_QUEUE_KEY
+from services.aml_batch import drain_batch
+
+## group-commit settlement of approved transfers (enabled with SETTLEMENT_ENABLED=true)
+## the AML check and /transfer/accept queue approved transfers (services.transfers.enqueue_settlement),
+## the worker drains up to SETTLEMENT_BATCH_SIZE of them (waiting at most SETTLEMENT_MAX_WAIT_MS)
+## and settles the whole batch in one database transaction -- one commit (one fsync) per batch:
+##   - the transfers are claimed with FOR UPDATE SKIP LOCKED (a second worker takes the others),
+##     by id and date (the queue entries carry the date, src.partitions.queue_entry) -- one partition each
+##   - the involved account rows are locked in the order of their ids (like src.balances.transfer_funds)
+##   - the transfers are decided one by one in the order of their ids against the running balances,
+##     so every transfer keeps its own outcome (completed, or failed without funds) exactly as if
+##     they were accepted sequentially
+##   - the balances get one UPDATE with the net delta per account, the statuses one bulk UPDATE
+## accounts with sharded balances (src.balance_shards) are not locked with the others -- senders are debited
+## with src.balances.debit inside the batch, receivers get one credit per batch
+##
+## run from the bank-backend folder: python -m services.settlement
+
+
+# Net balance changes of a batch -- one statement for all the accounts
+APPLY_DELTAS_SQL = """
+UPDATE accounts a SET balance = a.balance + d.delta
+FROM unnest(CAST(:account_ids AS integer[]), CAST(:deltas AS bigint[])) AS d(account_id, delta)
+WHERE a.id = d.account_id
+"""
+
+
+def settle_batch(db: Session, entries: list) -> dict:
+    """
+    Settle a batch of approved transfers -- the batched counterpart of services.transfers.accept_transfer.
+    The caller is responsible for committing the session.
+    :param db: database session
+    :param entries: queue entries of the transfers (src.partitions.queue_entry) or transfer ids
+    :return: dictionary transaction id -> new status (completed, failed without funds)
+    """
+
+    # Claim the approved transfers of the batch (others were already settled or are being settled)
+    transaction_ids, dates = zip(*(parse_queue_entry(entry) for entry in entries))
+    claimed = db.execute(
+        select(Transaction.id, Transaction.from_account_id, Transaction.to_account_id, Transaction.amount,
+               Transaction.date)
+        .where(*by_ids(transaction_ids, dates), Transaction.status == "aml_approved",
+               Transaction.type == "transfer")
+        .order_by(Transaction.id)
+        .with_for_update(skip_locked=True)
+    ).all()
+
+    if not claimed:
+        return {}
+
+    # The involved accounts, locked in the order of their ids -- no deadlock with single transfers
+    # Sharded accounts (src.balance_shards) are not locked here: their writes lock the shard rows first and
+    # the account row after them (like the consolidation), locking the account row first could deadlock
+    account_ids = sorted({row.from_account_id for row in claimed} | {row.to_account_id for row in claimed if row.to_account_id})
+    sharded = {account_id for account_id in account_ids if shard_count(db, account_id)}
+    available = dict(db.execute(select(Account.id, Account.balance)
+                                .where(Account.id.in_([i for i in account_ids if i not in sharded]))
+                                .order_by(Account.id).with_for_update()).all())
+
+    outcomes = {}
+    deltas = defaultdict(int)
+    sharded_credits = defaultdict(int)
+    for tx_id, from_account_id, to_account_id, amount, _ in claimed:
+        amount_minor = to_minor(amount)
+
+        if from_account_id in sharded:
+            completed = debit(db, from_account_id, amount_minor) is not None
+        elif available.get(from_account_id, -1) >= amount_minor:
+            completed = True
+            available[from_account_id] -= amount_minor
+            deltas[from_account_id] -= amount_minor
+        else:
+            completed = False
+
+        if completed:
+            if to_account_id in sharded:
+                sharded_credits[to_account_id] += amount_minor
+            elif to_account_id in available:
+                available[to_account_id] += amount_minor
+                deltas[to_account_id] += amount_minor
+
+        outcomes[tx_id] = "completed" if completed else "failed"
+        if completed:
+            update_amount_profile(db, from_account_id, amount)
+
+    # One credit per sharded receiver (one shard row each), in the order of the account ids
+    for account_id in sorted(sharded_credits):
+        credit(db, account_id, sharded_credits[account_id])
+
+    # Bulk write back: net balance deltas and statuses
+    changed = {account_id: delta for account_id, delta in deltas.items() if delta}
+    if changed:
+        db.execute(text(APPLY_DELTAS_SQL), {"account_ids": list(changed), "deltas": list(changed.values())})
+
+    update_statuses(db, outcomes, {row.id: row.date for row in claimed})
+
+    return outcomes
+
+
+def requeue_approved(db: Session) -> int:
+    """
+    Queue the approved transfers still waiting for the settlement (e.g. after a worker restart).
+    :return: number of queued transfers
+    """
+
+    entries = [queue_entry(tx_id, tx_date) for tx_id, tx_date in
+               db.query(Transaction.id, Transaction.date).filter(Transaction.status == "aml_approved",
+                                                                 Transaction.type == "transfer")]
+    if entries:
+        r.rpush(SETTLEMENT_QUEUE_KEY, *entries)
+    return len(entries)
+
+
+def run_worker():
+    db = next(get_db())
+    try:
+        print(f"Requeued {requeue_approved(db)} approved transfers.")
+    finally:
+        db.close()
+
+    while True:
+        entries = drain_batch(SETTLEMENT_BATCH_SIZE, SETTLEMENT_MAX_WAIT_MS, key=SETTLEMENT_QUEUE_KEY)
+        if not entries:
+            continue
+
+        db = next(get_db())
+        try:
+            start = time.perf_counter()
+            outcomes = settle_batch(db, entries)
+            settled = time.perf_counter()
+            db.commit()
+            committed = time.perf_counter()
+            publish_transaction_events(outcomes)
+            print(f"Settlement batch: {len(entries)} queued, {len(outcomes)} settled, "
+                  f"{sum(status == 'failed' for status in outcomes.values())} failed, "
+                  f"{(settled - start) * 1000:.1f} ms + commit {(committed - settled) * 1000:.1f} ms")
+        except Exception as e:
+            db.rollback()
+            r.rpush(SETTLEMENT_QUEUE_KEY, *entries)      # nothing was settled -- try again with the next batch
+            print(f"Settlement batch failed, transfers requeued: {e}")
+            time.sleep(1)
+        finally:
+            db.close()
+
+
+if __name__ == "__main__":
+    run_worker()
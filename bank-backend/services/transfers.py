@@ -0,0 +1,64 @@
+from datetime import datetime
+from sqlalchemy import update
+from sqlalchemy.orm import Session
+from sqlalchemy.orm.attributes import set_committed_value
+from src.models import Transaction
+from src.redis_client import r
+from src.balances import transfer_funds, to_minor
+from src.aml_profile import update_amount_profile
+from src.partitions import by_ids, update_statuses
+
+## acceptance of transfers, called in-process by the API routes and the AML check
+## with SETTLEMENT_ENABLED=true approved transfers are not accepted one by one -- they stay aml_approved
+## and are queued (after the commit) for the group-commit settlement worker (services.settlement)
+## the queue entries carry the transfer's date (src.partitions.queue_entry)
+
+SETTLEMENT_QUEUE_KEY = "settlement:approved-transfers"
+ACCEPTABLE_STATUSES = ("pending", "aml_approved", "aml_blocked")
+
+
+def accept_transfer(db: Session, transaction_id: int, tx_date: datetime = None):
+    """
+    Move the money between the accounts and mark the transfer as completed
+    (failed, when the sender's balance no longer covers it).
+    The transfer is claimed first -- a repeated or concurrent acceptance finds it already completed and moves nothing.
+    The caller is responsible for committing the session.
+    :param db: database session
+    :param transaction_id: transaction id
+    :param tx_date: transaction date, when known -- only its partition is read
+    :return: the accepted transaction, None when it does not exist or was already accepted or rejected
+    """
+
+    # Claim: the row lock serializes concurrent acceptances, the loser sees a status outside ACCEPTABLE_STATUSES
+    claimed = db.execute(update(Transaction).where(*by_ids([transaction_id], [tx_date]), Transaction.type == "transfer",
+                                                   Transaction.status.in_(ACCEPTABLE_STATUSES))
+                         .values(status="completed")
+                         .returning(Transaction.date, Transaction.from_account_id, Transaction.to_account_id,
+                                    Transaction.amount)
+                         .execution_options(synchronize_session=False)).first()
+    if claimed is None:
+        return None
+
+    # Conditional UPDATEs -- no overdraft and no lost update under concurrent transfers
+    if transfer_funds(db, claimed.from_account_id, claimed.to_account_id, to_minor(claimed.amount)):
+        status = "completed"
+        update_amount_profile(db, claimed.from_account_id, claimed.amount)
+    else:
+        status = "failed"
+        # By id and date -- a flush of the ORM object would look the row up by the id alone
+        update_statuses(db, {transaction_id: status}, {transaction_id: claimed.date})
+
+    transaction = db.query(Transaction).filter(*by_ids([transaction_id], [claimed.date])).first()
+    set_committed_value(transaction, "status", status)
+
+    return transaction
+
+
+def enqueue_settlement(*entries: str):
+    """
+    Queue approved (committed) transfers for the settlement worker.
+    :param entries: queue entries of the transfers (src.partitions.queue_entry)
+    """
+
+    if entries:
+        r.rpush(SETTLEMENT_QUEUE_KEY, *entries)
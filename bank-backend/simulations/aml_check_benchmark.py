@@ -0,0 +1,86 @@
+import sys
+import time
+from datetime import datetime, timedelta
+import pytz
+from sqlalchemy import event
+from src.database import engine, SessionLocal
+from src.models import Transaction
+from src.aml_features import extract_transfer_features
+
+## porównanie liczby zapytań i czasu sprawdzenia AML jednego przelewu: przed (osobne zapytania) i po (jeden wiersz cech)
+## uruchomienie z folderu bank-backend: python -m simulations.aml_check_benchmark <transaction_id> [iterations]
+## każda iteracja jest wycofywana (rollback), więc baza nie zmienia się
+
+statements = 0
+
+
+def count_statement(conn, cursor, statement, parameters, context, executemany):
+    global statements
+    statements += 1
+
+
+def legacy_check(db, transaction_id: int):
+    # Kształt zapytań sprzed wprowadzenia extract_transfer_features
+    now = datetime.now(pytz.timezone('Europe/Warsaw'))
+
+    transaction = db.query(Transaction).filter(Transaction.id == transaction_id).first()
+    transaction.status = "aml_processed"
+    db.flush()
+
+    account_id = transaction.from_account_id
+    db.query(Transaction).filter(Transaction.from_account_id == account_id,
+                                 Transaction.date >= now - timedelta(minutes=1)).count()
+    db.query(Transaction).filter(Transaction.from_account_id == account_id, Transaction.amount > 0).all()
+    db.query(Transaction).filter(Transaction.from_account_id == account_id,
+                                 Transaction.date >= now - timedelta(days=7)).count()
+    db.query(Transaction).filter(Transaction.from_account_id == account_id,
+                                 Transaction.date >= now - timedelta(days=37),
+                                 Transaction.date < now - timedelta(days=7)).all()
+
+    transaction.status = "aml_approved"
+    db.flush()
+
+
+def feature_check(db, transaction_id: int):
+    extract_transfer_features(db, transaction_id)
+    db.query(Transaction).filter(Transaction.id == transaction_id).update({"status": "aml_approved"},
+                                                                          synchronize_session=False)
+
+
+def run(check, transaction_id: int, iterations: int):
+    global statements
+    statements = 0
+    latencies = []
+
+    for _ in range(iterations):
+        db = SessionLocal()
+        try:
+            start = time.perf_counter()
+            check(db, transaction_id)
+            latencies.append(time.perf_counter() - start)
+        finally:
+            db.rollback()
+            db.close()
+
+    latencies.sort()
+    return {
+        "queries": statements / iterations,
+        "mean_ms": 1000 * sum(latencies) / len(latencies),
+        "p99_ms": 1000 * latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))],
+    }
+
+
+def main():
+    transaction_id = int(sys.argv[1])
+    iterations = int(sys.argv[2]) if len(sys.argv) > 2 else 200
+
+    event.listen(engine, "before_cursor_execute", count_statement)
+
+    for name, check in [("before", legacy_check), ("after", feature_check)]:
+        result = run(check, transaction_id, iterations)
+        print(f"{name:>6}: {result['queries']:.1f} queries/transfer, "
+              f"mean {result['mean_ms']:.2f} ms, p99 {result['p99_ms']:.2f} ms")
+
+
+if __name__ == "__main__":
+    main()
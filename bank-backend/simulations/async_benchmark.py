@@ -0,0 +1,75 @@
+import asyncio
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from sqlalchemy import select
+from src.database import SessionLocal, AsyncSessionLocal
+from src.models import Account
+
+## porównanie ścieżki synchronicznej (sesja w puli wątków, jak trasy "def" w FastAPI) i asynchronicznej (AsyncSession)
+## każde "żądanie" to odczyt salda konta, jak w /user/account/{id}/balance
+## uruchomienie z folderu bank-backend: python -m simulations.async_benchmark <account_id> [requests] [concurrency]
+
+THREADPOOL_SIZE = 40    # domyślny limit puli wątków FastAPI/anyio
+
+
+def sync_request(account_id: int):
+    db = SessionLocal()
+    try:
+        db.execute(select(Account.balance).where(Account.id == account_id)).first()
+    finally:
+        db.close()
+
+
+async def async_request(account_id: int):
+    async with AsyncSessionLocal() as db:
+        await db.execute(select(Account.balance).where(Account.id == account_id))
+
+
+def report(name: str, latencies: list, elapsed: float):
+    latencies.sort()
+    p99 = latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))]
+    print(f"{name:>5}: {len(latencies) / elapsed:8.1f} req/s, p99 {1000 * p99:8.2f} ms")
+
+
+def run_sync(account_id: int, requests: int, concurrency: int):
+    # Żądania trafiają do kolejki puli wątków -- opóźnienie liczone od zgłoszenia, jak dla klienta HTTP
+    latencies = []
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=min(concurrency, THREADPOOL_SIZE)) as pool:
+        submitted = []
+        for _ in range(requests):
+            submitted.append((time.perf_counter(), pool.submit(sync_request, account_id)))
+        for submitted_at, future in submitted:
+            future.result()
+            latencies.append(time.perf_counter() - submitted_at)
+    report("sync", latencies, time.perf_counter() - start)
+
+
+async def run_async(account_id: int, requests: int, concurrency: int):
+    latencies = []
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def timed():
+        submitted_at = time.perf_counter()
+        async with semaphore:
+            await async_request(account_id)
+        latencies.append(time.perf_counter() - submitted_at)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(timed() for _ in range(requests)))
+    report("async", latencies, time.perf_counter() - start)
+
+
+def main():
+    account_id = int(sys.argv[1])
+    requests = int(sys.argv[2]) if len(sys.argv) > 2 else 5000
+    concurrency = int(sys.argv[3]) if len(sys.argv) > 3 else 500
+
+    print(f"{requests} requests, concurrency {concurrency}")
+    run_sync(account_id, requests, concurrency)
+    asyncio.run(run_async(account_id, requests, concurrency))
+
+
+if __name__ == "__main__":
+    main()
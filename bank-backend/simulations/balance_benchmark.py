@@ -0,0 +1,96 @@
+import random
+import sys
+import threading
+import time
+from sqlalchemy import select, func, delete, insert
+from src.database import SessionLocal
+from src.models import Account
+from src.account_numbers import allocate_account_numbers
+from src.balances import transfer_funds
+
+## przelewy współbieżne między kilkoma kontami -- stara ścieżka (odczyt salda do pythona, zmiana, zapis)
+## i warunkowe UPDATE (src.balances); po każdym przebiegu sprawdzane są anomalie:
+## suma sald musi się zgadzać (brak utraconych aktualizacji), żadne saldo nie może być ujemne (brak debetu)
+## uruchomienie z folderu bank-backend: python -m simulations.balance_benchmark [accounts] [threads] [seconds]
+
+INITIAL_BALANCE = 10000     # grosze
+
+
+def naive_transfer(db, from_id: int, to_id: int, amount: int) -> bool:
+    sender = db.get(Account, from_id)
+    if sender.balance < amount:
+        return False
+    receiver = db.get(Account, to_id)
+    sender.balance -= amount
+    receiver.balance += amount
+    return True
+
+
+def run(name: str, transfer, account_ids: list, threads: int, seconds: float):
+    # Salda początkowe
+    db = SessionLocal()
+    db.query(Account).filter(Account.id.in_(account_ids)).update({"balance": INITIAL_BALANCE}, synchronize_session=False)
+    db.commit()
+    db.close()
+
+    counters = {"completed": 0, "rejected": 0, "errors": 0}
+    counters_lock = threading.Lock()
+    deadline = time.perf_counter() + seconds
+
+    def worker():
+        db = SessionLocal()
+        while time.perf_counter() < deadline:
+            from_id, to_id = random.sample(account_ids, 2)
+            try:
+                result = "completed" if transfer(db, from_id, to_id, random.randint(1, 5000)) else "rejected"
+                db.commit()
+            except Exception:
+                db.rollback()
+                result = "errors"
+            with counters_lock:
+                counters[result] += 1
+        db.close()
+
+    start = time.perf_counter()
+    workers = [threading.Thread(target=worker) for _ in range(threads)]
+    for thread in workers:
+        thread.start()
+    for thread in workers:
+        thread.join()
+    elapsed = time.perf_counter() - start
+
+    db = SessionLocal()
+    total, negative = db.execute(select(func.sum(Account.balance), func.count().filter(Account.balance < 0))
+                                 .where(Account.id.in_(account_ids))).one()
+    db.close()
+
+    anomalies = abs(total - INITIAL_BALANCE * len(account_ids)) + negative
+    print(f"{name:>6}: {counters['completed'] / elapsed:8.1f} transfers/s, {counters['rejected']} rejected, "
+          f"{counters['errors']} errors, balance drift {total - INITIAL_BALANCE * len(account_ids)}, "
+          f"{negative} negative balances -> {'OK' if not anomalies else 'ANOMALIES'}")
+
+
+def main():
+    accounts = int(sys.argv[1]) if len(sys.argv) > 1 else 10
+    threads = int(sys.argv[2]) if len(sys.argv) > 2 else 32
+    seconds = float(sys.argv[3]) if len(sys.argv) > 3 else 10
+
+    # Konta testowe (bez właściciela), usuwane po pomiarze
+    db = SessionLocal()
+    account_ids = db.scalars(insert(Account).returning(Account.id, sort_by_parameter_order=True),
+                             [{"account_number": number, "balance": INITIAL_BALANCE, "status": "active"}
+                              for number in allocate_account_numbers(db, accounts)]).all()
+    db.commit()
+
+    try:
+        print(f"{accounts} accounts, {threads} threads, {seconds} s")
+        run("naive", naive_transfer, account_ids, threads, seconds)
+        run("atomic", transfer_funds, account_ids, threads, seconds)
+    finally:
+        db.execute(delete(Account).where(Account.id.in_(account_ids)))
+        db.commit()
+        db.close()
+
+
+if __name__ == "__main__":
+    main()
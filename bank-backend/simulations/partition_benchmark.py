@@ -0,0 +1,110 @@
+import random
+import sys
+import time
+import numpy as np
+from sqlalchemy import text
+from src.database import engine
+
+## zapytanie okna AML (ostatnia godzina konta, jak src.aml_windows.sql_rapid_count) na rosnącej historii:
+## tabela bez partycji vs tabela partycjonowana po miesiącach (jak transactions, src.partitions)
+## w każdej rundzie dochodzi miesiąc starszej historii -- czas zapytania na tabeli partycjonowanej
+## nie powinien rosnąć (czytana jest tylko bieżąca partycja), na tabeli bez partycji rośnie głębokość indeksu
+## ścieżka po id (kolejki workerów AML i rozliczeń): tabela bez partycji po samym id, tabela partycjonowana
+## po samym id (sprawdzany indeks każdej partycji -- czas rośnie z liczbą miesięcy) oraz po id i dacie
+## (src.partitions.queue_entry -- czytana jest jedna partycja)
+## tabele robocze bench_tx_* są tworzone i usuwane przez skrypt
+## uruchomienie z folderu bank-backend: python -m simulations.partition_benchmark [months] [rows per month] [queries]
+
+ACCOUNTS = 10000
+
+SETUP_SQL = [
+    "DROP TABLE IF EXISTS bench_tx_flat, bench_tx_part",
+    """CREATE TABLE bench_tx_flat (id BIGSERIAL PRIMARY KEY, from_account_id INTEGER, amount FLOAT,
+                                   date TIMESTAMPTZ NOT NULL)""",
+    "CREATE INDEX ON bench_tx_flat (from_account_id, date, id)",
+    """CREATE TABLE bench_tx_part (id BIGSERIAL, from_account_id INTEGER, amount FLOAT, date TIMESTAMPTZ NOT NULL,
+                                   PRIMARY KEY (id, date))
+       PARTITION BY RANGE (date)""",
+    "CREATE INDEX ON bench_tx_part (from_account_id, date, id)",
+]
+
+# One month of history, [offset] months back (offset 0 -- the current month up to now)
+INSERT_SQL = """
+INSERT INTO {table} (from_account_id, amount, date)
+SELECT (random() * :accounts)::int, random() * 1000,
+       LEAST(NOW(), DATE_TRUNC('month', NOW()) - make_interval(months => :offset) + random() * INTERVAL '1 month')
+FROM generate_series(1, :rows)
+"""
+
+WINDOW_SQL = ("SELECT COUNT(*) FROM {table} WHERE from_account_id = :account_id "
+              "AND date >= NOW() - INTERVAL '1 hour' AND date < NOW()")
+
+# Lookups of one transaction -- by the id alone and by the id and the date
+BY_ID_SQL = "SELECT amount FROM {table} WHERE id = :id"
+BY_ID_DATE_SQL = "SELECT amount FROM {table} WHERE id = :id AND date = :date"
+
+
+def add_month(connection, offset: int, rows: int):
+    connection.execute(text(f"""
+        CREATE TABLE bench_tx_part_{offset} PARTITION OF bench_tx_part
+        FOR VALUES FROM (DATE_TRUNC('month', NOW()) - make_interval(months => {offset}))
+                     TO (DATE_TRUNC('month', NOW()) - make_interval(months => {offset - 1}))
+    """))
+    for table in ("bench_tx_flat", "bench_tx_part"):
+        connection.execute(text(INSERT_SQL.format(table=table)), {"accounts": ACCOUNTS, "offset": offset, "rows": rows})
+        connection.execute(text(f"ANALYZE {table}"))
+
+
+def measure(connection, sql: str, params: list) -> np.ndarray:
+    timings = []
+    statement = text(sql)
+    for values in params:
+        start = time.perf_counter()
+        connection.execute(statement, values).scalar()
+        timings.append(time.perf_counter() - start)
+    return np.array(timings) * 1000
+
+
+def sample_transactions(connection, table: str, total: int, queries: int) -> list:
+    # Losowe istniejące wiersze wraz z datami (to zapytanie nie jest mierzone)
+    ids = [random.randint(1, total) for _ in range(queries)]
+    rows = connection.execute(text(f"SELECT id, date FROM {table} WHERE id = ANY(:ids)"), {"ids": ids}).all()
+    return [{"id": row.id, "date": row.date} for row in rows]
+
+
+def main():
+    months = int(sys.argv[1]) if len(sys.argv) > 1 else 12
+    rows = int(sys.argv[2]) if len(sys.argv) > 2 else 500000
+    queries = int(sys.argv[3]) if len(sys.argv) > 3 else 2000
+
+    with engine.connect().execution_options(isolation_level="AUTOCOMMIT") as connection:
+        for statement in SETUP_SQL:
+            connection.execute(text(statement))
+
+        try:
+            print(f"{rows} rows per month, {queries} queries per measurement")
+            print(f"{'history':>12} {'window flat p50/p99':>20} {'window part p50/p99':>20} "
+                  f"{'id flat p50':>12} {'id part p50':>12} {'id+date part p50':>17}  (ms)")
+            for offset in range(months):
+                add_month(connection, offset, rows)
+                accounts = [{"account_id": random.randint(0, ACCOUNTS)} for _ in range(queries)]
+                flat = measure(connection, WINDOW_SQL.format(table="bench_tx_flat"), accounts)
+                part = measure(connection, WINDOW_SQL.format(table="bench_tx_part"), accounts)
+
+                total = rows * (offset + 1)
+                flat_rows = sample_transactions(connection, "bench_tx_flat", total, queries)
+                part_rows = sample_transactions(connection, "bench_tx_part", total, queries)
+                id_flat = measure(connection, BY_ID_SQL.format(table="bench_tx_flat"), flat_rows)
+                id_part = measure(connection, BY_ID_SQL.format(table="bench_tx_part"), part_rows)
+                id_date_part = measure(connection, BY_ID_DATE_SQL.format(table="bench_tx_part"), part_rows)
+
+                print(f"{total:>12} {np.percentile(flat, 50):9.3f} / {np.percentile(flat, 99):8.3f} "
+                      f"{np.percentile(part, 50):9.3f} / {np.percentile(part, 99):8.3f} "
+                      f"{np.percentile(id_flat, 50):12.3f} {np.percentile(id_part, 50):12.3f} "
+                      f"{np.percentile(id_date_part, 50):17.3f}")
+        finally:
+            connection.execute(text("DROP TABLE IF EXISTS bench_tx_flat, bench_tx_part"))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,50 @@
+import asyncio
+import os
+import sys
+import time
+from src.config import BCRYPT_ROUNDS
+from src.password_pool import PasswordPool, pwd_context
+
+## przepustowość logowania (weryfikacja bcrypt) w zależności od rozmiaru puli procesów
+## każde "logowanie" to jedna weryfikacja hasła w puli, jak w /login
+## uruchomienie z folderu bank-backend: python -m simulations.password_benchmark [logins] [pool sizes, np. 1,2,4,8]
+
+PASSWORD = "benchmark-password"
+
+
+async def run(size: int, logins: int, hashed: str):
+    pool = PasswordPool(size=size, queue_limit=logins)     # bez odrzucania -- mierzona jest sama przepustowość
+    await pool.verify_async(PASSWORD, hashed)               # uruchomienie procesów poza pomiarem
+
+    latencies = []
+
+    async def login():
+        submitted_at = time.perf_counter()
+        valid, _ = await pool.verify_async(PASSWORD, hashed)
+        assert valid
+        latencies.append(time.perf_counter() - submitted_at)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(login() for _ in range(logins)))
+    elapsed = time.perf_counter() - start
+    pool.shutdown()
+
+    latencies.sort()
+    p99 = latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))]
+    print(f"pool {size:>3}: {logins / elapsed:8.1f} logins/s, p99 {1000 * p99:8.1f} ms")
+
+
+def main():
+    logins = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    cpus = os.cpu_count() or 1
+    sizes = [int(size) for size in sys.argv[2].split(",")] if len(sys.argv) > 2 else \
+        sorted({1, 2, 4, cpus} & set(range(1, cpus + 1)))
+
+    hashed = pwd_context.hash(PASSWORD)
+    print(f"{logins} logins, bcrypt cost {BCRYPT_ROUNDS}, {cpus} CPUs")
+    for size in sizes:
+        asyncio.run(run(size, logins, hashed))
+
+
+if __name__ == "__main__":
+    main()
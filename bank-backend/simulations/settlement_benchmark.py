@@ -0,0 +1,92 @@
+import random
+import sys
+import time
+import numpy as np
+from sqlalchemy import select, func, delete, insert
+from src.database import SessionLocal
+from src.models import Account, Transaction, AccountAmountProfile
+from src.account_numbers import allocate_account_numbers
+from services.transfers import accept_transfer
+from services.settlement import settle_batch
+
+## rozliczanie zaakceptowanych przelewów -- pojedynczo (accept_transfer + commit na przelew)
+## i w partiach (services.settlement.settle_batch + jeden commit na partię) dla kilku rozmiarów partii
+## raportowane: rozliczone przelewy/s, czas commitu partii (średni, p99) i zgodność sumy sald
+## uruchomienie z folderu bank-backend: python -m simulations.settlement_benchmark [accounts] [transfers]
+
+BATCH_SIZES = (10, 100, 500, 1000)
+INITIAL_BALANCE = 100000    # grosze
+
+
+def create_transfers(account_ids: list, count: int) -> list:
+    db = SessionLocal()
+    db.query(Account).filter(Account.id.in_(account_ids)).update({"balance": INITIAL_BALANCE}, synchronize_session=False)
+    transaction_ids = db.scalars(insert(Transaction).returning(Transaction.id, sort_by_parameter_order=True), [
+        {"from_account_id": from_id, "to_account_id": to_id, "amount": random.randint(1, 500),
+         "type": "transfer", "status": "aml_approved"}
+        for from_id, to_id in (random.sample(account_ids, 2) for _ in range(count))
+    ]).all()
+    db.commit()
+    db.close()
+    return transaction_ids
+
+
+def run(name: str, settle, account_ids: list, transfers: int, batch_size: int):
+    transaction_ids = create_transfers(account_ids, transfers)
+
+    commit_times = []
+    completed = 0
+    db = SessionLocal()
+    start = time.perf_counter()
+    for i in range(0, len(transaction_ids), batch_size):
+        outcomes = settle(db, transaction_ids[i:i + batch_size])
+        before_commit = time.perf_counter()
+        db.commit()
+        commit_times.append(time.perf_counter() - before_commit)
+        completed += sum(status == "completed" for status in outcomes.values())
+    elapsed = time.perf_counter() - start
+
+    total, negative = db.execute(select(func.sum(Account.balance), func.count().filter(Account.balance < 0))
+                                 .where(Account.id.in_(account_ids))).one()
+    db.execute(delete(Transaction).where(Transaction.id.in_(transaction_ids)))
+    db.commit()
+    db.close()
+
+    commit_ms = np.array(commit_times) * 1000
+    drift = total - INITIAL_BALANCE * len(account_ids)
+    print(f"{name:>12}: {transfers / elapsed:8.1f} settled/s, {completed} completed, "
+          f"commit {commit_ms.mean():.2f} ms avg / {np.percentile(commit_ms, 99):.2f} ms p99, "
+          f"balance drift {drift}, {negative} negative balances -> {'OK' if not drift and not negative else 'ANOMALIES'}")
+
+
+def settle_one_by_one(db, transaction_ids: list) -> dict:
+    # Ścieżka /transfer/accept -- partia zawsze jednoelementowa
+    transaction = accept_transfer(db, transaction_ids[0])
+    return {transaction.id: transaction.status}
+
+
+def main():
+    accounts = int(sys.argv[1]) if len(sys.argv) > 1 else 100
+    transfers = int(sys.argv[2]) if len(sys.argv) > 2 else 5000
+
+    # Konta testowe (bez właściciela), usuwane po pomiarze
+    db = SessionLocal()
+    account_ids = db.scalars(insert(Account).returning(Account.id, sort_by_parameter_order=True),
+                             [{"account_number": number, "balance": INITIAL_BALANCE, "status": "active"}
+                              for number in allocate_account_numbers(db, accounts)]).all()
+    db.commit()
+
+    try:
+        print(f"{accounts} accounts, {transfers} transfers")
+        run("single", settle_one_by_one, account_ids, transfers, 1)
+        for batch_size in BATCH_SIZES:
+            run(f"batch {batch_size}", settle_batch, account_ids, transfers, batch_size)
+    finally:
+        db.execute(delete(AccountAmountProfile).where(AccountAmountProfile.account_id.in_(account_ids)))
+        db.execute(delete(Account).where(Account.id.in_(account_ids)))
+        db.commit()
+        db.close()
+
+
+if __name__ == "__main__":
+    main()
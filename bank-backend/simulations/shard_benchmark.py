@@ -0,0 +1,94 @@
+import random
+import sys
+import threading
+import time
+from sqlalchemy import select, delete, insert
+from src.database import SessionLocal
+from src.models import Account
+from src.account_numbers import allocate_account_numbers
+from src.balances import transfer_funds, total_balance
+from src.balance_shards import enable_sharding, disable_sharding, consolidate
+
+## przelewy współbieżne z wielu kont na jedno "gorące" konto (np. konto rozliczeniowe przelewów zewnętrznych)
+## przy różnej liczbie shardów salda (src.balance_shards; 1 -- konto bez shardów, jeden wiersz)
+## po każdym przebiegu sprawdzane jest, czy suma sald się zgadza (shardy + wiersz konta, przed i po konsolidacji)
+## uruchomienie z folderu bank-backend: python -m simulations.shard_benchmark [threads] [seconds]
+
+SHARD_COUNTS = (1, 2, 4, 8, 16)
+INITIAL_BALANCE = 10 ** 9   # grosze -- nadawcy nigdy nie kończą się środki
+
+
+def run(shards: int, hot_id: int, sender_ids: list, threads: int, seconds: float):
+    db = SessionLocal()
+    if shards > 1:
+        enable_sharding(db, hot_id, shards)
+    db.commit()
+    expected = db.scalar(select(total_balance(hot_id)).where(Account.id == hot_id))
+    db.close()
+
+    counters = {"completed": 0, "errors": 0, "amount": 0}
+    counters_lock = threading.Lock()
+    deadline = time.perf_counter() + seconds
+
+    def worker(sender_id: int):
+        db = SessionLocal()
+        while time.perf_counter() < deadline:
+            amount = random.randint(1, 5000)
+            try:
+                transfer_funds(db, sender_id, hot_id, amount)
+                db.commit()
+                result = "completed"
+            except Exception:
+                db.rollback()
+                result, amount = "errors", 0
+            with counters_lock:
+                counters[result] += 1
+                counters["amount"] += amount
+        db.close()
+
+    start = time.perf_counter()
+    workers = [threading.Thread(target=worker, args=(sender_ids[i % len(sender_ids)],)) for i in range(threads)]
+    for thread in workers:
+        thread.start()
+    for thread in workers:
+        thread.join()
+    elapsed = time.perf_counter() - start
+
+    db = SessionLocal()
+    total = db.scalar(select(total_balance(hot_id)).where(Account.id == hot_id))
+    consolidate(db, hot_id)
+    db.commit()
+    consolidated = db.scalar(select(Account.balance).where(Account.id == hot_id))
+    disable_sharding(db, hot_id)
+    db.commit()
+    db.close()
+
+    drift = total - expected - counters["amount"]
+    print(f"{shards:>3} shards: {counters['completed'] / elapsed:8.1f} transfers/s, {counters['errors']} errors, "
+          f"balance drift {drift} -> {'OK' if not drift and consolidated == total else 'ANOMALIES'}")
+
+
+def main():
+    threads = int(sys.argv[1]) if len(sys.argv) > 1 else 32
+    seconds = float(sys.argv[2]) if len(sys.argv) > 2 else 10
+
+    # Konta testowe (bez właściciela): gorące konto i po jednym nadawcy na wątek, usuwane po pomiarze
+    db = SessionLocal()
+    account_ids = db.scalars(insert(Account).returning(Account.id, sort_by_parameter_order=True),
+                             [{"account_number": number, "balance": INITIAL_BALANCE, "status": "active"}
+                              for number in allocate_account_numbers(db, threads + 1)]).all()
+    db.commit()
+    hot_id, sender_ids = account_ids[0], account_ids[1:]
+
+    try:
+        print(f"{threads} threads, {seconds} s")
+        for shards in SHARD_COUNTS:
+            run(shards, hot_id, sender_ids, threads, seconds)
+    finally:
+        db.execute(delete(Account).where(Account.id.in_(account_ids)))
+        db.commit()
+        db.close()
+
+
+if __name__ == "__main__":
+    main()
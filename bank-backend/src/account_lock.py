@@ -0,0 +1,164 @@
+import asyncio
+import threading
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+from src.config import ACCOUNT_LOCK_TTL_MS, ACCOUNT_LOCK_TIMEOUT, ACCOUNT_LOCK_METRICS_SIZE
+from src.pool_metrics import PoolMetrics
+from src.redis_client import async_r, blocking_r
+
+## account lock of ATM sessions
+## lock-account-{id}            -- holder's fencing token, expires after ACCOUNT_LOCK_TTL_MS
+## lock-account-{id}:fence      -- counter of issued fencing tokens (strictly increasing per account)
+## lock-account-{id}:handoff    -- list waiters block on (BLPOP); the release pushes one wake-up to it
+## a waiter is woken as soon as the lock is released -- no fixed retry interval; if the holder dies without
+## releasing, waiters retry when its lock expires
+## fencing: the protected write stores the token on the account row and is conditional on it
+## (accounts.lock_token < :token), so a holder whose lock expired cannot overwrite the write of a later holder
+
+
+# Take the lock if free: new fencing token, otherwise the time (ms) the current lock has left
+_ACQUIRE = async_r.register_script("""
+if redis.call('exists', KEYS[1]) == 0 then
+    local token = redis.call('incr', KEYS[2])
+    redis.call('set', KEYS[1], token, 'PX', ARGV[1])
+    return {1, token}
+end
+return {0, redis.call('pttl', KEYS[1])}
+""")
+
+# Release only by the holder; wake up one waiter (at most one pending wake-up is kept)
+_RELEASE = async_r.register_script("""
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    redis.call('del', KEYS[1])
+    if redis.call('llen', KEYS[2]) == 0 then
+        redis.call('rpush', KEYS[2], ARGV[1])
+    end
+    redis.call('pexpire', KEYS[2], ARGV[2])
+    return 1
+end
+return 0
+""")
+
+
+class LockMetrics(PoolMetrics):
+    """
+    Acquisition counters of a single account lock: acquisitions, contended acquisitions (had to wait),
+    timeouts and a histogram of the wait time.
+    """
+
+    def snapshot(self) -> dict:
+        metrics = super().snapshot()
+        return {
+            "acquisitions": metrics["checkouts"],
+            "contended": metrics["waits"],
+            "timeouts": metrics["timeouts"],
+            "wait_latency": metrics["checkout_latency"],
+        }
+
+
+# Most recently locked accounts last -- the least recently locked one is dropped past ACCOUNT_LOCK_METRICS_SIZE
+_metrics = OrderedDict()
+_metrics_lock = threading.Lock()
+
+
+def _account_metrics(account_id: int) -> LockMetrics:
+    with _metrics_lock:
+        if account_id in _metrics:
+            _metrics.move_to_end(account_id)
+        else:
+            if len(_metrics) >= ACCOUNT_LOCK_METRICS_SIZE:
+                _metrics.popitem(last=False)
+            _metrics[account_id] = LockMetrics()
+        return _metrics[account_id]
+
+
+def _keys(account_id: int) -> tuple:
+    lock_key = f"lock-account-{account_id}"
+    return lock_key, f"{lock_key}:fence", f"{lock_key}:handoff"
+
+
+async def acquire_account_lock(account_id: int, timeout: float = ACCOUNT_LOCK_TIMEOUT,
+                               ttl_ms: int = ACCOUNT_LOCK_TTL_MS):
+    """
+    Take the account lock, waiting at most [timeout] seconds.
+    :param account_id: account id
+    :param timeout: how long to wait, in seconds
+    :param ttl_ms: lock lifetime, in milliseconds
+    :return: fencing token, None on timeout
+    """
+
+    lock_key, fence_key, handoff_key = _keys(account_id)
+    loop = asyncio.get_running_loop()
+    start = loop.time()
+    deadline = start + timeout
+    contended = False
+
+    while True:
+        acquired, value = await _ACQUIRE(keys=[lock_key, fence_key], args=[ttl_ms])
+        if acquired:
+            _account_metrics(account_id).record(loop.time() - start, contended)
+            return int(value)
+
+        contended = True
+        remaining = deadline - loop.time()
+        if remaining <= 0:
+            _account_metrics(account_id).record(loop.time() - start, contended, timed_out=True)
+            return None
+
+        # Wait for the release, but not longer than the current lock lives (the holder may be gone)
+        wait = min(remaining, value / 1000) if value > 0 else remaining
+        await blocking_r.blpop([handoff_key], timeout=max(wait, 0.01))
+
+
+async def release_account_lock(account_id: int, token: int, ttl_ms: int = ACCOUNT_LOCK_TTL_MS) -> bool:
+    """
+    Release the account lock and wake up the next waiter.
+    :param token: fencing token returned by acquire_account_lock
+    :return: False when the lock was no longer held with this token (expired)
+    """
+
+    lock_key, _, handoff_key = _keys(account_id)
+    return bool(await _RELEASE(keys=[lock_key, handoff_key], args=[token, ttl_ms]))
+
+
+# Raise the token counter to at least ARGV[1]
+_ADVANCE_FENCE = async_r.register_script("""
+if tonumber(redis.call('get', KEYS[1]) or '0') < tonumber(ARGV[1]) then
+    redis.call('set', KEYS[1], ARGV[1])
+end
+return 1
+""")
+
+
+async def advance_fence(account_id: int, token: int):
+    """
+    Raise the account's token counter to [token] -- after a write was fenced off by a token stored in the database
+    (e.g. redis lost the counter), so the next acquisitions get tokens the database accepts.
+    """
+
+    _, fence_key, _ = _keys(account_id)
+    await _ADVANCE_FENCE(keys=[fence_key], args=[token])
+
+
+@asynccontextmanager
+async def account_lock(account_id: int, timeout: float = ACCOUNT_LOCK_TIMEOUT):
+    """
+    async with account_lock(account_id) as token: ... -- token is None when the lock was not acquired in time.
+    """
+
+    token = await acquire_account_lock(account_id, timeout)
+    try:
+        yield token
+    finally:
+        if token is not None:
+            await release_account_lock(account_id, token)
+
+
+def lock_stats() -> dict:
+    """
+    Lock metrics of the accounts most recently locked by this process (at most ACCOUNT_LOCK_METRICS_SIZE).
+    """
+
+    with _metrics_lock:
+        accounts = list(_metrics.items())
+    return {account_id: metrics.snapshot() for account_id, metrics in accounts}
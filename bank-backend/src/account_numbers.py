@@ -0,0 +1,51 @@
+from sqlalchemy import select, func
+from sqlalchemy.orm import Session
+from src.config import BANK_SORT_CODE
+from src.models import account_number_seq
+
+## NRB account numbers: 2 check digits + 8-digit sort code of the bank + 16-digit customer number
+## customer numbers come from a database sequence -- never handed out twice, also to concurrent
+## transactions, so no uniqueness probe is needed; a batch of numbers is reserved in one round trip
+## check digits as in IBAN (ISO 7064 mod 97-10): the number with "PL00" moved to the end is 1 mod 97
+
+# "PL" as digits (P = 25, L = 21)
+COUNTRY_DIGITS = "2521"
+
+
+def check_digits(bban: str) -> str:
+    """
+    Check digits of the account number.
+    :param bban: sort code + customer number (24 digits)
+    :return: two check digits
+    """
+
+    return f"{98 - int(bban + COUNTRY_DIGITS + '00') % 97:02d}"
+
+
+def is_valid_account_number(account_number: str) -> bool:
+    """
+    Whether the account number has 26 digits and correct check digits.
+    """
+
+    return (len(account_number) == 26 and account_number.isdigit()
+            and int(account_number[2:] + COUNTRY_DIGITS + account_number[:2]) % 97 == 1)
+
+
+def format_account_number(customer_number: int, sort_code: str = BANK_SORT_CODE) -> str:
+    bban = f"{sort_code}{customer_number:016d}"
+    return check_digits(bban) + bban
+
+
+def allocate_account_numbers(db: Session, count: int) -> list:
+    """
+    Reserve [count] new account numbers.
+    :param db: database session
+    :param count: number of account numbers
+    :return: list of account numbers
+    """
+
+    if count <= 0:
+        return []
+
+    values = db.scalars(select(account_number_seq.next_value()).select_from(func.generate_series(1, count))).all()
+    return [format_account_number(value) for value in values]
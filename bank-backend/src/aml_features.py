@@ -0,0 +1,64 @@
+from datetime import datetime
+import redis
+from sqlalchemy import text
+from sqlalchemy.orm import Session
+from src import aml_windows
+
+## feature row of a transfer under AML check -- everything the transfer rules need:
+## the transaction itself (marked as aml_processed) and its account's amount profile in one SQL round trip,
+## the windowed counts (rapid and frequency rules) from the redis windows of src.aml_windows --
+## the SQL counterparts are used only when redis is unavailable
+## with the transaction's date known, the update reads only its partition (src.partitions)
+
+TRANSFER_FEATURES_QUERY = text("""
+    WITH tx AS (
+        UPDATE transactions SET status = 'aml_processed'
+        WHERE id = :transaction_id AND (CAST(:tx_date AS timestamptz) IS NULL OR date = :tx_date)
+        RETURNING id, date, from_account_id, amount, type
+    )
+    SELECT tx.id, tx.date, tx.from_account_id, tx.amount, tx.type,
+           COALESCE(p.tx_count, 0) AS profile_count,
+           COALESCE(p.mean_amount, 0) AS profile_mean,
+           COALESCE(p.m2_amount, 0) AS profile_m2
+    FROM tx
+    LEFT JOIN account_amount_profiles p ON p.account_id = tx.from_account_id
+""")
+
+
+def window_counts(db: Session, account_id: int) -> dict:
+    """
+    Windowed counts of the account's outgoing transactions, from redis (SQL when redis is unavailable).
+    :return: dictionary rapid_count, recent_count, past_count
+    """
+
+    try:
+        rapid_count = aml_windows.rapid_count(account_id)
+        recent_count, past_count = aml_windows.frequency_counts(account_id)
+    except redis.RedisError:
+        rapid_count = aml_windows.sql_rapid_count(db, account_id)
+        recent_count, past_count = aml_windows.sql_frequency_counts(db, account_id)
+
+    return {"rapid_count": rapid_count, "recent_count": recent_count, "past_count": past_count}
+
+
+def extract_transfer_features(db: Session, transaction_id: int, tx_date: datetime = None):
+    """
+    Mark the transaction as aml_processed and collect its AML features.
+    The status change is part of the session's transaction -- commit before handing the transfer over.
+    :param db: database session
+    :param transaction_id: transaction id
+    :param tx_date: transaction date, when known
+    :return: dictionary with the features, None when the transaction does not exist
+    """
+
+    row = db.execute(TRANSFER_FEATURES_QUERY, {"transaction_id": transaction_id, "tx_date": tx_date}).mappings().first()
+    if not row:
+        return None
+
+    features = dict(row)
+    if features["from_account_id"] is not None:
+        features.update(window_counts(db, features["from_account_id"]))
+    else:
+        features.update(rapid_count=0, recent_count=0, past_count=0)
+
+    return features
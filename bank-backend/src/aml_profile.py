@@ -0,0 +1,127 @@
+from datetime import datetime
+import pytz
+from sqlalchemy import text
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.orm import Session
+from src.database import get_db
+from src.models import AccountAmountProfile
+
+## running statistics of the outgoing amounts per account, used by the AML "unusual amount" rule
+## the profile is updated with Welford's method, so the check is a single-row lookup
+
+
+def update_amount_profile(db: Session, account_id: int, amount: float):
+    """
+    Fold a completed transaction into the account's amount profile.
+    The update is a single upsert evaluated by the database, so concurrent completions do not lose updates.
+    The caller is responsible for committing the session.
+    :param db: database session
+    :param account_id: id of the account the money was sent from
+    :param amount: transaction amount
+    """
+
+    if account_id is None or amount <= 0:
+        return
+
+    now = datetime.now(pytz.timezone('Europe/Warsaw'))
+
+    # Welford's update -- the right-hand side always refers to the values before the update
+    new_count = AccountAmountProfile.tx_count + 1
+    delta = amount - AccountAmountProfile.mean_amount
+    new_mean = AccountAmountProfile.mean_amount + delta / new_count
+
+    stmt = insert(AccountAmountProfile).values(
+        account_id=account_id, tx_count=1, mean_amount=amount, m2_amount=0.0, updated_at=now
+    )
+    stmt = stmt.on_conflict_do_update(
+        index_elements=[AccountAmountProfile.account_id],
+        set_={
+            "tx_count": new_count,
+            "mean_amount": new_mean,
+            "m2_amount": AccountAmountProfile.m2_amount + delta * (amount - new_mean),
+            "updated_at": now,
+        },
+    )
+    db.execute(stmt)
+
+
+def get_amount_profile(db: Session, account_id: int):
+    """
+    Get the amount profile of the account.
+    :param db: database session
+    :param account_id: account id
+    :return: AccountAmountProfile or None, when the account has no completed transactions yet
+    """
+
+    return db.get(AccountAmountProfile, account_id)
+
+
+# Profiles rebuilt from the completed transactions (existing profiles are overwritten)
+BACKFILL_SQL = """
+INSERT INTO account_amount_profiles (account_id, tx_count, mean_amount, m2_amount, updated_at)
+SELECT from_account_id, COUNT(*), AVG(amount), COALESCE(VAR_POP(amount), 0) * COUNT(*), NOW()
+FROM transactions
+WHERE status = 'completed' AND amount > 0 AND from_account_id IS NOT NULL
+GROUP BY from_account_id
+ON CONFLICT (account_id) DO UPDATE SET
+    tx_count = EXCLUDED.tx_count,
+    mean_amount = EXCLUDED.mean_amount,
+    m2_amount = EXCLUDED.m2_amount,
+    updated_at = EXCLUDED.updated_at
+"""
+
+
+def backfill_amount_profiles(db: Session) -> int:
+    """
+    Build the amount profiles from the existing transactions table.
+    Existing profiles are overwritten, so the command can be rerun at any time (preferably when no
+    transactions are being completed, otherwise they may be counted twice).
+    :param db: database session
+    :return: number of profiles written
+    """
+
+    result = db.execute(text(BACKFILL_SQL))
+    db.commit()
+
+    return result.rowcount
+
+
+## migration, version 7 of src.migrations -- the table, filled from the history when it is new
+
+def create_amount_profiles(connection) -> bool:
+    """
+    Create the amount profiles table and build the profiles, unless the table exists.
+    :param connection: database connection (inside a transaction)
+    :return: False -- already created
+    """
+
+    if connection.execute(text("SELECT to_regclass('account_amount_profiles')")).scalar():
+        return False
+
+    connection.execute(text("""
+        CREATE TABLE account_amount_profiles (
+            account_id INTEGER PRIMARY KEY REFERENCES accounts (id),
+            tx_count INTEGER NOT NULL,
+            mean_amount DOUBLE PRECISION NOT NULL,
+            m2_amount DOUBLE PRECISION NOT NULL,
+            updated_at TIMESTAMPTZ
+        )
+    """))
+    connection.execute(text(BACKFILL_SQL))
+    return True
+
+
+## backfill command
+## run from the bank-backend folder: python -m src.aml_profile
+
+def main():
+    db = next(get_db())
+    try:
+        count = backfill_amount_profiles(db)
+        print(f"Backfilled {count} account amount profiles.")
+    finally:
+        db.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,297 @@
+import time
+from datetime import datetime
+import pytz
+import redis
+from sqlalchemy import func
+from sqlalchemy.orm import Session
+from src.config import (AML_RAPID_WINDOW_SECONDS, AML_RAPID_BUCKET_SECONDS,
+                        AML_FREQUENCY_RECENT_SECONDS, AML_FREQUENCY_PAST_SECONDS, AML_FREQUENCY_BUCKET_SECONDS,
+                        AML_SMURFING_WINDOW_SECONDS, AML_SMURFING_BUCKET_SECONDS, AML_SMURFING_MAX_SINGLE_AMOUNT,
+                        AML_LOCATIONS_WINDOW_SECONDS, AML_LOCATIONS_BUCKET_SECONDS)
+from src.database import get_db
+from src.redis_client import r
+from src.models import Transaction, AtmDevice
+
+## windowed aggregates for the AML rules, kept in redis in time buckets per account
+## every rule sums a fixed number of buckets, so the check does not depend on the account history
+##
+## aml:win:{bucket}:{account_id}:{index}               hash: count, small_sum:{type}
+## aml:loc:{bucket}:{account_id}:{type}:{index}        set of ATM localizations
+##
+## windows are rounded out to whole buckets (the oldest bucket may be partial), so the store
+## can only overcount -- the rules stay on the safe side
+
+
+ATM_TYPES = ["withdrawal", "deposit"]
+
+# Rule windows: (window length, bucket size) in seconds
+RULE_WINDOWS = {
+    "rapid": (AML_RAPID_WINDOW_SECONDS, AML_RAPID_BUCKET_SECONDS),
+    "frequency": (AML_FREQUENCY_RECENT_SECONDS + AML_FREQUENCY_PAST_SECONDS, AML_FREQUENCY_BUCKET_SECONDS),
+    "smurfing": (AML_SMURFING_WINDOW_SECONDS, AML_SMURFING_BUCKET_SECONDS),
+    "locations": (AML_LOCATIONS_WINDOW_SECONDS, AML_LOCATIONS_BUCKET_SECONDS),
+}
+
+
+def _bucket_ttl(bucket: int) -> int:
+    # Keep a bucket as long as the longest window that reads it
+    return max(window for window, size in RULE_WINDOWS.values() if size == bucket) + bucket
+
+
+def _window_key(bucket: int, account_id: int, index: int) -> str:
+    return f"aml:win:{bucket}:{account_id}:{index}"
+
+
+def _location_key(bucket: int, account_id: int, type_of_transaction: str, index: int) -> str:
+    return f"aml:loc:{bucket}:{account_id}:{type_of_transaction}:{index}"
+
+
+def _indices(rule: str, now: float) -> range:
+    """
+    Bucket indices covering the rule window that ends now.
+    :param rule: rule name (key of RULE_WINDOWS)
+    :param now: current unix time
+    :return: range of bucket indices
+    """
+
+    window, bucket = RULE_WINDOWS[rule]
+    return range(int((now - window) // bucket), int(now // bucket) + 1)
+
+
+def _frequency_indices(now: float) -> tuple:
+    """
+    Bucket indices of the recent period and of the period preceding it.
+    :param now: current unix time
+    :return: (recent indices, past indices)
+    """
+
+    bucket = AML_FREQUENCY_BUCKET_SECONDS
+    boundary = int((now - AML_FREQUENCY_RECENT_SECONDS) // bucket)
+    start = int((now - AML_FREQUENCY_RECENT_SECONDS - AML_FREQUENCY_PAST_SECONDS) // bucket)
+    return range(boundary, int(now // bucket) + 1), range(start, boundary)
+
+
+def _span(indices: range, bucket: int) -> tuple:
+    """
+    Time range covered by the buckets, used by the SQL counterparts of the store.
+    :return: (start, end) as aware datetimes, end exclusive
+    """
+
+    start = datetime.fromtimestamp(indices.start * bucket, tz=pytz.utc)
+    end = datetime.fromtimestamp(indices.stop * bucket, tz=pytz.utc)
+    return start, end
+
+
+def record_transaction(transaction: Transaction, localization: str = None, timestamp: float = None):
+    """
+    Add a newly written transaction to the windowed aggregates.
+    Failures are only logged -- the rules fall back to SQL when redis is unavailable.
+    :param transaction: the transaction, already committed
+    :param localization: localization of the ATM, for ATM operations
+    :param timestamp: unix time of the transaction (defaults to now)
+    """
+
+    account_id = transaction.from_account_id
+    if account_id is None:
+        return
+
+    now = timestamp if timestamp is not None else time.time()
+    pipe = r.pipeline(transaction=False)
+
+    # Counts of all outgoing transactions (rapid and frequency rules, once per bucket size)
+    for bucket in {AML_RAPID_BUCKET_SECONDS, AML_FREQUENCY_BUCKET_SECONDS}:
+        key = _window_key(bucket, account_id, int(now // bucket))
+        pipe.hincrby(key, "count", 1)
+        pipe.expire(key, _bucket_ttl(bucket))
+
+    # Sum of the small amounts per type (smurfing rule)
+    if transaction.amount <= AML_SMURFING_MAX_SINGLE_AMOUNT:
+        bucket = AML_SMURFING_BUCKET_SECONDS
+        key = _window_key(bucket, account_id, int(now // bucket))
+        pipe.hincrbyfloat(key, f"small_sum:{transaction.type}", transaction.amount)
+        pipe.expire(key, _bucket_ttl(bucket))
+
+    # Distinct ATM localizations per type (locations rule)
+    if localization is not None:
+        bucket = AML_LOCATIONS_BUCKET_SECONDS
+        key = _location_key(bucket, account_id, transaction.type, int(now // bucket))
+        pipe.sadd(key, localization)
+        pipe.expire(key, _bucket_ttl(bucket))
+
+    try:
+        pipe.execute()
+    except redis.RedisError as e:
+        print(f"Failed to record transaction {transaction.id} in AML windows: {e}")
+
+
+def _sum_field(bucket: int, account_id: int, field: str, indices: range) -> float:
+    # One round trip for all the buckets of the window
+    pipe = r.pipeline(transaction=False)
+    for index in indices:
+        pipe.hget(_window_key(bucket, account_id, index), field)
+    return sum(float(value) for value in pipe.execute() if value is not None)
+
+
+def rapid_count(account_id: int, now: float = None) -> int:
+    """
+    Number of outgoing transactions in the rapid-transactions window.
+    """
+
+    now = now if now is not None else time.time()
+    return int(_sum_field(AML_RAPID_BUCKET_SECONDS, account_id, "count", _indices("rapid", now)))
+
+
+def frequency_counts(account_id: int, now: float = None) -> tuple:
+    """
+    Number of outgoing transactions in the recent period and in the period preceding it.
+    :return: (recent count, past count)
+    """
+
+    now = now if now is not None else time.time()
+    recent, past = _frequency_indices(now)
+    bucket = AML_FREQUENCY_BUCKET_SECONDS
+
+    pipe = r.pipeline(transaction=False)
+    for index in range(past.start, recent.stop):
+        pipe.hget(_window_key(bucket, account_id, index), "count")
+    values = [int(value) if value is not None else 0 for value in pipe.execute()]
+
+    return sum(values[len(past):]), sum(values[:len(past)])
+
+
+def small_amount_sum(account_id: int, type_of_transaction: str, now: float = None) -> float:
+    """
+    Sum of the transactions not larger than AML_SMURFING_MAX_SINGLE_AMOUNT in the smurfing window.
+    """
+
+    now = now if now is not None else time.time()
+    return _sum_field(AML_SMURFING_BUCKET_SECONDS, account_id, f"small_sum:{type_of_transaction}",
+                      _indices("smurfing", now))
+
+
+def distinct_locations(account_id: int, type_of_transaction: str, now: float = None) -> int:
+    """
+    Number of distinct ATM localizations used in the locations window.
+    """
+
+    now = now if now is not None else time.time()
+    bucket = AML_LOCATIONS_BUCKET_SECONDS
+    keys = [_location_key(bucket, account_id, type_of_transaction, index) for index in _indices("locations", now)]
+    return len(r.sunion(keys))
+
+
+#################### SQL counterparts -- fallback when redis is unavailable and the consistency checker
+
+def sql_rapid_count(db: Session, account_id: int, now: float = None) -> int:
+    now = now if now is not None else time.time()
+    start, end = _span(_indices("rapid", now), AML_RAPID_BUCKET_SECONDS)
+
+    return db.query(func.count(Transaction.id)).filter(
+        Transaction.from_account_id == account_id,
+        Transaction.date >= start,
+        Transaction.date < end
+    ).scalar()
+
+
+def sql_frequency_counts(db: Session, account_id: int, now: float = None) -> tuple:
+    now = now if now is not None else time.time()
+    recent, past = _frequency_indices(now)
+    recent_start, end = _span(recent, AML_FREQUENCY_BUCKET_SECONDS)
+    past_start, _ = _span(past, AML_FREQUENCY_BUCKET_SECONDS)
+
+    recent_count, past_count = db.query(
+        func.count(Transaction.id).filter(Transaction.date >= recent_start),
+        func.count(Transaction.id).filter(Transaction.date < recent_start),
+    ).filter(
+        Transaction.from_account_id == account_id,
+        Transaction.date >= past_start,
+        Transaction.date < end
+    ).one()
+
+    return recent_count, past_count
+
+
+def sql_small_amount_sum(db: Session, account_id: int, type_of_transaction: str, now: float = None) -> float:
+    now = now if now is not None else time.time()
+    start, end = _span(_indices("smurfing", now), AML_SMURFING_BUCKET_SECONDS)
+
+    total = db.query(func.sum(Transaction.amount)).filter(
+        Transaction.from_account_id == account_id,
+        Transaction.date >= start,
+        Transaction.date < end,
+        Transaction.amount <= AML_SMURFING_MAX_SINGLE_AMOUNT,
+        Transaction.type == type_of_transaction
+    ).scalar()
+
+    return total or 0.0
+
+
+def sql_distinct_locations(db: Session, account_id: int, type_of_transaction: str, now: float = None) -> int:
+    now = now if now is not None else time.time()
+    start, end = _span(_indices("locations", now), AML_LOCATIONS_BUCKET_SECONDS)
+
+    return db.query(func.count(func.distinct(AtmDevice.localization))).join(
+        Transaction, Transaction.device_id == AtmDevice.id
+    ).filter(
+        Transaction.from_account_id == account_id,
+        Transaction.type == type_of_transaction,
+        Transaction.date >= start,
+        Transaction.date < end
+    ).scalar()
+
+
+def check_consistency(db: Session, account_ids: list = None) -> list:
+    """
+    Compare the windowed aggregates in redis with the same aggregates computed from the transactions table.
+    :param db: database session
+    :param account_ids: accounts to check (defaults to every account with a transaction in the longest window)
+    :return: list of mismatches
+    """
+
+    now = time.time()
+
+    if account_ids is None:
+        oldest = datetime.fromtimestamp(now - max(window for window, _ in RULE_WINDOWS.values()), tz=pytz.utc)
+        account_ids = [row[0] for row in db.query(Transaction.from_account_id).filter(
+            Transaction.from_account_id.isnot(None),
+            Transaction.date >= oldest
+        ).distinct()]
+
+    mismatches = []
+    for account_id in account_ids:
+        checks = [
+            ("rapid", rapid_count(account_id, now), sql_rapid_count(db, account_id, now)),
+            ("frequency", frequency_counts(account_id, now), sql_frequency_counts(db, account_id, now)),
+        ]
+        for type_of_transaction in ATM_TYPES:
+            checks.append((f"smurfing:{type_of_transaction}",
+                           round(small_amount_sum(account_id, type_of_transaction, now), 2),
+                           round(sql_small_amount_sum(db, account_id, type_of_transaction, now), 2)))
+            checks.append((f"locations:{type_of_transaction}",
+                           distinct_locations(account_id, type_of_transaction, now),
+                           sql_distinct_locations(db, account_id, type_of_transaction, now)))
+
+        for rule, store_value, sql_value in checks:
+            if store_value != sql_value:
+                mismatches.append({"account_id": account_id, "rule": rule, "store": store_value, "sql": sql_value})
+
+    return mismatches
+
+
+## consistency checker
+## run from the bank-backend folder: python -m src.aml_windows
+
+def main():
+    db = next(get_db())
+    try:
+        mismatches = check_consistency(db)
+        for mismatch in mismatches:
+            print(f"Account {mismatch['account_id']}, rule {mismatch['rule']}: "
+                  f"store={mismatch['store']} sql={mismatch['sql']}")
+        print(f"Found {len(mismatches)} mismatches.")
+    finally:
+        db.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,209 @@
+import asyncio
+import redis
+from sqlalchemy import update
+from sqlalchemy.ext.asyncio import AsyncSession
+from src.config import ATM_ASSIGNMENT_TIMEOUT, ATM_RELIST_SECONDS, ATM_REBUILD_GUARD_SECONDS
+from src.database import SessionLocal
+from src.models import AtmDevice
+from src.redis_client import r, async_r, blocking_r
+
+## free ATMs kept in redis lists, one per localization (atm:free:{localization})
+## clients wait with BLPOP, which redis serves in arrival order, so waiting clients get ATMs first come first served
+## (on the blocking pool of src.redis_client -- waiters do not take the connections of the shared async pool)
+## the database status stays the source of truth: an ATM is taken only by the conditional active -> busy update,
+## so stale or duplicated list entries are skipped; an active ATM missing from its list (the push after a release
+## failed) is put back by relist_periodically
+
+LOCALIZATIONS_KEY = "atm:localizations"
+REBUILD_GUARD_KEY = "atm:free:rebuilt"
+PUBLISH_ATTEMPTS = 3
+
+
+def _free_key(localization: str) -> str:
+    return f"atm:free:{localization}"
+
+
+def publish_free_atm(atm_id: int, localization: str):
+    """
+    Put the ATM in the free-list (sync client).
+    """
+
+    pipe = r.pipeline()
+    pipe.sadd(LOCALIZATIONS_KEY, localization)
+    pipe.rpush(_free_key(localization), atm_id)
+    pipe.execute()
+
+
+async def publish_free_atm_async(atm_id: int, localization: str):
+    """
+    Put the ATM in the free-list (async client), retrying on redis errors.
+    :return: False when every attempt failed -- the ATM is re-listed by relist_periodically
+    """
+
+    for attempt in range(PUBLISH_ATTEMPTS):
+        try:
+            pipe = async_r.pipeline()
+            pipe.sadd(LOCALIZATIONS_KEY, localization)
+            pipe.rpush(_free_key(localization), atm_id)
+            await pipe.execute()
+            return True
+        except redis.RedisError as e:
+            print(f"Failed to list free ATM {atm_id} (attempt {attempt + 1}): {e}")
+            await asyncio.sleep(0.1 * 2 ** attempt)
+
+    return False
+
+
+async def acquire_atm(db: AsyncSession, localization: str = None, timeout: float = ATM_ASSIGNMENT_TIMEOUT):
+    """
+    Wait for a free ATM and mark it as busy.
+    No database connection is held while waiting.
+    :param db: database session
+    :param localization: take an ATM from this localization only (default: any)
+    :param timeout: how long to wait, in seconds
+    :return: ATM id, None when no ATM became free in time
+    """
+
+    if localization:
+        keys = [_free_key(localization)]
+    else:
+        keys = [_free_key(name.decode()) for name in sorted(await async_r.smembers(LOCALIZATIONS_KEY))]
+        if not keys:
+            return None
+
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + timeout
+
+    while True:
+        remaining = deadline - loop.time()
+        if remaining <= 0:
+            return None
+
+        popped = await blocking_r.blpop(keys, timeout=remaining)
+        if not popped:
+            return None
+
+        key, atm_id = popped[0], int(popped[1])
+        try:
+            claimed = (await db.execute(
+                update(AtmDevice).where(AtmDevice.id == atm_id, AtmDevice.status == 'active')
+                .values(status='busy').returning(AtmDevice.id)
+            )).first()
+            await db.commit()
+        except BaseException:
+            # Client gone (cancelled) or database error between the pop and the claim -- the ATM goes back to
+            # the head of its list; if the claim did commit, the entry is stale and the next waiter skips it
+            await asyncio.shield(async_r.lpush(key, atm_id))
+            raise
+
+        if claimed:
+            return atm_id
+        # Stale entry (ATM deleted or already busy) -- wait for the next one
+
+
+async def release_atm(db: AsyncSession, atm_id: int) -> bool:
+    """
+    Mark the ATM as active and return it to the free-list.
+    :param db: database session
+    :param atm_id: ATM id
+    :return: False when the ATM does not exist
+    """
+
+    released = (await db.execute(
+        update(AtmDevice).where(AtmDevice.id == atm_id, AtmDevice.status == 'busy')
+        .values(status='active').returning(AtmDevice.localization)
+    )).first()
+    await db.commit()
+
+    if released:
+        # Only the busy -> active transition pushes, so an ATM is not listed twice;
+        # a push that failed despite the retries is repaired by relist_periodically
+        await publish_free_atm_async(atm_id, released[0])
+        return True
+
+    return await db.get(AtmDevice, atm_id) is not None
+
+
+def rebuild_free_list():
+    """
+    Rebuild the free-lists from the active ATMs in the database (at startup or after redis lost its data).
+    """
+
+    # Clearing first -- an ATM released meanwhile may be listed twice, which is harmless
+    keys = [_free_key(name.decode()) for name in r.smembers(LOCALIZATIONS_KEY)]
+    if keys:
+        r.delete(LOCALIZATIONS_KEY, *keys)
+
+    db = SessionLocal()
+    try:
+        for atm_id, localization in db.query(AtmDevice.id, AtmDevice.localization).filter(AtmDevice.status == 'active'):
+            publish_free_atm(atm_id, localization)
+    finally:
+        db.close()
+
+
+def rebuild_free_list_once() -> bool:
+    """
+    Rebuild the free-lists at startup, once per deployment -- the first process takes the guard key (SET NX),
+    the processes started within ATM_REBUILD_GUARD_SECONDS after it skip the rebuild (it would clear the lists
+    the running processes already serve from).
+    :return: True when this process rebuilt the free-lists
+    """
+
+    if not r.set(REBUILD_GUARD_KEY, 1, nx=True, ex=ATM_REBUILD_GUARD_SECONDS):
+        return False
+
+    try:
+        rebuild_free_list()
+    except Exception:
+        r.delete(REBUILD_GUARD_KEY)     # the next process to start retries
+        raise
+    return True
+
+
+def relist_missing_atms() -> int:
+    """
+    Put the active ATMs missing from their free-lists back at the tail.
+    An ATM popped by a waiter but not yet claimed may be listed twice -- harmless, the duplicate is skipped.
+    :return: number of re-listed ATMs
+    """
+
+    db = SessionLocal()
+    try:
+        active = db.query(AtmDevice.id, AtmDevice.localization).filter(AtmDevice.status == 'active').all()
+    finally:
+        db.close()
+
+    listed = {}
+    relisted = 0
+    for atm_id, localization in active:
+        if localization not in listed:
+            listed[localization] = {int(value) for value in r.lrange(_free_key(localization), 0, -1)}
+        if atm_id not in listed[localization]:
+            publish_free_atm(atm_id, localization)
+            relisted += 1
+
+    return relisted
+
+
+async def relist_periodically(interval: float = ATM_RELIST_SECONDS):
+    """
+    Background task of the API: re-list the active ATMs whose release could not reach redis.
+    """
+
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            relisted = await asyncio.to_thread(relist_missing_atms)
+            if relisted:
+                print(f"Re-listed {relisted} free ATMs.")
+        except Exception as e:
+            print(f"ATM free-list check failed: {e}")
+
+
+## rebuild command
+## run from the bank-backend folder: python -m src.atm_pool
+
+if __name__ == "__main__":
+    rebuild_free_list()
+    print("ATM free-lists rebuilt.")
@@ -1,15 +1,21 @@
+import asyncio
+import threading
+import time
 import jwt
-import redis
 from fastapi import HTTPException, Depends, status
 from fastapi.security import OAuth2PasswordBearer
-from passlib.context import CryptContext
 from datetime import datetime, timedelta, timezone
-from src.config import ALGORITHM, SECRET_KEY
+from src.config import (ALGORITHM, SECRET_KEY, PRINCIPAL_CACHE_TTL_SECONDS, PRINCIPAL_CACHE_SIZE,
+                        SESSION_PRUNE_INTERVAL_SECONDS)
+from src.database import SessionLocal
+from src.models import User
+from src.redis_client import r, async_r
+from src.password_pool import pwd_context
 
-r = redis.Redis(host='redis', port=6379, db=0)
 
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="login")
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+
+SESSIONS_KEY = "sessions"
 
 
 def hash_password(password: str) -> str:
@@ -60,7 +66,31 @@ def store_token_in_redis(user_id: int, token: str, expires_delta: timedelta):
     :param expires_delta: token lifetime
     """
 
-    r.setex(f"user:{user_id}:token", int(expires_delta.total_seconds()), token)
+    # The token and its expiry in the session registry
+    pipe = r.pipeline()
+    pipe.setex(f"user:{user_id}:token", int(expires_delta.total_seconds()), token)
+    pipe.zadd(SESSIONS_KEY, {user_id: time.time() + expires_delta.total_seconds()})
+    pipe.execute()
+
+    # The previous token of the user (if any) is no longer valid
+    invalidate_principal(user_id)
+
+
+def remove_token_from_redis(user_id: int) -> bool:
+    """
+    Remove the token of the user (logout).
+    :param user_id: user id
+    :return: False when the user had no token
+    """
+
+    pipe = r.pipeline()
+    pipe.delete(f"user:{user_id}:token")
+    pipe.zrem(SESSIONS_KEY, user_id)
+    deleted, _ = pipe.execute()
+
+    if deleted:
+        invalidate_principal(user_id)       # cached principals of the user in every API process
+    return bool(deleted)
 
 
 def verify_token_in_redis(token: str, user_id: int):
@@ -83,30 +113,151 @@ def verify_token_in_redis(token: str, user_id: int):
     return True
 
 
-def get_current_user(token: str = Depends(oauth2_scheme)) -> int:
+## principal of the request -- resolved once per request (FastAPI caches the get_principal dependency)
+## and kept in a short-lived in-process cache keyed by the token, so most authenticated requests
+## need neither redis nor the database
+## logout, a new login, disabling or deleting the user publish the user id on INVALIDATION_CHANNEL --
+## every process drops the cached principals of that user; if the subscription is down, entries
+## still expire after PRINCIPAL_CACHE_TTL_SECONDS
+
+INVALIDATION_CHANNEL = "auth:invalidate"
+
+
+class Principal:
     """
-    Get the current user id.
+    Authenticated user of the request.
+    """
+
+    __slots__ = ("user_id", "role", "status", "first_name")
+
+    def __init__(self, user_id: int, role: str, status: str, first_name: str):
+        self.user_id = user_id
+        self.role = role
+        self.status = status
+        self.first_name = first_name
+
+
+_principals = {}        # token -> (expiry, Principal)
+_principals_lock = threading.Lock()
+_subscriber = None
+
+
+def _drop_principals(message):
+    user_id = int(message["data"])
+    with _principals_lock:
+        for token in [token for token, (_, principal) in _principals.items() if principal.user_id == user_id]:
+            del _principals[token]
+
+
+def _start_subscriber():
+    global _subscriber
+
+    with _principals_lock:
+        if _subscriber is not None and _subscriber.is_alive():
+            return
+        pubsub = r.pubsub(ignore_subscribe_messages=True)
+        pubsub.subscribe(**{INVALIDATION_CHANNEL: _drop_principals})
+        _subscriber = pubsub.run_in_thread(sleep_time=1, daemon=True)
+
+
+def invalidate_principal(user_id: int):
+    """
+    Drop the cached principals of the user in every API process.
+    :param user_id: user id
+    """
+
+    r.publish(INVALIDATION_CHANNEL, user_id)
+
+
+def _cache_principal(token: str, principal: Principal):
+    now = time.monotonic()
+    with _principals_lock:
+        if len(_principals) >= PRINCIPAL_CACHE_SIZE:
+            for cached in [cached for cached, (expiry, _) in _principals.items() if expiry <= now]:
+                del _principals[cached]
+            while len(_principals) >= PRINCIPAL_CACHE_SIZE:
+                del _principals[next(iter(_principals))]      # the oldest entry
+        _principals[token] = (now + PRINCIPAL_CACHE_TTL_SECONDS, principal)
+
+
+def get_principal(token: str = Depends(oauth2_scheme)) -> Principal:
+    """
+    Resolve the principal of the request: the token signature, the token stored in redis (the user
+    is still logged in with this token) and the user row -- cached for PRINCIPAL_CACHE_TTL_SECONDS.
     :param token: bearer token
-    :return: user id
+    :return: principal
     """
 
     try:
         # Decode the token -- obtain the user data
         payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
-        user_id = payload.get("user_id")
-        role = payload.get("role")
+    # Raise the exception when the token is invalid
+    except jwt.PyJWTError:
+        raise HTTPException(status_code=401, detail="Invalid token")
+
+    _start_subscriber()
 
-        token_key = f"user:{user_id}:token"
+    with _principals_lock:
+        cached = _principals.get(token)
+    if cached and cached[0] > time.monotonic():
+        principal = cached[1]
+    else:
+        user_id = int(payload.get("user_id"))
 
-        # Raise the exception when token does not exist in redis
-        if not r.exists(token_key):
+        # Raise the exception when token does not exist in redis (or the user logged in again since)
+        stored_token = r.get(f"user:{user_id}:token")
+        if stored_token is None or stored_token.decode() != token:
             raise HTTPException(status_code=401, detail="Invalid token or user logged out")
 
-        return user_id
+        db = SessionLocal()
+        try:
+            user = db.query(User.id, User.role, User.status, User.first_name).filter(User.id == user_id).first()
+        finally:
+            db.close()
 
-    # Raise the exception when the token is invalid
-    except jwt.PyJWTError:
-        raise HTTPException(status_code=401, detail="Invalid token")
+        if not user:
+            raise HTTPException(status_code=401, detail="User not found")
+
+        principal = Principal(user.id, user.role, user.status, user.first_name)
+        _cache_principal(token, principal)
+
+    if principal.status == "disabled":
+        raise HTTPException(status_code=403, detail="User disabled")
+
+    return principal
+
+
+def get_current_user(principal: Principal = Depends(get_principal)) -> int:
+    """
+    Get the current user id.
+    :param principal: principal of the request
+    :return: user id
+    """
+
+    return principal.user_id
+
+
+## session registry -- sorted set of the logged in users scored by the expiry of their token
+## listing walks the registry with ZSCAN (cost proportional to the active sessions, never the whole keyspace)
+## and reads the tokens with one MGET per page; expired entries are pruned in the background
+
+
+def list_sessions(cursor: int = 0, count: int = 100) -> tuple:
+    """
+    Get a page of the active sessions.
+    :param cursor: cursor returned with the previous page (0 -- first page)
+    :param count: page size hint (like SCAN, a page may be smaller or larger)
+    :return: next cursor (0 -- last page), dictionary token key -> token
+    """
+
+    cursor, entries = r.zscan(SESSIONS_KEY, cursor, count=count)
+
+    now = time.time()
+    keys = [f"user:{int(member)}:token" for member, expiry in entries if expiry > now]
+    tokens = r.mget(keys) if keys else []
+
+    # A token may have expired after the registry entry was read
+    return cursor, {key: token.decode() for key, token in zip(keys, tokens) if token is not None}
 
 
 def get_all_tokens() -> dict:
@@ -115,41 +266,56 @@ def get_all_tokens() -> dict:
     :return: dictionary with tokens
     """
 
-    # Get keys matching the specifc pattern
-    keys = r.keys("user:*:token")
+    tokens = {}
+    cursor = 0
+    while True:
+        cursor, page = list_sessions(cursor)
+        tokens.update(page)
+        if cursor == 0:
+            return tokens
+
+
+async def prune_sessions() -> int:
+    """
+    Remove the expired sessions from the registry.
+    :return: number of removed sessions
+    """
+
+    return await async_r.zremrangebyscore(SESSIONS_KEY, "-inf", time.time())
 
-    # Associate tokens with the keys
-    tokens = {key.decode(): r.get(key).decode() for key in keys}
 
-    return tokens
+async def prune_sessions_periodically(interval: float = SESSION_PRUNE_INTERVAL_SECONDS):
+    """
+    Background task of the API process -- prune the registry every [interval] seconds.
+    """
 
+    while True:
+        try:
+            await prune_sessions()
+        except Exception as e:
+            print(f"Session registry pruning failed: {e}")
+        await asyncio.sleep(interval)
 
-def admin_required(token: str = Depends(oauth2_scheme)):
-    payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
-    if payload.get("role") != "admin":
+
+def admin_required(principal: Principal = Depends(get_principal)) -> Principal:
+    if principal.role != "admin":
         raise HTTPException(status_code=403, detail="Admins only")
-    return payload
+    return principal
 
 
-def user_required(token: str = Depends(oauth2_scheme)):
-    payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
-    if payload.get("role") not in ["user", "admin"]:
+def user_required(principal: Principal = Depends(get_principal)) -> Principal:
+    if principal.role not in ["user", "admin"]:
         raise HTTPException(status_code=403, detail="Users only")
-    return payload
+    return principal
 
 
-def bank_employee_required(token: str = Depends(oauth2_scheme)):
-    payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
-    if payload.get("role") not in ["user", "bank_emp"]:
+def bank_employee_required(principal: Principal = Depends(get_principal)) -> Principal:
+    if principal.role not in ["user", "bank_emp"]:
         raise HTTPException(status_code=403, detail="Bank employees only")
-    return payload
+    return principal
 
 
-def aml_required(token: str = Depends(oauth2_scheme)):
-    payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
-    if payload.get("role") not in ["user", "aml"]:
+def aml_required(principal: Principal = Depends(get_principal)) -> Principal:
+    if principal.role not in ["user", "aml"]:
         raise HTTPException(status_code=403, detail="AML only")
-    return payload
-
-
-
+    return principal
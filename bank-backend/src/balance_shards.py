@@ -0,0 +1,167 @@
+import random
+import sys
+import threading
+import time
+from sqlalchemy import select, func, delete, text
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.orm import Session
+from src.config import BALANCE_SHARDS_REFRESH_SECONDS, BALANCE_SHARDS_CONSOLIDATE_SECONDS
+from src.database import SessionLocal
+from src.models import Account, AccountBalanceShard
+
+## sharded balances of hot accounts (opt-in, e.g. clearing or corporate accounts)
+## the balance of a sharded account = the account row + its rows in account_balance_shards;
+## a write goes to one random shard instead of the single account row, so concurrent writers
+## rarely wait for the same row lock; reads sum the shards (total_balance)
+## consolidation folds the shards back into the account row periodically
+## the shard counts are cached in-process -- a stale entry is harmless: a write to a shard that no
+## longer exists falls back to the account row, an account not yet known as sharded is written directly
+##
+## run from the bank-backend folder:
+##   python -m src.balance_shards enable <account_id> <shards>
+##   python -m src.balance_shards disable <account_id>
+##   python -m src.balance_shards consolidate          (loop, every BALANCE_SHARDS_CONSOLIDATE_SECONDS)
+
+
+_shard_counts = {}
+_loaded_at = 0.0
+_lock = threading.Lock()
+
+
+def shard_count(db: Session, account_id: int) -> int:
+    """
+    Number of balance shards of the account (0 -- not sharded), from the in-process cache.
+    """
+
+    global _shard_counts, _loaded_at
+
+    # One thread reloads (outside the lock) and swaps the new dict in, the others keep reading the old one
+    with _lock:
+        reload = time.monotonic() - _loaded_at > BALANCE_SHARDS_REFRESH_SECONDS
+        if reload:
+            _loaded_at = time.monotonic()
+
+    if reload:
+        try:
+            _shard_counts = dict(db.execute(select(AccountBalanceShard.account_id, func.count())
+                                            .group_by(AccountBalanceShard.account_id)).all())
+        except Exception:
+            reload_shard_counts()
+            raise
+
+    return _shard_counts.get(account_id, 0)
+
+
+def reload_shard_counts():
+    """
+    Make the next shard_count reload the counts (sharding changed by this process).
+    """
+
+    global _loaded_at
+    with _lock:
+        _loaded_at = 0.0
+
+
+def pick_shard(shards: int) -> int:
+    return random.randrange(shards)
+
+
+def total_balance(account_id):
+    """
+    SQL expression of the whole balance of the account: the account row and its shards.
+    :param account_id: account id (value or column)
+    """
+
+    shards = select(func.coalesce(func.sum(AccountBalanceShard.balance), 0)) \
+        .where(AccountBalanceShard.account_id == account_id).scalar_subquery()
+    return Account.balance + shards
+
+
+# Fold the shards into the account rows -- the shard rows are locked (in a fixed order), so no write is lost
+CONSOLIDATE_SQL = """
+WITH old AS (
+    SELECT account_id, shard, balance FROM account_balance_shards
+    WHERE balance <> 0 AND (CAST(:account_id AS integer) IS NULL OR account_id = :account_id)
+    ORDER BY account_id, shard
+    FOR UPDATE
+), folded AS (
+    UPDATE account_balance_shards s SET balance = 0
+    FROM old WHERE s.account_id = old.account_id AND s.shard = old.shard
+    RETURNING old.account_id, old.balance
+)
+UPDATE accounts a SET balance = a.balance + f.total
+FROM (SELECT account_id, SUM(balance) AS total FROM folded GROUP BY account_id) f
+WHERE a.id = f.account_id
+"""
+
+
+def consolidate(db: Session, account_id: int = None) -> int:
+    """
+    Fold the shards of the account (default: of all the sharded accounts) into the account rows.
+    The caller is responsible for committing the session.
+    :return: number of updated accounts
+    """
+
+    return db.execute(text(CONSOLIDATE_SQL), {"account_id": account_id}).rowcount
+
+
+def enable_sharding(db: Session, account_id: int, shards: int):
+    """
+    Split the writes of the account over [shards] balance shards (also: change the number of shards).
+    The caller is responsible for committing the session.
+    """
+
+    # Shards above the new count are folded back first
+    consolidate(db, account_id)
+    db.execute(delete(AccountBalanceShard).where(AccountBalanceShard.account_id == account_id,
+                                                 AccountBalanceShard.shard >= shards))
+    db.execute(insert(AccountBalanceShard).values([{"account_id": account_id, "shard": shard, "balance": 0}
+                                                   for shard in range(shards)]).on_conflict_do_nothing())
+    reload_shard_counts()
+
+
+def disable_sharding(db: Session, account_id: int):
+    """
+    Fold the shards back and write the account row directly again.
+    The caller is responsible for committing the session.
+    """
+
+    consolidate(db, account_id)
+    db.execute(delete(AccountBalanceShard).where(AccountBalanceShard.account_id == account_id))
+    reload_shard_counts()
+
+
+def run_consolidation(interval: float = BALANCE_SHARDS_CONSOLIDATE_SECONDS):
+    while True:
+        db = SessionLocal()
+        try:
+            print(f"Consolidated {consolidate(db)} sharded accounts.")
+            db.commit()
+        except Exception as e:
+            db.rollback()
+            print(f"Consolidation failed: {e}")
+        finally:
+            db.close()
+        time.sleep(interval)
+
+
+def main():
+    command = sys.argv[1] if len(sys.argv) > 1 else "consolidate"
+    if command == "consolidate":
+        run_consolidation()
+        return
+
+    db = SessionLocal()
+    try:
+        if command == "enable":
+            enable_sharding(db, int(sys.argv[2]), int(sys.argv[3]))
+        elif command == "disable":
+            disable_sharding(db, int(sys.argv[2]))
+        db.commit()
+    finally:
+        db.close()
+    print("Done.")
+
+
+if __name__ == "__main__":
+    main()
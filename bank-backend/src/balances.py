@@ -0,0 +1,151 @@
+from decimal import Decimal, ROUND_HALF_UP
+from sqlalchemy import update, text
+from sqlalchemy.orm import Session
+from src.database import engine
+from src.models import Account, AccountBalanceShard
+from src.balance_shards import shard_count, pick_shard, consolidate, total_balance
+
+## account balances in integer minor units (grosze) changed only by single conditional UPDATE statements:
+## a debit succeeds only when the balance covers it, a credit always does -- no read-modify-write in python,
+## so concurrent operations can neither lose an update nor overdraw an account
+## the API keeps speaking PLN (to_minor / to_major at the boundary)
+## hot accounts can be sharded (src.balance_shards) -- their balance is read with total_balance
+
+
+def to_minor(amount) -> int:
+    """
+    Amount in PLN -> grosze (rounded half up, exact for decimal input).
+    """
+
+    return int((Decimal(str(amount)) * 100).quantize(Decimal(1), rounding=ROUND_HALF_UP))
+
+
+def to_major(amount_minor: int) -> float:
+    """
+    Grosze -> amount in PLN.
+    """
+
+    return amount_minor / 100
+
+
+def _debit_row(db: Session, account_id: int, amount_minor: int):
+    return db.execute(
+        update(Account).where(Account.id == account_id, Account.balance >= amount_minor)
+        .values(balance=Account.balance - amount_minor).returning(Account.balance)
+        .execution_options(synchronize_session=False)
+    ).scalar()
+
+
+def _credit_row(db: Session, account_id: int, amount_minor: int):
+    return db.execute(
+        update(Account).where(Account.id == account_id)
+        .values(balance=Account.balance + amount_minor).returning(Account.balance)
+        .execution_options(synchronize_session=False)
+    ).scalar()
+
+
+def _change_shard(db: Session, account_id: int, shard: int, amount_minor: int, covered: bool):
+    condition = [AccountBalanceShard.balance >= -amount_minor] if covered else []
+    return db.execute(
+        update(AccountBalanceShard).where(AccountBalanceShard.account_id == account_id,
+                                          AccountBalanceShard.shard == shard, *condition)
+        .values(balance=AccountBalanceShard.balance + amount_minor).returning(AccountBalanceShard.balance)
+        .execution_options(synchronize_session=False)
+    ).scalar()
+
+
+def debit(db: Session, account_id: int, amount_minor: int):
+    """
+    Take the amount from the account, only if the balance covers it.
+    Sharded accounts (src.balance_shards): one random shard, then the account row, then -- when
+    the balance is spread over the shards -- the shards are folded into the account row first.
+    :return: new balance of the debited row, None -- insufficient funds (or no such account)
+    """
+
+    shards = shard_count(db, account_id)
+    if not shards:
+        return _debit_row(db, account_id, amount_minor)
+
+    balance = _change_shard(db, account_id, pick_shard(shards), -amount_minor, covered=True)
+    if balance is None:
+        balance = _debit_row(db, account_id, amount_minor)
+    if balance is None:
+        consolidate(db, account_id)
+        balance = _debit_row(db, account_id, amount_minor)
+    return balance
+
+
+def credit(db: Session, account_id: int, amount_minor: int):
+    """
+    Add the amount to the account (sharded accounts: to one random shard).
+    :return: new balance of the credited row, None -- no such account
+    """
+
+    shards = shard_count(db, account_id)
+    if shards:
+        balance = _change_shard(db, account_id, pick_shard(shards), amount_minor, covered=False)
+        if balance is not None:
+            return balance
+        # The shard is gone (sharding changed since the counts were cached) -- the account row
+
+    return _credit_row(db, account_id, amount_minor)
+
+
+def transfer_funds(db: Session, from_account_id: int, to_account_id, amount_minor: int) -> bool:
+    """
+    Move the amount between the accounts (to_account_id 0/None -- external transfer, only the debit).
+    Both rows are updated in the order of their ids, so opposite transfers cannot deadlock.
+    The caller is responsible for committing the session.
+    :return: False -- insufficient funds, nothing changed
+    """
+
+    if not to_account_id:
+        return debit(db, from_account_id, amount_minor) is not None
+
+    if from_account_id < to_account_id:
+        if debit(db, from_account_id, amount_minor) is None:
+            return False
+        credit(db, to_account_id, amount_minor)
+        return True
+
+    credit(db, to_account_id, amount_minor)
+    if debit(db, from_account_id, amount_minor) is None:
+        # Undo the credit -- not committed, the receiver row is still locked by this transaction
+        credit(db, to_account_id, -amount_minor)
+        return False
+    return True
+
+
+## migration of an existing database (float PLN -> bigint grosze), version 2 of src.migrations
+## run from the bank-backend folder: python -m src.migrations (or alone: python -m src.balances)
+
+MIGRATION_SQL = """
+ALTER TABLE accounts ALTER COLUMN balance TYPE BIGINT USING ROUND(balance::numeric * 100)::bigint;
+ALTER TABLE accounts ALTER COLUMN balance SET DEFAULT 0;
+"""
+
+
+def migrate_to_minor_units(connection) -> bool:
+    """
+    Convert the balances to grosze, unless already converted.
+    :param connection: database connection (inside a transaction)
+    :return: False -- already in minor units
+    """
+
+    column_type = connection.execute(text(
+        "SELECT data_type FROM information_schema.columns WHERE table_name = 'accounts' AND column_name = 'balance'"
+    )).scalar()
+    if column_type == "bigint":
+        return False
+    connection.execute(text(MIGRATION_SQL))
+    return True
+
+
+def main():
+    with engine.begin() as connection:
+        migrated = migrate_to_minor_units(connection)
+    print("Balances migrated to minor units." if migrated else "Balances already in minor units.")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,74 +1,59 @@
-from celery import Celery
-from models import AtmDevice, Card, Account, User, Transaction
-from database import get_db
-import requests
 from datetime import datetime
-import pytz
-import sys
+from celery import Celery
+from src.database import get_db
+from src.partitions import queue_entry
 
-from routes.aml import send_transaction_to_aml
+from services.aml import check_transfer
+from services.atm import process_atm_operation, publish_result
+from services.transfers import enqueue_settlement
+from src.transaction_feed import publish_transaction_event
 
 
 celery_app = Celery("worker", broker="redis://redis:6379/0")
 
 @celery_app.task(name="process_aml_check")
-def process_aml_check(transaction_id: int, amount: float):
-
-    send_transaction_to_aml(transaction_id, amount)
-
-
-@celery_app.task(name="process_atm_operation_task")         # wywołuje się
-def process_atm_operation_task(transaction_id: int):        # kolejkowanie operacji bankomatowych ig
+def process_aml_check(transaction_id: int, amount: float, tx_date: str = None):
 
+    # Sprawdzenie AML (i ewentualna akceptacja przelewu) w jednej transakcji bazy danych
+    # Data transakcji (ISO) -- odczyt tylko z jej partycji
+    tx_date = datetime.fromisoformat(tx_date) if tx_date else None
     db = next(get_db())
 
     try:
-        transaction = db.query(Transaction).filter(Transaction.id == transaction_id).first()
-        if not transaction:
-            return
+        new_status = check_transfer(db, transaction_id, tx_date)
+        db.commit()
+    except Exception:
+        db.rollback()
+        raise
+    finally:
+        db.close()
 
-        # rozgraniczenie na dwie rodzaje transakcji - wplaty/wyplaty --> roznica w tym czy to from_account, czy to_account
-        if transaction.type == "withdrawal":
-            account = db.query(Account).filter(Account.id == transaction.from_account_id).first()
-        elif transaction.type == "deposit":
-            account = db.query(Account).filter(Account.id == transaction.to_account_id).first()
+    if new_status == "aml_approved":
+        enqueue_settlement(queue_entry(transaction_id, tx_date))      # group-commit settlement (services.settlement)
+    if new_status:
+        publish_transaction_event(transaction_id, new_status)
 
-        # Weryfikacja AML
-        verification_response = requests.post(
-            "http://bank-backend:8000/verify-transaction-auto",
-            json={"transaction_id": transaction_id}
-        )
 
-        now = datetime.now(pytz.timezone('Europe/Warsaw'))
+@celery_app.task(name="process_atm_operation_task")         # wywołuje się
+def process_atm_operation_task(transaction_id: int, tx_date: str = None):        # kolejkowanie operacji bankomatowych ig
 
+    # Data utworzenia transakcji (ISO) -- odczyt tylko partycji od jej miesiąca
+    tx_date = datetime.fromisoformat(tx_date) if tx_date else None
+    db = next(get_db())
 
-        if verification_response.status_code != 200:
-            transaction.status = "failed"
-            transaction.date = now
+    status = "error"
+    try:
+        status = process_atm_operation(db, transaction_id, tx_date)
+        if status in ["completed", "failed"]:
             db.commit()
-            return
-
-        result_status = verification_response.json().get("status")
-        transaction.date = now
-
-        if result_status == "completed":
-            transaction.status = "completed"
-
-            #rozgraniczenie czy balance na "+" czy "-"
-            if transaction.type == "withdrawal":
-                account.balance -= transaction.amount
-            elif transaction.type == "deposit":
-                account.balance += transaction.amount
-
-
-        else:
-            transaction.status = "pending"  # albo aml_blocked
-            return
-
-        db.commit()
-        db.refresh(transaction)
     except Exception as e:
         db.rollback()
         print(f"Błąd przetwarzania transakcji ATM: {e}")
     finally:
-        db.close()
\ No newline at end of file
+        db.close()
+
+    # Powiadomienie oczekującego bankomatu -- także gdy operacja czeka na pracownika lub przetwarzanie się nie powiodło
+    if status is not None:
+        publish_result(transaction_id, status)
+        if status in ["completed", "failed"]:
+            publish_transaction_event(transaction_id, status)
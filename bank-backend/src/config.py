@@ -1,4 +1,5 @@
 import os
+import re
 from dotenv import load_dotenv
 
 # Load database url (and other potentially secret data) from .env file
@@ -9,4 +10,99 @@ load_dotenv(dotenv_path=dotenv_path)
 DATABASE_URL = os.getenv("DATABASE_URL")
 BASE_URL = os.getenv("BASE_URL")
 SECRET_KEY = os.getenv("SECRET_KEY")
-ALGORITHM = os.getenv("ALGORITHM")
\ No newline at end of file
+ALGORITHM = os.getenv("ALGORITHM")
+
+# Async driver (asyncpg) for the async routes -- derived from DATABASE_URL unless given explicitly
+ASYNC_DATABASE_URL = os.getenv("ASYNC_DATABASE_URL") or (
+    re.sub(r"^postgresql(\+\w+)?://", "postgresql+asyncpg://", DATABASE_URL) if DATABASE_URL else None)
+REDIS_HOST = os.getenv("REDIS_HOST", "redis")
+
+# Windowed AML aggregates (redis) -- window and bucket sizes in seconds
+AML_RAPID_WINDOW_SECONDS = int(os.getenv("AML_RAPID_WINDOW_SECONDS", 60))
+AML_RAPID_BUCKET_SECONDS = int(os.getenv("AML_RAPID_BUCKET_SECONDS", 5))
+AML_FREQUENCY_RECENT_SECONDS = int(os.getenv("AML_FREQUENCY_RECENT_SECONDS", 7 * 24 * 3600))
+AML_FREQUENCY_PAST_SECONDS = int(os.getenv("AML_FREQUENCY_PAST_SECONDS", 30 * 24 * 3600))
+AML_FREQUENCY_BUCKET_SECONDS = int(os.getenv("AML_FREQUENCY_BUCKET_SECONDS", 3600))
+AML_SMURFING_WINDOW_SECONDS = int(os.getenv("AML_SMURFING_WINDOW_SECONDS", 3600))
+AML_SMURFING_BUCKET_SECONDS = int(os.getenv("AML_SMURFING_BUCKET_SECONDS", 60))
+AML_SMURFING_MAX_SINGLE_AMOUNT = float(os.getenv("AML_SMURFING_MAX_SINGLE_AMOUNT", 2000.0))
+AML_LOCATIONS_WINDOW_SECONDS = int(os.getenv("AML_LOCATIONS_WINDOW_SECONDS", 1800))
+AML_LOCATIONS_BUCKET_SECONDS = int(os.getenv("AML_LOCATIONS_BUCKET_SECONDS", 60))
+
+# Micro-batched AML worker (services.aml_batch)
+AML_BATCH_ENABLED = os.getenv("AML_BATCH_ENABLED", "false").lower() == "true"
+AML_BATCH_SIZE = int(os.getenv("AML_BATCH_SIZE", 500))
+AML_BATCH_MAX_WAIT_MS = int(os.getenv("AML_BATCH_MAX_WAIT_MS", 200))
+AML_BATCH_MAX_ATTEMPTS = int(os.getenv("AML_BATCH_MAX_ATTEMPTS", 5))      # failed checks before dead-lettering
+
+# Idempotency-Key of /transfer and the ATM operations (src.idempotency): how long responses are replayed,
+# how long an unfinished request holds its key, how long a concurrent duplicate waits for the first one
+IDEMPOTENCY_TTL_SECONDS = int(os.getenv("IDEMPOTENCY_TTL_SECONDS", 86400))
+IDEMPOTENCY_LOCK_TTL_SECONDS = int(os.getenv("IDEMPOTENCY_LOCK_TTL_SECONDS", 30))
+IDEMPOTENCY_WAIT_TIMEOUT = float(os.getenv("IDEMPOTENCY_WAIT_TIMEOUT", 10))
+
+# Monthly partitions of transactions (src.partitions): months created ahead, maintenance loop interval in seconds
+PARTITION_MONTHS_AHEAD = int(os.getenv("PARTITION_MONTHS_AHEAD", 3))
+PARTITION_MAINTENANCE_SECONDS = float(os.getenv("PARTITION_MAINTENANCE_SECONDS", 3600))
+
+# Group-commit settlement of approved transfers (services.settlement)
+SETTLEMENT_ENABLED = os.getenv("SETTLEMENT_ENABLED", "false").lower() == "true"
+SETTLEMENT_BATCH_SIZE = int(os.getenv("SETTLEMENT_BATCH_SIZE", 500))
+SETTLEMENT_MAX_WAIT_MS = int(os.getenv("SETTLEMENT_MAX_WAIT_MS", 20))
+
+# /admin/transaction-stats result cache
+STATS_CACHE_TTL_SECONDS = int(os.getenv("STATS_CACHE_TTL_SECONDS", 10))
+
+# Connection pools
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", 5))
+DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", 10))
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", 30))
+DB_POOL_RECYCLE = int(os.getenv("DB_POOL_RECYCLE", 1800))
+DB_POOL_PRE_PING = os.getenv("DB_POOL_PRE_PING", "true").lower() == "true"
+REDIS_MAX_CONNECTIONS = int(os.getenv("REDIS_MAX_CONNECTIONS", 50))
+REDIS_POOL_TIMEOUT = float(os.getenv("REDIS_POOL_TIMEOUT", 5))
+REDIS_SOCKET_TIMEOUT = float(os.getenv("REDIS_SOCKET_TIMEOUT", 5))
+REDIS_HEALTH_CHECK_INTERVAL = int(os.getenv("REDIS_HEALTH_CHECK_INTERVAL", 30))
+# Blocking pops (ATM free-list, account lock handoff) -- one connection per waiting client, kept apart from the
+# shared async pool
+REDIS_BLOCKING_MAX_CONNECTIONS = int(os.getenv("REDIS_BLOCKING_MAX_CONNECTIONS", 500))
+
+# ATM assignment (redis free-list) -- how long a client waits for a free ATM, in seconds
+ATM_ASSIGNMENT_TIMEOUT = float(os.getenv("ATM_ASSIGNMENT_TIMEOUT", 10))
+# How often the API re-lists active ATMs missing from the free-lists (a release whose push to redis failed), in seconds
+ATM_RELIST_SECONDS = float(os.getenv("ATM_RELIST_SECONDS", 30))
+# The free-lists are rebuilt by the first API process of a deployment -- the processes started within this many
+# seconds after it skip the rebuild
+ATM_REBUILD_GUARD_SECONDS = int(os.getenv("ATM_REBUILD_GUARD_SECONDS", 300))
+
+# Account lock of ATM sessions -- lock lifetime (ms) and how long a client waits for the lock (s)
+ACCOUNT_LOCK_TTL_MS = int(os.getenv("ACCOUNT_LOCK_TTL_MS", 10000))
+ACCOUNT_LOCK_TIMEOUT = float(os.getenv("ACCOUNT_LOCK_TIMEOUT", 10))
+# Lock metrics (/admin/lock-stats) are kept for at most this many most recently locked accounts per process
+ACCOUNT_LOCK_METRICS_SIZE = int(os.getenv("ACCOUNT_LOCK_METRICS_SIZE", 1000))
+
+# ATM confirmation (long-poll) -- how long a client waits for the worker's result, in seconds
+ATM_CONFIRMATION_TIMEOUT = float(os.getenv("ATM_CONFIRMATION_TIMEOUT", 10))
+
+# Admin live feed -- events buffered per client before the oldest are dropped
+FEED_CLIENT_BUFFER = int(os.getenv("FEED_CLIENT_BUFFER", 100))
+
+# Principal cache of the auth dependencies -- entry lifetime (s) and maximum number of cached tokens
+PRINCIPAL_CACHE_TTL_SECONDS = float(os.getenv("PRINCIPAL_CACHE_TTL_SECONDS", 5))
+PRINCIPAL_CACHE_SIZE = int(os.getenv("PRINCIPAL_CACHE_SIZE", 10000))
+
+# Session registry -- how often the API processes prune expired sessions, in seconds
+SESSION_PRUNE_INTERVAL_SECONDS = float(os.getenv("SESSION_PRUNE_INTERVAL_SECONDS", 60))
+
+# Password hashing -- bcrypt cost (hashes with another cost are rehashed at login), size of the hashing
+# process pool and how many requests may wait for it before new ones are rejected
+BCRYPT_ROUNDS = int(os.getenv("BCRYPT_ROUNDS", 12))
+PASSWORD_POOL_SIZE = int(os.getenv("PASSWORD_POOL_SIZE", max(1, (os.cpu_count() or 2) // 2)))
+PASSWORD_QUEUE_LIMIT = int(os.getenv("PASSWORD_QUEUE_LIMIT", 64))
+
+# Sort code (8 digits, "numer rozliczeniowy") of the bank in the issued NRB account numbers
+BANK_SORT_CODE = os.getenv("BANK_SORT_CODE", "10101010")
+
+# Sharded balances of hot accounts -- how often the shard counts are reloaded and the shards folded back, in seconds
+BALANCE_SHARDS_REFRESH_SECONDS = float(os.getenv("BALANCE_SHARDS_REFRESH_SECONDS", 10))
+BALANCE_SHARDS_CONSOLIDATE_SECONDS = float(os.getenv("BALANCE_SHARDS_CONSOLIDATE_SECONDS", 60))
@@ -1,11 +1,29 @@
 from sqlalchemy import create_engine
 from sqlalchemy.orm import sessionmaker
-from src.config import DATABASE_URL
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker
+from src.config import (DATABASE_URL, ASYNC_DATABASE_URL, DB_POOL_SIZE, DB_MAX_OVERFLOW, DB_POOL_TIMEOUT,
+                        DB_POOL_RECYCLE, DB_POOL_PRE_PING)
+from src.pool_metrics import MeteredQueuePool, MeteredAsyncQueuePool
 
-engine = create_engine(DATABASE_URL, connect_args={"client_encoding": "UTF8"})
+# Pool settings come from the environment (DB_POOL_*), the pools report checkout metrics (/admin/pool-stats)
+POOL_SETTINGS = {
+    "pool_size": DB_POOL_SIZE,
+    "max_overflow": DB_MAX_OVERFLOW,
+    "pool_timeout": DB_POOL_TIMEOUT,
+    "pool_recycle": DB_POOL_RECYCLE,
+    "pool_pre_ping": DB_POOL_PRE_PING,
+}
+
+engine = create_engine(DATABASE_URL, connect_args={"client_encoding": "UTF8"}, poolclass=MeteredQueuePool,
+                       **POOL_SETTINGS)
 
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
+# Async stack for the hot routes -- objects stay usable after commit (no lazy loading in async code)
+async_engine = create_async_engine(ASYNC_DATABASE_URL, poolclass=MeteredAsyncQueuePool, **POOL_SETTINGS)
+
+AsyncSessionLocal = async_sessionmaker(async_engine, autoflush=False, expire_on_commit=False)
+
 
 def get_db():
     """
@@ -18,3 +36,11 @@ def get_db():
     finally:
         db.close()
 
+
+async def get_async_db():
+    """
+    Async database session generator.
+    """
+
+    async with AsyncSessionLocal() as db:
+        yield db
@@ -3,6 +3,7 @@ import random
 import string
 from src.database import get_db
 from src.models import User, Account
+from src.balances import to_major
 from pytz import timezone
 from datetime import datetime, timedelta
 import json
@@ -12,6 +13,7 @@ import os
 ## aby uruchomić, należy otworzyć projekt jako folder bank-backend --> konieczne, ze względu na ścieżki
 
 url = "http://localhost:8000/bank_employee/add-user"
+bulk_users_url = "http://localhost:8000/bank_employee/bulk/users"
 
 # Funkcja do generowania losowego hasła
 def generate_random_password():
@@ -40,16 +42,18 @@ def generate_random_user(db):
         "role":"user"
     }
 
-# Funkcja do dodawania wielu użytkowników
+# Funkcja do dodawania wielu użytkowników -- jedno żądanie NDJSON zamiast żądania na użytkownika
 def add_multiple_users(db, num_users):
-    for _ in range(num_users):
-        user_data = generate_random_user(db)
-        response = requests.post(url, json=user_data)
+    users = [generate_random_user(db) for _ in range(num_users)]
+    body = "".join(json.dumps(user_data) + "\n" for user_data in users)
+    response = requests.post(bulk_users_url, data=body.encode(), headers={"Content-Type": "application/x-ndjson"})
 
-        if response.status_code == 200:
+    for result in (json.loads(line) for line in response.text.splitlines()):
+        user_data = users[result["line"] - 1]
+        if result["status"] == "created":
             print(f"User {user_data['username']} added successfully!")
         else:
-            print(f"Error adding user {user_data['username']}: {response.text}")
+            print(f"Error adding user {user_data['username']}: {result['detail']}")
 
 
 ## skrypt do dodawania wielu kont
@@ -57,6 +61,7 @@ def add_multiple_users(db, num_users):
 
 # Endpoint do dodawania kont
 url = "http://localhost:8000/bank_employee/add-account"
+bulk_accounts_url = "http://localhost:8000/bank_employee/bulk/accounts"
 
 # Funkcja do tworzenia konta dla użytkownika
 def create_account_for_user(user_id, initial_balance=0.0):
@@ -67,23 +72,26 @@ def create_account_for_user(user_id, initial_balance=0.0):
     response = requests.post(url, json=account_data)
     return response
 
-# Funkcja do dodania wielu kont użytkownikom
+# Funkcja do dodania wielu kont użytkownikom -- wszystkie konta jednym żądaniem NDJSON
 def create_accounts_for_users(min_accounts: int, max_accounts: int):
     db = next(get_db())
-    users = db.query(User).all()
+    user_ids = [user_id for user_id, in db.query(User.id)]
 
-    for user in users:
-        num_accounts = random.randint(min_accounts, max_accounts)
-        print(f"Creating {num_accounts} accounts for user {user.id} ({user.first_name} {user.last_name})")
-
-        for _ in range(num_accounts):
+    accounts = []
+    for user_id in user_ids:
+        for _ in range(random.randint(min_accounts, max_accounts)):
             balance = round(random.uniform(0, 10000), 2)  # przykładowe saldo
-            response = create_account_for_user(user.id, balance)
+            accounts.append({"user_id": user_id, "initial_balance": balance})
+
+    body = "".join(json.dumps(account_data) + "\n" for account_data in accounts)
+    response = requests.post(bulk_accounts_url, data=body.encode(), headers={"Content-Type": "application/x-ndjson"})
 
-            if response.status_code == 200:
-                print(f" Account created for user {user.id}")
-            else:
-                print(f" Error creating account for user {user.id}: {response.text}")
+    for result in (json.loads(line) for line in response.text.splitlines()):
+        user_id = accounts[result["line"] - 1]["user_id"]
+        if result["status"] == "created":
+            print(f" Account created for user {user_id}")
+        else:
+            print(f" Error creating account for user {user_id}: {result['detail']}")
 
 
 ####################################### functions for testing module:
@@ -112,7 +120,7 @@ def generate_transaction_logs_auto_filename(db, count: int = 50, folder: str = "
     if not accounts:
         raise ValueError("Brak aktywnych kont w systemie.")
 
-    account_balances = {acc.account_number: acc.balance for acc in accounts}
+    account_balances = {acc.account_number: to_major(acc.balance) for acc in accounts}
     transactions = []
 
     for _ in range(count):
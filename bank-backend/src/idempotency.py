@@ -0,0 +1,115 @@
+import asyncio
+import hashlib
+import json
+import time
+import uuid
+from fastapi import HTTPException
+from fastapi.responses import JSONResponse
+from pydantic import BaseModel
+from src.config import IDEMPOTENCY_TTL_SECONDS, IDEMPOTENCY_LOCK_TTL_SECONDS, IDEMPOTENCY_WAIT_TIMEOUT
+from src.notifications import RedisListener
+from src.redis_client import async_r
+
+## Idempotency-Key of the requests creating transactions (/transfer, ATM withdrawal and deposit)
+## idempotency:{scope}:{key}          -- {"fingerprint", "token"} while the first request is processed
+##                                       (expires after IDEMPOTENCY_LOCK_TTL_SECONDS if its process dies),
+##                                       then its response {"fingerprint", "status_code", "body"}
+##                                       for IDEMPOTENCY_TTL_SECONDS
+## idempotency:done:{scope}:{key}     -- channel the first request publishes to when it finishes
+## a retry is answered from redis (no database access, header Idempotent-Replayed: true), a concurrent
+## duplicate waits for the first request; the same key with a different body -- 422
+## successful responses and 4xx HTTPExceptions are stored, any other failure frees the key for the retry
+
+MAX_KEY_LENGTH = 255
+
+# Finish only the request holding the key: store its response (or free the key) and wake the duplicates
+_FINISH = async_r.register_script("""
+if redis.call('get', KEYS[1]) ~= ARGV[1] then
+    return 0
+end
+if ARGV[2] == '' then
+    redis.call('del', KEYS[1])
+else
+    redis.call('set', KEYS[1], ARGV[2], 'EX', ARGV[3])
+end
+redis.call('publish', KEYS[2], 1)
+return 1
+""")
+
+_listener = RedisListener("idempotency:done:*")
+
+
+def _fingerprint(payload: BaseModel) -> str:
+    return hashlib.sha256(payload.model_dump_json().encode()).hexdigest()
+
+
+def _replay(entry: dict):
+    if entry["status_code"] >= 400:
+        raise HTTPException(status_code=entry["status_code"], detail=entry["body"])
+    return JSONResponse(status_code=entry["status_code"], content=entry["body"],
+                        headers={"Idempotent-Replayed": "true"})
+
+
+async def _finish(cache_key: str, channel: str, marker: str, entry: dict = None):
+    value = json.dumps(entry, default=str) if entry else ""
+    await _FINISH(keys=[cache_key, channel], args=[marker, value, IDEMPOTENCY_TTL_SECONDS])
+
+
+async def run_idempotent(scope: str, key, payload: BaseModel, handler, timeout: float = IDEMPOTENCY_WAIT_TIMEOUT):
+    """
+    Run [handler] once per Idempotency-Key: retries get the stored response of the first request.
+    :param scope: who the key belongs to (operation and user / ATM) -- keys of different clients never collide
+    :param key: value of the Idempotency-Key header (None -- no idempotency, the handler just runs)
+    :param payload: request body -- a key reused with a different body is rejected
+    :param handler: async function without arguments producing the response (JSON-serializable)
+    :param timeout: how long a concurrent duplicate waits for the first request, in seconds
+    :return: response of the handler, or the replayed response
+    """
+
+    if key is None:
+        return await handler()
+    if not key or len(key) > MAX_KEY_LENGTH:
+        raise HTTPException(status_code=400, detail="Invalid Idempotency-Key.")
+
+    cache_key = f"idempotency:{scope}:{key}"
+    channel = f"idempotency:done:{scope}:{key}"
+    fingerprint = _fingerprint(payload)
+    deadline = time.monotonic() + timeout
+
+    while True:
+        marker = json.dumps({"fingerprint": fingerprint, "token": uuid.uuid4().hex})
+        if await async_r.set(cache_key, marker, nx=True, ex=IDEMPOTENCY_LOCK_TTL_SECONDS):
+            break
+
+        # Subscribe before reading -- the first request finishing in between is not missed
+        async with _listener.watch(channel) as done:
+            stored = await async_r.get(cache_key)
+            if stored is None:
+                continue        # the first request failed (or its key expired) -- this one takes over
+
+            entry = json.loads(stored)
+            if entry["fingerprint"] != fingerprint:
+                raise HTTPException(status_code=422, detail="Idempotency-Key reused with a different request.")
+            if "status_code" in entry:
+                return _replay(entry)
+
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise HTTPException(status_code=409, detail="A request with this Idempotency-Key is in progress.")
+            try:
+                await asyncio.wait_for(done, remaining)
+            except asyncio.TimeoutError:
+                pass
+
+    try:
+        response = await handler()
+    except HTTPException as e:
+        entry = {"fingerprint": fingerprint, "status_code": e.status_code, "body": e.detail}
+        await _finish(cache_key, channel, marker, entry if e.status_code < 500 else None)
+        raise
+    except BaseException:
+        await _finish(cache_key, channel, marker)
+        raise
+
+    await _finish(cache_key, channel, marker, {"fingerprint": fingerprint, "status_code": 200, "body": response})
+    return response
@@ -0,0 +1,116 @@
+import json
+import sys
+from sqlalchemy import text
+from src.database import engine
+
+## EXPLAIN checks of the hot-path indexes (src.migrations, version 4)
+## every query below has the shape of a real hot query; its plan must use the expected index
+## sequential scans are disabled for the check, so on a small (e.g. freshly migrated) database the planner
+## still shows whether the index can serve the query -- not whether it wins on the current data
+## the partition pruning of the AML window query is checked the same way
+## run from the bank-backend folder after the migrations: python -m src.index_checks (exit code 1 on failure)
+
+# (expected index, query, parameters)
+QUERY_SHAPES = [
+    # AML windows of an account (src.aml_windows sql_*, src.aml_features)
+    ("ix_transactions_from_account_date",
+     "SELECT COUNT(*) FROM transactions WHERE from_account_id = :account_id "
+     "AND date >= NOW() - INTERVAL '1 hour' AND date < NOW()",
+     {"account_id": 1}),
+    # Account history, newest first (routes.user, keyset pagination)
+    ("ix_transactions_to_account_date",
+     "SELECT id, date FROM transactions WHERE to_account_id = :account_id ORDER BY date DESC, id DESC LIMIT 50",
+     {"account_id": 1}),
+    # Requeue of the AML and settlement workers, AML panel
+    ("ix_transactions_status_date",
+     "SELECT id FROM transactions WHERE status = 'aml_approved' AND type = 'transfer'",
+     {}),
+    # ATM operations of a device in a window
+    ("ix_transactions_device_date",
+     "SELECT COUNT(*) FROM transactions WHERE device_id = :device_id AND date >= NOW() - INTERVAL '30 minutes'",
+     {"device_id": 1}),
+    # Reasons of a blocked transaction (routes.aml)
+    ("ix_aml_to_control_transaction_id",
+     "SELECT reasoning FROM aml_to_control WHERE transaction_id = :transaction_id",
+     {"transaction_id": 1}),
+]
+
+
+def _plan_values(plan: dict, key: str) -> set:
+    values = {plan[key]} if key in plan else set()
+    for child in plan.get("Plans", ()):
+        values |= _plan_values(child, key)
+    return values
+
+
+def _parent_indexes(connection, names: set) -> set:
+    # Scans of a partitioned table use the indexes of its partitions -- report the index they belong to
+    parents = dict(connection.execute(text("""
+        SELECT c.relname, p.relname FROM pg_inherits i
+        JOIN pg_class c ON c.oid = i.inhrelid
+        JOIN pg_class p ON p.oid = i.inhparent
+        WHERE c.relname = ANY(:names)
+    """), {"names": list(names)}).all()) if names else {}
+    return {parents.get(name, name) for name in names}
+
+
+def check_indexes() -> list:
+    """
+    EXPLAIN every query shape.
+    :return: list of (expected index, used indexes, passed)
+    """
+
+    results = []
+    with engine.begin() as connection:
+        connection.execute(text("SET LOCAL enable_seqscan = off"))
+        for index, query, params in QUERY_SHAPES:
+            plan = connection.execute(text(f"EXPLAIN (FORMAT JSON) {query}"), params).scalar()
+            if isinstance(plan, str):
+                plan = json.loads(plan)
+            used = _parent_indexes(connection, _plan_values(plan[0]["Plan"], "Index Name"))
+            results.append((index, used, index in used))
+
+    return results
+
+
+# AML window of the last hour -- with monthly partitions only the current (and at most the previous) month is read
+PRUNING_QUERY = ("SELECT COUNT(*) FROM transactions WHERE from_account_id = :account_id "
+                 "AND date >= NOW() - INTERVAL '1 hour' AND date < NOW()")
+
+
+def check_pruning() -> tuple:
+    """
+    EXPLAIN the AML window query on the partitioned transactions table (src.partitions).
+    :return: (scanned partitions, all partitions, passed)
+    """
+
+    with engine.begin() as connection:
+        partitions = set(connection.scalars(text("""
+            SELECT c.relname FROM pg_inherits i
+            JOIN pg_class c ON c.oid = i.inhrelid
+            JOIN pg_class p ON p.oid = i.inhparent
+            WHERE p.relname = 'transactions'
+        """)))
+        plan = connection.execute(text(f"EXPLAIN (FORMAT JSON) {PRUNING_QUERY}"), {"account_id": 1}).scalar()
+        if isinstance(plan, str):
+            plan = json.loads(plan)
+
+    scanned = _plan_values(plan[0]["Plan"], "Relation Name") & partitions
+    return scanned, partitions, bool(partitions) and len(scanned) <= 2
+
+
+def main():
+    results = check_indexes()
+    for index, used, passed in results:
+        print(f"{'OK' if passed else 'FAIL':>4}  {index}  (plan uses: {', '.join(sorted(used)) or 'no index'})")
+
+    scanned, partitions, pruned = check_pruning()
+    print(f"{'OK' if pruned else 'FAIL':>4}  partition pruning  (AML window reads {len(scanned)} of {len(partitions)} "
+          f"partitions: {', '.join(sorted(scanned)) or 'none'})")
+
+    if not pruned or not all(passed for _, _, passed in results):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
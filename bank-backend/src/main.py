@@ -1,6 +1,8 @@
+import asyncio
+from contextlib import asynccontextmanager
 import uvicorn
-import redis
 from fastapi import FastAPI
+from fastapi.concurrency import run_in_threadpool
 from fastapi.middleware.cors import CORSMiddleware
 from routes.transactions import router as transactions_router
 from routes.login import router as login_router
@@ -10,14 +12,26 @@ from routes.atm_operations import router as withdrawal_router
 from routes.admin import router as admin_router
 from routes.bank_employee import router as bank_employee_router
 from routes.aml import router as aml_router
-from src.database import engine
-from src.models import Base
+from src.atm_pool import rebuild_free_list_once, relist_periodically
+from src.auth import prune_sessions_periodically
+from src.password_pool import password_pool
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Kolejka wolnych bankomatów (redis) odtwarzana ze stanu bazy -- raz na wdrożenie, nie w każdym procesie API
+    await run_in_threadpool(rebuild_free_list_once)
+
+    # Background tasks of the API process
+    pruning = asyncio.create_task(prune_sessions_periodically())
+    relisting = asyncio.create_task(relist_periodically())
+    yield
+    pruning.cancel()
+    relisting.cancel()
+    password_pool.shutdown()
 
-# Connect to the local redis server
-r = redis.Redis(host='redis', port=6379, db=0)
 
 # Create an instance of a FastAPI app, add selected routes
-app = FastAPI()
+app = FastAPI(lifespan=lifespan)
 
 app.add_middleware(
     CORSMiddleware,
@@ -37,8 +51,7 @@ app.include_router(bank_employee_router)
 app.include_router(aml_router)
 
 
-# Create the defined tables
-Base.metadata.create_all(bind=engine)
+# The schema is created and upgraded by the migrations, before the app starts: python -m src.migrations
 
 if __name__ == "__main__":
     uvicorn.run(app, host="127.0.0.1", port=8000)   # Run the app
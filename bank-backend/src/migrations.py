@@ -0,0 +1,260 @@
+import sys
+from sqlalchemy import text
+from src.database import engine
+from src.balances import migrate_to_minor_units
+from src.transaction_stats import install_rollup
+from src.partitions import partition_transactions
+from src.aml_profile import create_amount_profiles
+
+## versioned schema migrations -- run once per deployment, before the API and the workers start
+## (not at app startup: many processes would race for DDL locks on every restart)
+## the applied versions are recorded in schema_migrations; the runner holds an advisory lock,
+## so two deployments running it at once apply every migration only once
+## version 1 is the schema of the first release in explicit DDL, every later schema change is its own
+## numbered migration -- the migrations never create tables from the current models, so a new database goes
+## through the same steps as an old one; every step checks the current state (IF NOT EXISTS, ...), so it is
+## a no-op on a database that already has the change (e.g. created by the former create_all version 1)
+## new migrations are appended -- the versions of the applied ones never change
+##
+## run from the bank-backend folder:
+##   python -m src.migrations            apply the pending migrations
+##   python -m src.migrations status     list the migrations and whether they are applied
+
+MIGRATIONS_LOCK_ID = 724091         # pg_advisory_lock key of the runner
+
+VERSIONS_DDL = """
+CREATE TABLE IF NOT EXISTS schema_migrations (
+    version INTEGER PRIMARY KEY,
+    name VARCHAR(100) NOT NULL,
+    applied_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
+)
+"""
+
+# Indexes of the hot queries: (name, table, columns, partial index condition)
+# CREATE INDEX CONCURRENTLY -- the transactions table stays writable while they are built
+HOT_PATH_INDEXES = [
+    # AML windows (src.aml_windows, src.aml_features, services.aml_batch), outgoing history
+    ("ix_transactions_from_account_date", "transactions", "from_account_id, date, id", None),
+    # Incoming history (routes.user)
+    ("ix_transactions_to_account_date", "transactions", "to_account_id, date, id", None),
+    # Work queues of the workers (pending, aml_approved) and the AML panel (aml_blocked)
+    ("ix_transactions_status_date", "transactions", "status, date", None),
+    # ATM operations per device; also the foreign key check when an ATM is deleted
+    ("ix_transactions_device_date", "transactions", "device_id, date", "device_id IS NOT NULL"),
+    # Reasons of a blocked transaction (routes.aml)
+    ("ix_aml_to_control_transaction_id", "aml_to_control", "transaction_id", None),
+]
+
+
+# Schema of the first release (version 1)
+INITIAL_SCHEMA_DDL = [
+    # CREATE TYPE has no IF NOT EXISTS
+    """
+    DO $$ BEGIN
+        CREATE TYPE account_statuses AS ENUM ('active', 'busy');
+    EXCEPTION WHEN duplicate_object THEN NULL; END $$
+    """,
+    """
+    DO $$ BEGIN
+        CREATE TYPE user_statuses AS ENUM ('active', 'disabled');
+    EXCEPTION WHEN duplicate_object THEN NULL; END $$
+    """,
+    """
+    DO $$ BEGIN
+        CREATE TYPE transaction_types AS ENUM ('deposit', 'withdrawal', 'transfer');
+    EXCEPTION WHEN duplicate_object THEN NULL; END $$
+    """,
+    """
+    DO $$ BEGIN
+        CREATE TYPE transaction_statuses AS ENUM ('pending', 'completed', 'failed', 'cancelled', 'aml_processed',
+                                                  'aml_blocked', 'aml_approved');
+    EXCEPTION WHEN duplicate_object THEN NULL; END $$
+    """,
+    """
+    DO $$ BEGIN
+        CREATE TYPE atm_statuses AS ENUM ('active', 'busy');
+    EXCEPTION WHEN duplicate_object THEN NULL; END $$
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS users (
+        id SERIAL PRIMARY KEY,
+        first_name VARCHAR(100),
+        last_name VARCHAR(100),
+        email VARCHAR(100) UNIQUE,
+        username INTEGER UNIQUE,
+        password VARCHAR(100),
+        role VARCHAR(5),
+        status user_statuses
+    )
+    """,
+    "CREATE INDEX IF NOT EXISTS ix_users_id ON users (id)",
+    """
+    CREATE TABLE IF NOT EXISTS accounts (
+        id SERIAL PRIMARY KEY,
+        account_number VARCHAR(26),
+        user_id INTEGER REFERENCES users (id),
+        balance DOUBLE PRECISION,
+        status account_statuses
+    )
+    """,
+    "CREATE INDEX IF NOT EXISTS ix_accounts_id ON accounts (id)",
+    "CREATE UNIQUE INDEX IF NOT EXISTS ix_accounts_account_number ON accounts (account_number)",
+    """
+    CREATE TABLE IF NOT EXISTS atm_devices (
+        id SERIAL PRIMARY KEY,
+        localization VARCHAR(20) NOT NULL,
+        status atm_statuses
+    )
+    """,
+    "CREATE INDEX IF NOT EXISTS ix_atm_devices_id ON atm_devices (id)",
+    """
+    CREATE TABLE IF NOT EXISTS transactions (
+        id SERIAL PRIMARY KEY,
+        from_account_id INTEGER REFERENCES accounts (id),
+        to_account_id INTEGER REFERENCES accounts (id),
+        amount DOUBLE PRECISION NOT NULL,
+        type transaction_types,
+        date TIMESTAMPTZ,
+        status transaction_statuses,
+        device_id INTEGER REFERENCES atm_devices (id)
+    )
+    """,
+    "CREATE INDEX IF NOT EXISTS ix_transactions_id ON transactions (id)",
+    """
+    CREATE TABLE IF NOT EXISTS cards (
+        id SERIAL PRIMARY KEY,
+        account_id INTEGER REFERENCES accounts (id),
+        pin VARCHAR(4) NOT NULL
+    )
+    """,
+    "CREATE INDEX IF NOT EXISTS ix_cards_id ON cards (id)",
+    """
+    CREATE TABLE IF NOT EXISTS aml_to_control (
+        id SERIAL PRIMARY KEY,
+        transaction_id INTEGER REFERENCES transactions (id),
+        reasoning VARCHAR(100),
+        changed_by_id INTEGER REFERENCES users (id),
+        change_date TIMESTAMPTZ
+    )
+    """,
+    "CREATE INDEX IF NOT EXISTS ix_aml_to_control_id ON aml_to_control (id)",
+]
+
+
+def _create_initial_schema(connection):
+    for statement in INITIAL_SCHEMA_DDL:
+        connection.execute(text(statement))
+
+
+def _add_account_lock_tokens(connection):
+    connection.execute(text("ALTER TABLE accounts ADD COLUMN IF NOT EXISTS lock_token BIGINT NOT NULL DEFAULT 0"))
+
+
+def _create_account_number_sequence(connection):
+    # Source of the account numbers (src.account_numbers)
+    connection.execute(text("CREATE SEQUENCE IF NOT EXISTS account_number_seq START 1"))
+
+
+def _create_balance_shards(connection):
+    # Sharded balances of hot accounts (src.balance_shards)
+    connection.execute(text("""
+        CREATE TABLE IF NOT EXISTS account_balance_shards (
+            account_id INTEGER NOT NULL REFERENCES accounts (id) ON DELETE CASCADE,
+            shard INTEGER NOT NULL,
+            balance BIGINT NOT NULL,
+            PRIMARY KEY (account_id, shard)
+        )
+    """))
+
+
+def _create_hot_path_indexes(connection):
+    for name, table, columns, condition in HOT_PATH_INDEXES:
+        # Partitioned tables cannot be indexed CONCURRENTLY -- they are created with the indexes (src.partitions)
+        kind = connection.execute(text("SELECT relkind FROM pg_class WHERE relname = :table"), {"table": table}).scalar()
+        if kind == "p":
+            continue
+
+        # A build interrupted earlier leaves an invalid index behind -- IF NOT EXISTS would keep it
+        invalid = connection.execute(text(
+            "SELECT 1 FROM pg_index i JOIN pg_class c ON c.oid = i.indexrelid WHERE c.relname = :name AND NOT i.indisvalid"
+        ), {"name": name}).scalar()
+        if invalid:
+            connection.execute(text(f"DROP INDEX CONCURRENTLY IF EXISTS {name}"))
+
+        where = f" WHERE {condition}" if condition else ""
+        connection.execute(text(f"CREATE INDEX CONCURRENTLY IF NOT EXISTS {name} ON {table} ({columns}){where}"))
+        connection.execute(text(f"ANALYZE {table}"))
+
+
+# (version, name, function(connection), runs in a transaction)
+MIGRATIONS = [
+    (1, "create tables", _create_initial_schema, True),
+    (2, "balances in minor units", migrate_to_minor_units, True),
+    (3, "transaction stats rollup", install_rollup, True),
+    (4, "hot-path indexes", _create_hot_path_indexes, False),
+    (5, "partition transactions by month", partition_transactions, True),
+    (6, "account lock tokens", _add_account_lock_tokens, True),
+    (7, "account amount profiles", create_amount_profiles, True),
+    (8, "account number sequence", _create_account_number_sequence, True),
+    (9, "balance shards", _create_balance_shards, True),
+]
+
+
+def applied_versions(connection) -> set:
+    connection.execute(text(VERSIONS_DDL))
+    return set(connection.scalars(text("SELECT version FROM schema_migrations")))
+
+
+def migrate() -> list:
+    """
+    Apply the pending migrations in the order of their versions.
+    :return: names of the applied migrations
+    """
+
+    applied = []
+
+    # Session-level advisory lock on its own connection -- held across the migrations' transactions
+    with engine.connect().execution_options(isolation_level="AUTOCOMMIT") as lock_connection:
+        lock_connection.execute(text("SELECT pg_advisory_lock(:id)"), {"id": MIGRATIONS_LOCK_ID})
+        try:
+            done = applied_versions(lock_connection)
+
+            for version, name, migration, transactional in MIGRATIONS:
+                if version in done:
+                    continue
+
+                if transactional:
+                    with engine.begin() as connection:
+                        migration(connection)
+                        connection.execute(text("INSERT INTO schema_migrations (version, name) VALUES (:version, :name)"),
+                                           {"version": version, "name": name})
+                else:
+                    # DDL that cannot run inside a transaction (CONCURRENTLY) -- written to be rerun when interrupted
+                    with engine.connect().execution_options(isolation_level="AUTOCOMMIT") as connection:
+                        migration(connection)
+                        connection.execute(text("INSERT INTO schema_migrations (version, name) VALUES (:version, :name)"),
+                                           {"version": version, "name": name})
+
+                applied.append(f"{version}: {name}")
+        finally:
+            lock_connection.execute(text("SELECT pg_advisory_unlock(:id)"), {"id": MIGRATIONS_LOCK_ID})
+
+    return applied
+
+
+def main():
+    if len(sys.argv) > 1 and sys.argv[1] == "status":
+        with engine.begin() as connection:
+            done = applied_versions(connection)
+        for version, name, _, _ in MIGRATIONS:
+            print(f"{version:>3} {'applied' if version in done else 'pending':>8}  {name}")
+        return
+
+    applied = migrate()
+    for migration in applied:
+        print(f"Applied {migration}")
+    print("Schema up to date." if not applied else f"Applied {len(applied)} migrations.")
+
+
+if __name__ == "__main__":
+    main()
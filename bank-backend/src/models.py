@@ -1,4 +1,4 @@
-from sqlalchemy import Column, Integer, String, Float, DateTime, ForeignKey, Enum
+from sqlalchemy import Column, Integer, BigInteger, String, Float, DateTime, ForeignKey, Enum, Index, Sequence, text
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import relationship
 from datetime import datetime, timezone
@@ -6,13 +6,17 @@ from pytz import timezone
 
 Base = declarative_base()   # Base class
 
+# Source of the account numbers (src.account_numbers) -- created with the tables
+account_number_seq = Sequence("account_number_seq", start=1, metadata=Base.metadata)
+
 class Account(Base):
     __tablename__ = 'accounts'
     id = Column(Integer, primary_key=True, index=True)  # PK: Account ID
     account_number = Column(String(26), unique=True, index=True)  # Account number
     user_id = Column(Integer, ForeignKey('users.id'))  # FK: User
-    balance = Column(Float, default=0.0)  # Account balance
+    balance = Column(BigInteger, default=0)  # Account balance in minor units (grosze), see src.balances
     status = Column(Enum("active", "busy", name="account_statuses"), default="active")
+    lock_token = Column(BigInteger, nullable=False, default=0, server_default="0")  # Last fencing token, see src.account_lock
 
     user = relationship("User", back_populates="accounts")
     card = relationship("Card", back_populates="account")
@@ -35,12 +39,14 @@ class User(Base):
 class Transaction(Base):
     __tablename__ = 'transactions'
 
-    id = Column(Integer, primary_key=True, index=True)  # PK: Transaction ID
+    # Partitioned by month of the date (src.partitions) -- the date is part of the table's primary key,
+    # the ORM identifies transactions by the id alone
+    id = Column(Integer, primary_key=True, autoincrement=True, index=True)  # PK: Transaction ID
     from_account_id = Column(Integer, ForeignKey('accounts.id'), nullable=True)  # FK: Source account ID
     to_account_id = Column(Integer, ForeignKey('accounts.id'), nullable=True)  # FK: Destination account ID
     amount = Column(Float, nullable=False)  # Amount
     type = Column(Enum("deposit", "withdrawal", "transfer", name="transaction_types"))  # Transaction type
-    date = Column(DateTime(timezone=True), default=lambda: datetime.now(timezone("Europe/Warsaw")))  # Transaction date
+    date = Column(DateTime(timezone=True), primary_key=True, default=lambda: datetime.now(timezone("Europe/Warsaw")))  # Transaction date, partition key
     status = Column(Enum("pending", "completed", "failed", "cancelled", "aml_processed", "aml_blocked", "aml_approved", name="transaction_statuses"), default="pending")  # Transaction state
     device_id = Column(Integer, ForeignKey('atm_devices.id'), nullable=True)
 
@@ -48,6 +54,16 @@ class Transaction(Base):
     to_account = relationship("Account", foreign_keys=[to_account_id])
     device = relationship("AtmDevice", foreign_keys=[device_id])
 
+    __table_args__ = (
+        Index("ix_transactions_from_account_date", "from_account_id", "date", "id"),  # Outgoing history, AML windows
+        Index("ix_transactions_to_account_date", "to_account_id", "date", "id"),  # Incoming history
+        Index("ix_transactions_status_date", "status", "date"),  # Work queues (pending, aml_approved), AML panel
+        Index("ix_transactions_device_date", "device_id", "date",
+              postgresql_where=text("device_id IS NOT NULL")),  # ATM operations per device
+        {"postgresql_partition_by": "RANGE (date)"},
+    )
+    __mapper_args__ = {"primary_key": [id]}
+
     def __repr__(self):
         return f"<Transaction(id={self.id}, amount={self.amount}, date={self.date}, type={self.type})>"
 
@@ -70,11 +86,41 @@ class AtmDevice(Base):
 class AmlToControl(Base):
     __tablename__ = 'aml_to_control'
     id = Column(Integer, primary_key=True, index=True)
-    transaction_id = Column(Integer, ForeignKey('transactions.id'), nullable=True)
+    transaction_id = Column(Integer, nullable=True)  # Transaction ID (no FK -- transactions is partitioned by date)
     reasoning = Column(String(100), unique=False)
     changed_by_id = Column(Integer, ForeignKey('users.id'), nullable=True)
     change_date = Column(DateTime(timezone=True), default=lambda: datetime.now(timezone("Europe/Warsaw")))
 
-    transaction=relationship("Transaction", foreign_keys=[transaction_id])
+    transaction=relationship("Transaction", primaryjoin="foreign(AmlToControl.transaction_id) == Transaction.id")
     changed_by=relationship("User", foreign_keys=[changed_by_id])
 
+    __table_args__ = (
+        Index("ix_aml_to_control_transaction_id", "transaction_id"),  # Reasons of a blocked transaction
+    )
+
+
+
+
+class AccountAmountProfile(Base):
+    __tablename__ = 'account_amount_profiles'
+    account_id = Column(Integer, ForeignKey('accounts.id'), primary_key=True)  # PK/FK: Account ID
+    tx_count = Column(Integer, nullable=False, default=0)  # Number of completed outgoing transactions
+    mean_amount = Column(Float, nullable=False, default=0.0)  # Running mean of the amounts
+    m2_amount = Column(Float, nullable=False, default=0.0)  # Running sum of squared deviations (Welford)
+    updated_at = Column(DateTime(timezone=True), default=lambda: datetime.now(timezone("Europe/Warsaw")))
+
+    account = relationship("Account", foreign_keys=[account_id])
+
+class TransactionStatsMinute(Base):
+    __tablename__ = 'transaction_stats_minute'
+    bucket = Column(DateTime(timezone=True), primary_key=True)  # Minute of the transaction date
+    status = Column(String(20), primary_key=True)  # Transaction state
+    type = Column(String(20), primary_key=True)  # Transaction type
+    slot = Column(Integer, primary_key=True)  # Transaction id modulo ROLLUP_SLOTS -- spreads concurrent writers
+    count = Column(Integer, nullable=False, default=0)  # Number of transactions
+
+class AccountBalanceShard(Base):
+    __tablename__ = 'account_balance_shards'
+    account_id = Column(Integer, ForeignKey('accounts.id', ondelete='CASCADE'), primary_key=True)  # FK: sharded (hot) account
+    shard = Column(Integer, primary_key=True)  # Shard number, 0..N-1
+    balance = Column(BigInteger, nullable=False, default=0)  # Part of the balance (grosze) not yet folded into the account row
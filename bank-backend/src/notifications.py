@@ -0,0 +1,92 @@
+import asyncio
+from collections import defaultdict
+from contextlib import asynccontextmanager
+import redis
+from src.config import REDIS_POOL_TIMEOUT
+from src.redis_client import async_r
+
+## notifications published through redis pub/sub (workers publish with the sync client: r.publish(channel, data))
+## every API process keeps one subscriber connection per pattern and dispatches the messages to the
+## callbacks registered for the channel -- waiting clients do not take a redis connection each
+
+
+class RedisListener:
+    """
+    Single pub/sub subscription (pattern) of the process, started on first use.
+    """
+
+    def __init__(self, pattern: str):
+        self.pattern = pattern
+        self._callbacks = defaultdict(list)
+        self._task = None
+        self._ready = None
+
+    async def _start(self, timeout: float = REDIS_POOL_TIMEOUT):
+        if self._task is None:
+            self._ready = asyncio.Event()
+            self._task = asyncio.create_task(self._listen())
+        # Subscription confirmed -- messages published from now on are not missed
+        # (redis down: the listener keeps reconnecting, the caller gets an error instead of waiting forever)
+        try:
+            await asyncio.wait_for(self._ready.wait(), timeout)
+        except asyncio.TimeoutError:
+            raise redis.ConnectionError(f"Redis listener {self.pattern} not subscribed within {timeout} s")
+
+    async def _listen(self):
+        while True:
+            pubsub = async_r.pubsub()
+            try:
+                await pubsub.psubscribe(self.pattern)
+                self._ready.set()
+                async for message in pubsub.listen():
+                    if message["type"] != "pmessage":
+                        continue
+                    channel = message["channel"].decode()
+                    for callback in list(self._callbacks.get(channel, ())):
+                        callback(message["data"])
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                # Connection lost -- messages published meanwhile are lost, waiters fall back on their timeouts
+                print(f"Redis listener {self.pattern} reconnecting: {e}")
+                await asyncio.sleep(1)
+            finally:
+                await pubsub.reset()
+
+    async def add(self, channel: str, callback):
+        """
+        Call [callback(data)] for every message published to [channel].
+        """
+
+        self._callbacks[channel].append(callback)
+        try:
+            await self._start()
+        except BaseException:
+            self.remove(channel, callback)
+            raise
+
+    def remove(self, channel: str, callback):
+        callbacks = self._callbacks.get(channel)
+        if callbacks and callback in callbacks:
+            callbacks.remove(callback)
+            if not callbacks:
+                del self._callbacks[channel]
+
+    @asynccontextmanager
+    async def watch(self, channel: str):
+        """
+        async with listener.watch(channel) as message: ... -- [message] is a future resolved with the
+        data of the first message published to [channel] after entering.
+        """
+
+        future = asyncio.get_running_loop().create_future()
+
+        def resolve(data):
+            if not future.done():
+                future.set_result(data)
+
+        await self.add(channel, resolve)
+        try:
+            yield future
+        finally:
+            self.remove(channel, resolve)
@@ -0,0 +1,339 @@
+import re
+import sys
+import time
+from datetime import date, datetime
+import pytz
+from sqlalchemy import text, update, bindparam, or_, DateTime
+from sqlalchemy.orm import Session
+from src.config import PARTITION_MONTHS_AHEAD, PARTITION_MAINTENANCE_SECONDS
+from src.database import engine
+from src.models import Transaction
+from src.transaction_stats import TRIGGER_DDL, ADD_ROWS_SQL
+
+## transactions partitioned by month of the date (declarative RANGE partitioning)
+## transactions_yYYYYmMM    -- one partition per month (Europe/Warsaw months), created PARTITION_MONTHS_AHEAD ahead
+## transactions_default     -- rows outside the created months (safety net; moved out when their month is created)
+## queries filtering on the date (AML windows, history, stats backfill) only touch the partitions of their
+## range (partition pruning, also with bind parameters); lookups by id probe the id index of every partition --
+## the work queues therefore carry the date with the id (queue_entry) and the workers look transactions up
+## by both (by_ids, update_statuses), reading one partition per transaction
+## old months are detached (the table leaves the partitioned table, its data stays) and later dropped;
+## the stats rollup (src.transaction_stats) is not changed by detaching -- the history counts remain
+##
+## run from the bank-backend folder:
+##   python -m src.partitions list
+##   python -m src.partitions ensure [months ahead]
+##   python -m src.partitions maintain               (loop, every PARTITION_MAINTENANCE_SECONDS)
+##   python -m src.partitions detach YYYY-MM         (every month before YYYY-MM)
+##   python -m src.partitions drop YYYY-MM           (detached months before YYYY-MM)
+
+TIMEZONE = "Europe/Warsaw"
+DEFAULT_PARTITION = "transactions_default"
+PARTITION_NAME = re.compile(r"^transactions_y(\d{4})m(\d{2})$")
+
+
+def _add_months(month: date, count: int) -> date:
+    index = month.year * 12 + month.month - 1 + count
+    return date(index // 12, index % 12 + 1, 1)
+
+
+def _current_month() -> date:
+    return datetime.now(pytz.timezone(TIMEZONE)).date().replace(day=1)
+
+
+def _bound(month: date) -> str:
+    return f"'{month.isoformat()} 00:00:00 {TIMEZONE}'"
+
+
+def partition_name(month: date) -> str:
+    return f"transactions_y{month.year}m{month.month:02d}"
+
+
+def _month_of(name: str):
+    match = PARTITION_NAME.match(name)
+    return date(int(match.group(1)), int(match.group(2)), 1) if match else None
+
+
+def queue_entry(transaction_id: int, tx_date: datetime = None) -> str:
+    """
+    Work queue entry of a transaction: "id@date" (the id alone when the date is unknown).
+    """
+
+    return f"{transaction_id}@{tx_date.isoformat()}" if tx_date else str(transaction_id)
+
+
+def parse_queue_entry(value) -> tuple:
+    """
+    :param value: queue entry (str or bytes) or a bare transaction id
+    :return: (transaction id, date -- None for an entry without it)
+    """
+
+    if isinstance(value, bytes):
+        value = value.decode()
+    transaction_id, _, tx_date = str(value).partition("@")
+    return int(transaction_id), datetime.fromisoformat(tx_date) if tx_date else None
+
+
+def by_ids(transaction_ids: list, dates: list = None, since: datetime = None) -> list:
+    """
+    Conditions of a lookup of transactions by id -- when all their dates are known, only their partitions are read.
+    :param since: lower bound of the date instead of the exact dates -- for transactions whose date moves forward
+                  when they are processed (ATM operations), only the partitions from its month on are read
+    """
+
+    conditions = [Transaction.id.in_(transaction_ids)]
+    if dates and all(dates):
+        conditions.append(Transaction.date.in_(set(dates)))
+    if since is not None:
+        conditions.append(Transaction.date >= since)
+    return conditions
+
+
+# Status change of one transaction, by id and date (a NULL date -- by the id alone)
+_SET_STATUS = update(Transaction.__table__).where(
+    Transaction.__table__.c.id == bindparam("tx_id"),
+    or_(bindparam("tx_date", type_=DateTime(timezone=True)).is_(None),
+        Transaction.__table__.c.date == bindparam("tx_date")),
+).values(status=bindparam("new_status"))
+
+
+def update_statuses(db: Session, statuses: dict, dates: dict):
+    """
+    Set the statuses of many transactions in one statement (executemany), each row read in its partition only.
+    :param statuses: dictionary transaction id -> new status
+    :param dates: dictionary transaction id -> date (missing or None -- the row is looked up by the id alone)
+    """
+
+    if statuses:
+        db.execute(_SET_STATUS, [{"tx_id": tx_id, "tx_date": dates.get(tx_id), "new_status": status}
+                                 for tx_id, status in statuses.items()])
+
+
+def attached_partitions(connection) -> list:
+    """
+    :return: names of the partitions of transactions, sorted
+    """
+
+    return sorted(connection.scalars(text("""
+        SELECT c.relname FROM pg_inherits i
+        JOIN pg_class c ON c.oid = i.inhrelid
+        JOIN pg_class p ON p.oid = i.inhparent
+        WHERE p.relname = 'transactions'
+    """)))
+
+
+def detached_partitions(connection) -> list:
+    """
+    :return: names of the monthly tables no longer attached to transactions, sorted
+    """
+
+    return sorted(connection.scalars(text("""
+        SELECT relname FROM pg_class
+        WHERE relname ~ '^transactions_y[0-9]{4}m[0-9]{2}$' AND relkind = 'r' AND NOT relispartition
+    """)))
+
+
+def create_partition(connection, month: date) -> bool:
+    """
+    Create the partition of the month, moving its rows out of the default partition.
+    :param connection: database connection (inside a transaction)
+    :return: False -- the partition already exists
+    """
+
+    name = partition_name(month)
+    if name in attached_partitions(connection):
+        return False
+
+    start, end = _bound(month), _bound(_add_months(month, 1))
+    has_default = DEFAULT_PARTITION in attached_partitions(connection)
+
+    if has_default and connection.execute(text(
+            f"SELECT EXISTS (SELECT 1 FROM {DEFAULT_PARTITION} WHERE date >= {start} AND date < {end})")).scalar():
+        # Rows of the month landed in the default partition -- a new partition cannot overlap them
+        connection.execute(text(f"CREATE TABLE {name} (LIKE transactions INCLUDING DEFAULTS INCLUDING CONSTRAINTS)"))
+        connection.execute(text(f"""
+            WITH moved AS (DELETE FROM {DEFAULT_PARTITION} WHERE date >= {start} AND date < {end} RETURNING *)
+            INSERT INTO {name} SELECT * FROM moved
+        """))
+        # The delete took the rows out of the stats rollup (trigger of the default partition), the insert into
+        # the not yet attached table fires no trigger -- count them back in
+        connection.execute(text(ADD_ROWS_SQL.format(table=name)))
+        connection.execute(text(f"ALTER TABLE transactions ATTACH PARTITION {name} FOR VALUES FROM ({start}) TO ({end})"))
+    else:
+        connection.execute(text(f"CREATE TABLE {name} PARTITION OF transactions FOR VALUES FROM ({start}) TO ({end})"))
+
+    return True
+
+
+def ensure_partitions(connection, months_ahead: int = PARTITION_MONTHS_AHEAD, since: date = None) -> list:
+    """
+    Create the missing partitions from [since] (default: the current month) to [months_ahead] months ahead,
+    and the default partition.
+    :param connection: database connection (inside a transaction)
+    :return: names of the created partitions
+    """
+
+    created = []
+    if DEFAULT_PARTITION not in attached_partitions(connection):
+        connection.execute(text(f"CREATE TABLE {DEFAULT_PARTITION} PARTITION OF transactions DEFAULT"))
+        created.append(DEFAULT_PARTITION)
+
+    month = (since or _current_month()).replace(day=1)
+    last = _add_months(_current_month(), months_ahead)
+    while month <= last:
+        if create_partition(connection, month):
+            created.append(partition_name(month))
+        month = _add_months(month, 1)
+
+    return created
+
+
+def detach_partitions(before: date) -> list:
+    """
+    Detach the partitions of the months before [before]; their tables stay until dropped.
+    Each detach briefly locks transactions (lock_timeout -- a busy table fails the command instead of stalling it).
+    :return: names of the detached partitions
+    """
+
+    detached = []
+    with engine.connect() as connection:
+        for name in attached_partitions(connection):
+            month = _month_of(name)
+            if month is None or month >= before:
+                continue
+            with connection.begin():
+                connection.execute(text("SET LOCAL lock_timeout = '5s'"))
+                connection.execute(text(f"ALTER TABLE transactions DETACH PARTITION {name}"))
+            detached.append(name)
+
+    return detached
+
+
+def drop_detached_partitions(before: date) -> list:
+    """
+    Drop the detached monthly tables of the months before [before].
+    :return: names of the dropped tables
+    """
+
+    dropped = []
+    with engine.begin() as connection:
+        for name in detached_partitions(connection):
+            if _month_of(name) < before:
+                connection.execute(text(f"DROP TABLE {name}"))
+                dropped.append(name)
+
+    return dropped
+
+
+## migration of an existing (unpartitioned) transactions table, version 5 of src.migrations
+## the table is rebuilt under an exclusive lock -- run it in a maintenance window
+
+# The partitioned table (src.models.Transaction) with its indexes -- the indexes of version 4 and the id index
+PARTITIONED_DDL = [
+    """
+    CREATE TABLE transactions (
+        id SERIAL,
+        from_account_id INTEGER REFERENCES accounts (id),
+        to_account_id INTEGER REFERENCES accounts (id),
+        amount DOUBLE PRECISION NOT NULL,
+        type transaction_types,
+        date TIMESTAMPTZ NOT NULL,
+        status transaction_statuses,
+        device_id INTEGER REFERENCES atm_devices (id),
+        PRIMARY KEY (id, date)
+    ) PARTITION BY RANGE (date)
+    """,
+    "CREATE INDEX ix_transactions_id ON transactions (id)",
+    "CREATE INDEX ix_transactions_from_account_date ON transactions (from_account_id, date, id)",
+    "CREATE INDEX ix_transactions_to_account_date ON transactions (to_account_id, date, id)",
+    "CREATE INDEX ix_transactions_status_date ON transactions (status, date)",
+    "CREATE INDEX ix_transactions_device_date ON transactions (device_id, date) WHERE device_id IS NOT NULL",
+]
+PARTITIONED_INDEXES = ["ix_transactions_id", "ix_transactions_from_account_date", "ix_transactions_to_account_date",
+                       "ix_transactions_status_date", "ix_transactions_device_date"]
+
+def partition_transactions(connection) -> bool:
+    """
+    Rebuild the transactions table as a partitioned table, keeping the ids and the rows.
+    :param connection: database connection (inside a transaction)
+    :return: False -- already partitioned
+    """
+
+    kind = connection.execute(text("SELECT relkind FROM pg_class WHERE relname = 'transactions'")).scalar()
+    if kind == "p":
+        return False
+
+    connection.execute(text("LOCK TABLE transactions IN ACCESS EXCLUSIVE MODE"))
+
+    # The names of the old table's objects are taken by the new table
+    connection.execute(text("ALTER TABLE aml_to_control DROP CONSTRAINT IF EXISTS aml_to_control_transaction_id_fkey"))
+    connection.execute(text("ALTER TABLE transactions RENAME TO transactions_unpartitioned"))
+    connection.execute(text("ALTER TABLE transactions_unpartitioned RENAME CONSTRAINT transactions_pkey "
+                            "TO transactions_unpartitioned_pkey"))
+    connection.execute(text("ALTER SEQUENCE IF EXISTS transactions_id_seq RENAME TO transactions_unpartitioned_id_seq"))
+    for index in PARTITIONED_INDEXES:
+        connection.execute(text(f"DROP INDEX IF EXISTS {index}"))
+
+    for statement in PARTITIONED_DDL:
+        connection.execute(text(statement))
+    since = connection.execute(text("SELECT MIN(date) FROM transactions_unpartitioned")).scalar()
+    ensure_partitions(connection, since=since.astimezone(pytz.timezone(TIMEZONE)).date() if since else None)
+
+    # Rows without a date go to the default partition (the date is part of the primary key now)
+    connection.execute(text("""
+        INSERT INTO transactions (id, from_account_id, to_account_id, amount, type, date, status, device_id)
+        SELECT id, from_account_id, to_account_id, amount, type, COALESCE(date, TO_TIMESTAMP(0)), status, device_id
+        FROM transactions_unpartitioned
+    """))
+    connection.execute(text("""
+        SELECT setval(pg_get_serial_sequence('transactions', 'id'), COALESCE(MAX(id), 0) + 1, false) FROM transactions
+    """))
+
+    # The rollup already counts these rows -- only the trigger moves to the new table
+    connection.execute(text("DROP TABLE transactions_unpartitioned CASCADE"))
+    for statement in TRIGGER_DDL:
+        connection.execute(text(statement))
+    connection.execute(text("ANALYZE transactions"))
+
+    return True
+
+
+def run_maintenance(interval: float = PARTITION_MAINTENANCE_SECONDS):
+    while True:
+        try:
+            with engine.begin() as connection:
+                created = ensure_partitions(connection)
+            if created:
+                print(f"Created partitions: {', '.join(created)}")
+        except Exception as e:
+            print(f"Partition maintenance failed: {e}")
+        time.sleep(interval)
+
+
+def _month_argument(value: str) -> date:
+    return datetime.strptime(value, "%Y-%m").date()
+
+
+def main():
+    command = sys.argv[1] if len(sys.argv) > 1 else "list"
+
+    if command == "maintain":
+        run_maintenance()
+    elif command == "ensure":
+        with engine.begin() as connection:
+            created = ensure_partitions(connection, int(sys.argv[2]) if len(sys.argv) > 2 else PARTITION_MONTHS_AHEAD)
+        print(f"Created {len(created)} partitions.")
+    elif command == "detach":
+        print(f"Detached: {', '.join(detach_partitions(_month_argument(sys.argv[2]))) or 'nothing'}")
+    elif command == "drop":
+        print(f"Dropped: {', '.join(drop_detached_partitions(_month_argument(sys.argv[2]))) or 'nothing'}")
+    else:
+        with engine.begin() as connection:
+            for name in attached_partitions(connection):
+                print(f"attached  {name}")
+            for name in detached_partitions(connection):
+                print(f"detached  {name}")
+
+
+if __name__ == "__main__":
+    main()
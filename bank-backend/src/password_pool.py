@@ -0,0 +1,102 @@
+import asyncio
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from passlib.context import CryptContext
+from src.config import BCRYPT_ROUNDS, PASSWORD_POOL_SIZE, PASSWORD_QUEUE_LIMIT
+
+## password hashing off the API threads -- bcrypt runs in a dedicated process pool of bounded size
+## at most [size] hashes run at once and at most [queue_limit] more wait; further requests are rejected
+## immediately (PasswordPoolSaturated) instead of piling up, so a login storm cannot starve other endpoints
+## hashes made with another bcrypt cost than BCRYPT_ROUNDS are recomputed at login (verify_and_update)
+
+
+# Every hash with another cost "needs update"
+pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto", bcrypt__default_rounds=BCRYPT_ROUNDS,
+                           bcrypt__min_rounds=BCRYPT_ROUNDS, bcrypt__max_rounds=BCRYPT_ROUNDS)
+
+
+class PasswordPoolSaturated(Exception):
+    """
+    All the workers are busy and the wait queue is full.
+    """
+
+
+def _hash(password: str) -> str:
+    return pwd_context.hash(password)
+
+
+def _verify_and_update(password: str, hashed_password: str) -> tuple:
+    return pwd_context.verify_and_update(password, hashed_password)
+
+
+class PasswordPool:
+    """
+    Size-bounded process pool for password hashing, created on first use.
+    """
+
+    def __init__(self, size: int = PASSWORD_POOL_SIZE, queue_limit: int = PASSWORD_QUEUE_LIMIT):
+        self.size = size
+        self.queue_limit = queue_limit
+        self.rejected = 0
+        self._slots = threading.BoundedSemaphore(size + queue_limit)
+        self._executor = None
+        self._lock = threading.Lock()
+
+    def _get_executor(self) -> ProcessPoolExecutor:
+        with self._lock:
+            if self._executor is None:
+                self._executor = ProcessPoolExecutor(max_workers=self.size)
+            return self._executor
+
+    def _submit(self, function, *args, wait: bool = False):
+        # Fast rejection -- no waiting for a slot (unless [wait]: bulk work takes its turn instead)
+        if not self._slots.acquire(blocking=wait):
+            self.rejected += 1
+            raise PasswordPoolSaturated()
+
+        try:
+            future = self._get_executor().submit(function, *args)
+        except Exception:
+            self._slots.release()
+            raise
+        future.add_done_callback(lambda _: self._slots.release())
+        return future
+
+    def hash(self, password: str) -> str:
+        """
+        Hash the password (blocks the calling thread, not the CPU of the API process).
+        """
+
+        return self._submit(_hash, password).result()
+
+    def hash_many(self, passwords: list) -> list:
+        """
+        Hash many passwords (bulk provisioning) -- one slot per hash, at most [size] of them queued at once,
+        so the rest of the queue stays free for logins.
+        """
+
+        hashes = []
+        for start in range(0, len(passwords), self.size):
+            futures = [self._submit(_hash, password, wait=True) for password in passwords[start:start + self.size]]
+            hashes.extend(future.result() for future in futures)
+        return hashes
+
+    async def hash_async(self, password: str) -> str:
+        return await asyncio.wrap_future(self._submit(_hash, password))
+
+    async def verify_async(self, password: str, hashed_password: str) -> tuple:
+        """
+        Verify the password.
+        :return: (valid, new hash -- when the stored hash has to be upgraded, otherwise None)
+        """
+
+        return await asyncio.wrap_future(self._submit(_verify_and_update, password, hashed_password))
+
+    def shutdown(self):
+        with self._lock:
+            if self._executor is not None:
+                self._executor.shutdown(wait=False, cancel_futures=True)
+                self._executor = None
+
+
+password_pool = PasswordPool()
@@ -0,0 +1,155 @@
+import threading
+import time
+import redis
+import redis.asyncio as aioredis
+from sqlalchemy import exc
+from sqlalchemy.pool import QueuePool, AsyncAdaptedQueuePool
+
+## connection pools reporting checkout metrics: number of checkouts, checkouts that had to wait
+## for a free connection, timeouts and a histogram of the checkout latency
+
+
+class PoolMetrics:
+    """
+    Checkout counters of a single pool (thread-safe).
+    """
+
+    # Upper bounds of the latency histogram buckets, in milliseconds
+    BUCKETS_MS = [1, 5, 10, 50, 100, 500, 1000, 5000, 30000]
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.checkouts = 0
+        self.waits = 0
+        self.timeouts = 0
+        self.histogram = [0] * (len(self.BUCKETS_MS) + 1)
+
+    def record(self, seconds: float, waited: bool, timed_out: bool = False):
+        milliseconds = seconds * 1000
+        bucket = next((i for i, bound in enumerate(self.BUCKETS_MS) if milliseconds <= bound), len(self.BUCKETS_MS))
+
+        with self._lock:
+            self.checkouts += 1
+            self.waits += waited
+            self.timeouts += timed_out
+            self.histogram[bucket] += 1
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            labels = [f"<={bound}ms" for bound in self.BUCKETS_MS] + [f">{self.BUCKETS_MS[-1]}ms"]
+            return {
+                "checkouts": self.checkouts,
+                "waits": self.waits,
+                "timeouts": self.timeouts,
+                "checkout_latency": dict(zip(labels, self.histogram)),
+            }
+
+
+class _MeteredPoolMixin:
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.metrics = PoolMetrics()
+
+    def _do_get(self):
+        # No idle connection and no overflow left -- the checkout has to wait for a checkin
+        waited = self.checkedin() == 0 and -1 < self._max_overflow <= self.overflow()
+        start = time.perf_counter()
+        try:
+            connection = super()._do_get()
+        except exc.TimeoutError:
+            self.metrics.record(time.perf_counter() - start, waited, timed_out=True)
+            raise
+        self.metrics.record(time.perf_counter() - start, waited)
+        return connection
+
+
+class MeteredQueuePool(_MeteredPoolMixin, QueuePool):
+    pass
+
+
+class MeteredAsyncQueuePool(_MeteredPoolMixin, AsyncAdaptedQueuePool):
+    pass
+
+
+class MeteredBlockingConnectionPool(redis.BlockingConnectionPool):
+    """
+    Redis pool that waits (up to [timeout]) for a free connection instead of failing, with checkout metrics.
+    """
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.metrics = PoolMetrics()
+
+    def get_connection(self, command_name, *keys, **options):
+        waited = self.pool.empty()
+        start = time.perf_counter()
+        try:
+            connection = super().get_connection(command_name, *keys, **options)
+        except redis.ConnectionError:
+            self.metrics.record(time.perf_counter() - start, waited, timed_out=waited)
+            raise
+        self.metrics.record(time.perf_counter() - start, waited)
+        return connection
+
+
+class MeteredAsyncBlockingConnectionPool(aioredis.BlockingConnectionPool):
+    """
+    Async redis pool that waits (up to [timeout]) for a free connection instead of failing, with checkout metrics.
+    """
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.metrics = PoolMetrics()
+
+    async def get_connection(self, command_name, *keys, **options):
+        waited = not self.can_get_connection()
+        start = time.perf_counter()
+        try:
+            connection = await super().get_connection(command_name, *keys, **options)
+        except redis.ConnectionError:
+            self.metrics.record(time.perf_counter() - start, waited, timed_out=waited)
+            raise
+        self.metrics.record(time.perf_counter() - start, waited)
+        return connection
+
+
+def sqlalchemy_pool_stats(pool) -> dict:
+    """
+    State and metrics of an SQLAlchemy pool.
+    """
+
+    return {
+        "size": pool.size(),
+        "checked_out": pool.checkedout(),
+        "idle": pool.checkedin(),
+        "overflow": max(pool.overflow(), 0),
+        **pool.metrics.snapshot(),
+    }
+
+
+def redis_pool_stats(pool: MeteredBlockingConnectionPool) -> dict:
+    """
+    State and metrics of the redis pool.
+    """
+
+    idle = sum(1 for connection in list(pool.pool.queue) if connection is not None)
+    return {
+        "max_connections": pool.max_connections,
+        "checked_out": len(pool._connections) - idle,
+        "idle": idle,
+        **pool.metrics.snapshot(),
+    }
+
+
+def async_redis_pool_stats(pool: MeteredAsyncBlockingConnectionPool) -> dict:
+    """
+    State and metrics of an async redis pool.
+    """
+
+    return {
+        "max_connections": pool.max_connections,
+        "checked_out": len(pool._in_use_connections),
+        "idle": len(pool._available_connections),
+        **pool.metrics.snapshot(),
+    }
@@ -0,0 +1,37 @@
+import redis
+import redis.asyncio as aioredis
+from src.config import (REDIS_HOST, REDIS_MAX_CONNECTIONS, REDIS_POOL_TIMEOUT, REDIS_SOCKET_TIMEOUT,
+                        REDIS_HEALTH_CHECK_INTERVAL, REDIS_BLOCKING_MAX_CONNECTIONS)
+from src.pool_metrics import MeteredBlockingConnectionPool, MeteredAsyncBlockingConnectionPool
+
+# One connection pool per process, shared by every module using redis
+pool = MeteredBlockingConnectionPool(
+    host=REDIS_HOST, port=6379, db=0,
+    max_connections=REDIS_MAX_CONNECTIONS,
+    timeout=REDIS_POOL_TIMEOUT,
+    socket_timeout=REDIS_SOCKET_TIMEOUT,
+    health_check_interval=REDIS_HEALTH_CHECK_INTERVAL,
+)
+
+r = redis.Redis(connection_pool=pool)
+
+# Async client for the async routes (commands, scripts, pub/sub listeners) -- no socket timeout
+async_pool = MeteredAsyncBlockingConnectionPool(
+    host=REDIS_HOST, port=6379, db=0,
+    max_connections=REDIS_MAX_CONNECTIONS,
+    timeout=REDIS_POOL_TIMEOUT,
+    health_check_interval=REDIS_HEALTH_CHECK_INTERVAL,
+)
+
+async_r = aioredis.Redis(connection_pool=async_pool)
+
+# Async client for blocking pops only -- every waiting client holds its connection for the whole pop,
+# so waiters never take the connections of the commands and listeners above
+blocking_pool = MeteredAsyncBlockingConnectionPool(
+    host=REDIS_HOST, port=6379, db=0,
+    max_connections=REDIS_BLOCKING_MAX_CONNECTIONS,
+    timeout=REDIS_POOL_TIMEOUT,
+    health_check_interval=REDIS_HEALTH_CHECK_INTERVAL,
+)
+
+blocking_r = aioredis.Redis(connection_pool=blocking_pool)
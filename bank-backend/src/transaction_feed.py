@@ -0,0 +1,102 @@
+import asyncio
+import json
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+from src.config import FEED_CLIENT_BUFFER
+from src.notifications import RedisListener
+from src.redis_client import r, async_r
+
+## live transaction feed of the admin panel
+## routes and workers publish transaction events to the redis channel transactions:feed, every API process
+## subscribes once (RedisListener) and fans the events out to its WebSocket/SSE clients
+## every client has its own bounded buffer: events of the same transaction are coalesced (the latest status wins)
+## and when the buffer is full the oldest event is dropped -- a slow client never holds up the others
+
+FEED_CHANNEL = "transactions:feed"
+
+
+def _event(transaction_id: int, status: str, details: dict) -> str:
+    return json.dumps({"transaction_id": transaction_id, "status": status, **details}, default=str)
+
+
+def publish_transaction_event(transaction_id: int, status: str, **details):
+    """
+    Publish a transaction event (sync client -- workers and sync routes).
+    :param transaction_id: transaction id
+    :param status: current status of the transaction
+    :param details: other fields of the event (amount, type, accounts...)
+    """
+
+    r.publish(FEED_CHANNEL, _event(transaction_id, status, details))
+
+
+def publish_transaction_events(statuses: dict):
+    """
+    Publish the status events of many transactions in one round trip (batch workers).
+    :param statuses: dictionary transaction id -> status
+    """
+
+    pipe = r.pipeline(transaction=False)
+    for transaction_id, status in statuses.items():
+        pipe.publish(FEED_CHANNEL, _event(transaction_id, status, {}))
+    pipe.execute()
+
+
+async def publish_transaction_event_async(transaction_id: int, status: str, **details):
+    """
+    Publish a transaction event (async client -- async routes).
+    """
+
+    await async_r.publish(FEED_CHANNEL, _event(transaction_id, status, details))
+
+
+class FeedClient:
+    """
+    Bounded buffer of the events waiting to be sent to one client.
+    """
+
+    def __init__(self, size: int = FEED_CLIENT_BUFFER):
+        self.size = size
+        self.dropped = 0
+        self._events = OrderedDict()
+        self._ready = asyncio.Event()
+
+    def put(self, data: bytes):
+        event = json.loads(data)
+        transaction_id = event["transaction_id"]
+
+        if transaction_id in self._events:
+            # Coalesce -- the pending event of the transaction takes the newer fields, keeps its place
+            self._events[transaction_id].update(event)
+        else:
+            if len(self._events) >= self.size:
+                self._events.popitem(last=False)
+                self.dropped += 1
+            self._events[transaction_id] = event
+
+        self._ready.set()
+
+    async def get(self) -> dict:
+        while not self._events:
+            self._ready.clear()
+            await self._ready.wait()
+
+        _, event = self._events.popitem(last=False)
+        return event
+
+
+_listener = RedisListener(FEED_CHANNEL)
+
+
+@asynccontextmanager
+async def subscribe_feed(size: int = FEED_CLIENT_BUFFER):
+    """
+    async with subscribe_feed() as client: event = await client.get()
+    """
+
+    client = FeedClient(size)
+    await _listener.add(FEED_CHANNEL, client.put)
+    try:
+        yield client
+    finally:
+        _listener.remove(FEED_CHANNEL, client.put)
@@ -76,7 +76,7 @@ const AMLDashboard = () => {
     const token = localStorage.getItem("token");
 
     try {
-      const response = await fetch(`http://localhost:8000/aml/reason?id=${tx.id}`, {
+      const response = await fetch(`http://localhost:8000/aml/reason?id=${tx.id}&date=${encodeURIComponent(tx.date)}`, {
         method: "GET",
         headers: {
           Authorization: `Bearer ${token}`,
@@ -111,7 +111,7 @@ const AMLDashboard = () => {
           Authorization: `Bearer ${token}`,
           "Content-Type": "application/json",
         },
-        body: JSON.stringify({ id: selectedTx.id }),
+        body: JSON.stringify({ id: selectedTx.id, date: selectedTx.date }),
       });
 
       if (response.ok) {
@@ -136,7 +136,7 @@ const AMLDashboard = () => {
           Authorization: `Bearer ${token}`,
           "Content-Type": "application/json",
         },
-        body: JSON.stringify({ id: selectedTx.id }),
+        body: JSON.stringify({ id: selectedTx.id, date: selectedTx.date }),
       });
 
       if (response.ok) {
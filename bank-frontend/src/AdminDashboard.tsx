@@ -34,6 +34,7 @@ const AdminDashboard = () => {
   const [loading, setLoading] = useState(true);
   const [error, setError] = useState("");
   const [transactions, setTransactions] = useState<Transaction[]>([]);
+  const [nextCursor, setNextCursor] = useState<number | null>(null);
   const navigate = useNavigate();
   const [isCreateATMOpen, setIsCreateATMOpen] = useState(false);
   const [ATMLocalization, setATMLocalization] = useState("");
@@ -117,18 +118,25 @@ const [endDate, setEndDate] = useState<Dayjs | null>(null);
     }
   };
 
-  const fetchTransactions = async () => {
+  // Pierwsza strona bez kursora, kolejne ("Załaduj więcej") od next_cursor poprzedniej -- dopisywane do listy
+  const fetchTransactions = async (cursor?: number) => {
     const token = localStorage.getItem("token");
     try {
-      const response = await fetch(`http://localhost:8000/admin/transactions`, {
+      const url = new URL("http://localhost:8000/admin/transactions");
+      if (cursor !== undefined) {
+        url.searchParams.append("cursor", String(cursor));
+      }
+      const response = await fetch(url.toString(), {
         headers: {Authorization: `Bearer ${token}`},
       });
 
       if (response.ok) {
-        const res: Transaction[] = await response.json();
-        setTransactions(res);
-      } else {
+        const res: { items: Transaction[]; next_cursor: number | null } = await response.json();
+        setTransactions((previous) => cursor !== undefined ? [...previous, ...res.items] : res.items);
+        setNextCursor(res.next_cursor);
+      } else if (cursor === undefined) {
         setTransactions([]);
+        setNextCursor(null);
       }
     } catch (err) {
       console.error("Błąd pobierania transakcji:", err);
@@ -516,6 +524,13 @@ const [endDate, setEndDate] = useState<Dayjs | null>(null);
               </TableBody>
             </Table>
           </Box>
+          {nextCursor !== null && (
+            <Box sx={{ display: 'flex', justifyContent: 'center', mt: 1 }}>
+              <Button variant="outlined" size="small" onClick={() => fetchTransactions(nextCursor)}>
+                Załaduj więcej
+              </Button>
+            </Box>
+          )}
 
           <Box sx={{ mt: 4 }}>
             <Box sx={{ display: 'flex', alignItems: 'center', mb: 2 }}>
@@ -49,6 +49,7 @@ const UserDashboard = () => {
   const [pin, setPin] = useState("");
   const [isConfirmationOpen, setIsConfirmationOpen] = useState(false);
   const [lastestTransaction, setLastestTransaction] = useState<number | null>(null);
+  const [lastestTransactionDate, setLastestTransactionDate] = useState<string | null>(null);
   const [confirmationData, setConfirmationData] = useState("");
 
   const [isDepositOpen, setIsDepositOpen] = useState(false);
@@ -426,6 +427,7 @@ const UserDashboard = () => {
         else {alert("Operacja oczekuje na weryfikację...");}
 
         setLastestTransaction(data["transaction_id"]);
+        setLastestTransactionDate(data["date"]);
         setIsConfirmationOpen(true);  // oczekiwanie na potwierdzenie
 
         //fetchTransactions(selectedAccount.id);
@@ -474,6 +476,7 @@ const UserDashboard = () => {
         else {alert("Operacja oczekuje na weryfikację...");}
 
         setLastestTransaction(data["transaction_id"]);
+        setLastestTransactionDate(data["date"]);
         setIsConfirmationOpen(true);  // oczekiwanie na potwierdzenie
 
         //fetchTransactions(selectedAccount.id);
@@ -502,7 +505,7 @@ const UserDashboard = () => {
     }
 
     try {
-      const response = await fetch(`http://localhost:8000/atm-operation/confirmation?transaction_id=${lastestTransaction}`, {
+      const response = await fetch(`http://localhost:8000/atm-operation/confirmation?transaction_id=${lastestTransaction}${lastestTransactionDate ? `&date=${encodeURIComponent(lastestTransactionDate)}` : ""}`, {
         method: "GET",
         headers: {
           "Content-Type": "application/json",
@@ -517,6 +520,7 @@ const UserDashboard = () => {
         setAmount("");
         setIsConfirmationOpen(false);
         setLastestTransaction(null);
+        setLastestTransactionDate(null);
 
         cancelATMOperationStage2();
 